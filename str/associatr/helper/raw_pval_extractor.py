@@ -43,13 +43,11 @@ def main(input_dir, cell_types, chromosomes):
                 gene_files = list(to_path(f'{input_dir}/{cell_type}/chr{chromosome}').glob('*.tsv'))
                 for gene_file in gene_files:
                     # read the raw results
-                    gene_results = pd.read_csv(gene_file, sep='\t')
-                    chr = gene_results.iloc[:, 0]
-                    pos = gene_results.iloc[:, 1]
+                    gene_results = pd.read_csv(gene_file, sep='\t', usecols=[0, 1, 5])
                     gene_name = str(gene_file).split('/')[-1].split('_')[0]
-                    pvals = gene_results.iloc[:, 5]
-                    for chr1, pos1, pval1 in zip(chr, pos, pvals):
-                        f.write(chr1 + '\t' + str(pos1) + '\t' + gene_name + '\t' + str(pval1) + '\n')
+                    gene_results.insert(2, 'gene', gene_name)
+                    # write chr, pos, gene and pval for every locus of the gene in one block
+                    gene_results.to_csv(f, sep='\t', header=False, index=False)
 
 
 if __name__ == '__main__':
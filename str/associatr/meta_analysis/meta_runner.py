@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 
 """
-This script runs R's meta package to generate pooled effect sizes for each eQTL.
-Assumes associaTR was run previously on both cohorts and gene lists were generated for each cell type and chromosome.
-Outputs a TSV file with the meta-analysis results for each gene.
+This script generates pooled effect sizes for each eQTL using a random-effects meta-analysis (DerSimonian-Laird tau^2).
+The estimates match R's meta::metagen (TE.random, seTE.random, pval.Q, pval.random and CIs), but all loci of all genes
+for a cell type and chromosome are meta-analysed as arrays in a single job.
+Assumes associaTR was run previously on all cohorts and gene lists were generated for each cell type and chromosome.
+Any number of cohorts can be meta-analysed with --results-dirs/--gene-list-dirs; loci are aligned across cohorts with a
+sorted merge-join on (chrom, pos, motif, period, ref_len).
+Outputs a TSV file with the meta-analysis results for each gene. Per-cohort columns (n_samples_tested, r2,
+allele_frequency) are numbered in the order the cohorts are given.
 
 analysis-runner --dataset "bioheart" --description "meta results runner" --access-level "test" \
     --output-dir "str/associatr/common_variants_snps/tob_n1055_and_bioheart_n990" \
@@ -14,152 +19,211 @@ analysis-runner --dataset "bioheart" --description "meta results runner" --acces
     --cell-types=B_intermediate \
     --chromosomes=chr1 \
     --always-run
+
+# equivalent run using the k-cohort options (append further cohorts to both lists)
+analysis-runner --dataset "bioheart" --description "meta results runner" --access-level "test" \
+    --output-dir "str/associatr/common_variants_snps/tob_n1055_and_bioheart_n990" \
+    meta_runner.py --results-dirs=gs://cpg-bioheart-test/str/associatr/common_variants_snps/tob_n1055/results/v4,gs://cpg-bioheart-test/str/associatr/common_variants_snps/bioheart_n990/results/v4 \
+    --gene-list-dirs=gs://cpg-bioheart-test/str/associatr/tob_n1055/input_files/scRNA_gene_lists/1_min_pct_cells_expressed,gs://cpg-bioheart-test/str/associatr/bioheart_n990/input_files/scRNA_gene_lists/1_min_pct_cells_expressed \
+    --cell-types=B_intermediate \
+    --chromosomes=chr1
 """
 import json
 
 import click
-import pandas as pd
 
 import hailtop.batch as hb
 
 from cpg_utils import to_path
-from cpg_utils.hail_batch import get_batch, image_path, output_path
+from cpg_utils.hail_batch import get_batch, output_path
 
+META_KEY_COLUMNS = ['chrom', 'pos', 'motif', 'period', 'ref_len']
 
-def run_meta_gen(input_dir_1, input_dir_2, cell_type, chr, gene):
-    """
-    Run meta-analysis (metagen) using R's meta package
-    """
 
-    # load packages
-    import rpy2.robjects as ro
-    from rpy2.robjects import pandas2ri
-
-    from cpg_utils.hail_batch import output_path
+def random_effects_meta(coeffs, ses, level=0.95):
+    """
+    Inverse-variance random-effects meta-analysis (DerSimonian-Laird tau^2) over many loci at once.
+    Mirrors R's meta::metagen(coeffs, ses, random = TRUE, method.tau = 'DL') with classic (z-based) CIs.
 
-    ro.r('library(meta)')
-    ro.r('library(tidyverse)')
+    Args:
+        coeffs (np.ndarray): effect sizes, shape (n_loci, n_studies)
+        ses (np.ndarray): standard errors, shape (n_loci, n_studies)
+        level (float): confidence level of the pooled CI
 
-    # read in raw associaTR results for each cohort for a particular gene
-    d1 = pd.read_csv(f'{input_dir_1}/{cell_type}/{chr}/{gene}_100000bp.tsv', sep='\t')
-    d2 = pd.read_csv(f'{input_dir_2}/{cell_type}/{chr}/{gene}_100000bp.tsv', sep='\t')
+    Returns:
+        dict of arrays (length n_loci): coeff_meta (TE.random), se_meta (seTE.random), pval_q_meta (pval.Q),
+        pval_meta (pval.random), lowerCI_meta, upperCI_meta (lower/upper.random) and tau2
+    """
+    import numpy as np
+    from scipy.stats import chi2, norm
+
+    coeffs = np.asarray(coeffs, dtype=np.float64)
+    ses = np.asarray(ses, dtype=np.float64)
+    n_studies = coeffs.shape[1]
+
+    # fixed effect (inverse-variance) estimate and Cochran's Q
+    w = 1 / ses**2
+    sum_w = w.sum(axis=1)
+    coeff_fixed = (w * coeffs).sum(axis=1) / sum_w
+    q = (w * (coeffs - coeff_fixed[:, None]) ** 2).sum(axis=1)
+    df = n_studies - 1
+
+    # DerSimonian-Laird between-study variance
+    c = sum_w - (w**2).sum(axis=1) / sum_w
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau2 = np.maximum(0, (q - df) / c)
+
+    # random effects estimate
+    w_random = 1 / (ses**2 + tau2[:, None])
+    se_random = np.sqrt(1 / w_random.sum(axis=1))
+    coeff_random = (w_random * coeffs).sum(axis=1) / w_random.sum(axis=1)
+    z_crit = norm.ppf(1 - (1 - level) / 2)
+
+    return {
+        'coeff_meta': coeff_random,
+        'se_meta': se_random,
+        'pval_q_meta': chi2.sf(q, df),
+        'pval_meta': 2 * norm.sf(np.abs(coeff_random / se_random)),
+        'lowerCI_meta': coeff_random - z_crit * se_random,
+        'upperCI_meta': coeff_random + z_crit * se_random,
+        'tau2': tau2,
+    }
 
-    # remove loci that failed to be tested in either dataset
-    d1 = d1[d1['locus_filtered'] == 'False']
-    d2 = d2[d2['locus_filtered'] == 'False']
 
-    # convert to R dataframe
-    with (ro.default_converter + pandas2ri.converter).context():
-        r_from_pd_df1 = ro.conversion.get_conversion().py2rpy(d1)
+def read_cohort_results(input_dir, cell_type, chr, gene):
+    """
+    Read the raw associaTR results of one cohort for a particular gene, keeping only loci that were tested
+    """
+    import pandas as pd
+
+    d = pd.read_csv(f'{input_dir}/{cell_type}/{chr}/{gene}_100000bp.tsv', sep='\t')
+    # remove loci that failed to be tested
+    d = d[d['locus_filtered'].astype(str) == 'False']
+    d = d[
+        [
+            *META_KEY_COLUMNS,
+            f'coeff_{cell_type}_{chr}_{gene}',
+            f'se_{cell_type}_{chr}_{gene}',
+            'n_samples_tested',
+            'regression_R^2',
+            'allele_frequency',
+        ]
+    ]
+    return d.rename(columns={f'coeff_{cell_type}_{chr}_{gene}': 'coeff', f'se_{cell_type}_{chr}_{gene}': 'se'})
+
+
+def merge_join_cohorts(cohort_dfs):
+    """
+    Align the loci of k cohorts with a merge-join on the locus key (chrom, pos, motif, period, ref_len).
+    Keys are encoded as integers that sort in (chrom, pos, motif, period, ref_len) order, each cohort is sorted once
+    and the sorted key arrays are intersected cohort by cohort, so adding a cohort costs one extra sorted pass.
 
-    with (ro.default_converter + pandas2ri.converter).context():
-        r_from_pd_df2 = ro.conversion.get_conversion().py2rpy(d2)
+    Args:
+        cohort_dfs (list[pd.DataFrame]): per-cohort results, each with the META_KEY_COLUMNS
 
-    # initialise R variable in the R environment
-    ro.globalenv['r_df1'] = r_from_pd_df1
-    ro.globalenv['r_df2'] = r_from_pd_df2
+    Returns:
+        list of row positions (one np.ndarray per cohort) selecting the shared loci in key order
+    """
+    import numpy as np
+    import pandas as pd
+
+    # encode the composite key jointly across cohorts, with codes ordered like the keys themselves
+    keys = pd.concat([d[META_KEY_COLUMNS] for d in cohort_dfs], ignore_index=True)
+    codes, _ = pd.MultiIndex.from_frame(keys).factorize(sort=True)
+    offsets = np.cumsum([0] + [len(d) for d in cohort_dfs])
+
+    sorted_codes = []
+    sorted_rows = []
+    for i in range(len(cohort_dfs)):
+        cohort_codes = codes[offsets[i] : offsets[i + 1]]
+        # stable sort, so that duplicated loci keep their first occurrence (as in the results file)
+        order = np.argsort(cohort_codes, kind='stable')
+        cohort_codes = cohort_codes[order]
+        first = np.ones(len(cohort_codes), dtype=bool)
+        first[1:] = cohort_codes[1:] != cohort_codes[:-1]
+        sorted_codes.append(cohort_codes[first])
+        sorted_rows.append(order[first])
+
+    shared = sorted_codes[0]
+    for cohort_codes in sorted_codes[1:]:
+        shared = np.intersect1d(shared, cohort_codes, assume_unique=True)
+
+    return [rows[np.searchsorted(cohort_codes, shared)] for cohort_codes, rows in zip(sorted_codes, sorted_rows)]
+
+
+def run_meta_chromosome(input_dirs, cell_type, chr, genes, max_workers=16):
+    """
+    Run random-effects meta-analysis over k cohorts for every gene of a cell type and chromosome in one job.
+    Loci of all genes are pooled and meta-analysed as arrays; results are written per gene.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-    # clean up dfs and merge
-    ro.r(
-        f'r_df1 = r_df1 %>% select(chrom, pos, coeff_{cell_type}_{chr}_{gene},se_{cell_type}_{chr}_{gene}, motif, period, ref_len,n_samples_tested, `regression_R^2`, allele_frequency)',
-    )
-    ro.r(
-        f'r_df2 = r_df2 %>% select(chrom, pos, coeff_{cell_type}_{chr}_{gene},se_{cell_type}_{chr}_{gene},motif, period, ref_len,n_samples_tested, `regression_R^2`, allele_frequency)',
-    )
-    ro.r(f'r_df1 = r_df1 %>% rename(coeff_1 =coeff_{cell_type}_{chr}_{gene}, se_1 =se_{cell_type}_{chr}_{gene}  )')
-    ro.r(f'r_df2 = r_df2 %>% rename(coeff_2 =coeff_{cell_type}_{chr}_{gene}, se_2 =se_{cell_type}_{chr}_{gene}  )')
-    ro.r('df <- merge(r_df1, r_df2, by = c("chrom", "pos", "motif", "period", "ref_len"))')
-
-    # initialise empty df to store meta results
-    ro.r(
-        '''
-    meta_df <- data.frame(
-    chr = character(),
-    pos = numeric(),
-    n_samples_tested_1 = numeric(),
-    n_samples_tested_2 = numeric(),
-    coeff_meta = numeric(),
-    se_meta = numeric(),
-    pval_q_meta = numeric(),
-    pval_meta = numeric(),
-    lowerCI_meta = numeric(),
-    upperCI_meta = numeric(),
-    r2_1 = numeric(),
-    r2_2 = numeric(),
-    motif = character(),
-    period = numeric(),
-    ref_len = numeric(),
-    allele_frequency_1 = numeric(),
-    allele_frequency_2 = numeric()
-    )
-    ''',
-    )
+    import numpy as np
+    import pandas as pd
 
-    # run meta
+    from cpg_utils.hail_batch import output_path
 
-    ro.r(
-        '''
-    for (i in 1:nrow(df)) {
-    # Extract values for cohort 1
-    row_cohort1 <- data.frame(
-        cohort = 1,
-        se = df[i, "se_1"],
-        coeff = df[i, "coeff_1"]
+    def merge_gene(gene):
+        cohort_dfs = [read_cohort_results(input_dir, cell_type, chr, gene) for input_dir in input_dirs]
+        rows = merge_join_cohorts(cohort_dfs)
+        return [d.iloc[r].reset_index(drop=True).assign(gene=gene) for d, r in zip(cohort_dfs, rows)]
+
+    # reading the per-gene files is I/O bound, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        merged = list(executor.map(merge_gene, genes))
+    # one aligned frame per cohort, spanning all genes
+    cohorts = [pd.concat([gene_dfs[i] for gene_dfs in merged], ignore_index=True) for i in range(len(input_dirs))]
+    cohort_numbers = range(1, len(cohorts) + 1)
+
+    meta = random_effects_meta(
+        np.column_stack([d['coeff'] for d in cohorts]),
+        np.column_stack([d['se'] for d in cohorts]),
     )
-    # Extract values for cohort 2
-    row_cohort2 <- data.frame(
-        cohort = 2,
-        se = df[i, "se_2"],
-        coeff = df[i, "coeff_2"]
-    )
-    result_df <- rbind(row_cohort1, row_cohort2)
-    m.gen = metagen(result_df$coeff, result_df$se, random = TRUE)
-
-
-    new_entry = data.frame(
-        chr = df[i, "chrom"],
-        pos = df[i, "pos"],
-        n_samples_tested_1 = df[i, "n_samples_tested.x"],
-        n_samples_tested_2 = df[i, "n_samples_tested.y"],
-        coeff_meta = m.gen$TE.random,
-        se_meta = m.gen$seTE.random,
-        pval_q_meta = m.gen$pval.Q,
-        pval_meta = m.gen$pval.random,
-        lowerCI_meta = m.gen$lower.random,
-        upperCI_meta = m.gen$upper.random,
-        r2_1 = df[i, "regression_R^2.x"],
-        r2_2 = df[i, "regression_R^2.y"],
-        motif = df[i, "motif"],
-        period = df[i, "period"],
-        ref_len = df[i, "ref_len"],
-        allele_frequency_1 = df[i, "allele_frequency.x"],
-        allele_frequency_2 = df[i, "allele_frequency.y"]
+    meta_df = pd.DataFrame(
+        {
+            'chr': cohorts[0]['chrom'],
+            'pos': cohorts[0]['pos'],
+            **{f'n_samples_tested_{i}': d['n_samples_tested'] for i, d in zip(cohort_numbers, cohorts)},
+            'coeff_meta': meta['coeff_meta'],
+            'se_meta': meta['se_meta'],
+            'pval_q_meta': meta['pval_q_meta'],
+            'pval_meta': meta['pval_meta'],
+            'lowerCI_meta': meta['lowerCI_meta'],
+            'upperCI_meta': meta['upperCI_meta'],
+            **{f'r2_{i}': d['regression_R^2'] for i, d in zip(cohort_numbers, cohorts)},
+            'motif': cohorts[0]['motif'],
+            'period': cohorts[0]['period'],
+            'ref_len': cohorts[0]['ref_len'],
+            **{f'allele_frequency_{i}': d['allele_frequency'] for i, d in zip(cohort_numbers, cohorts)},
+        },
     )
 
-    meta_df = rbind(meta_df, new_entry)
-    }
-    ''',
-    )
-
-    # convert to pandas df
-    with (ro.default_converter + pandas2ri.converter).context():
-        pd_meta_df = ro.conversion.get_conversion().rpy2py(ro.r('meta_df'))
-
-    # write to GCS
-    pd_meta_df.to_csv(
-        f'{output_path(f"meta_results/{cell_type}/{chr}/{gene}_100000bp_meta_results.tsv", "analysis")}',
-        sep='\t',
-        index=False,
-    )
+    # write to GCS, one file per gene (genes without shared loci get a header-only file)
+    gene_meta_dfs = dict(list(meta_df.groupby(cohorts[0]['gene'], sort=False)))
+    for gene in genes:
+        gene_meta_dfs.get(gene, meta_df.iloc[0:0]).to_csv(
+            output_path(f'meta_results/{cell_type}/{chr}/{gene}_100000bp_meta_results.tsv', 'analysis'),
+            sep='\t',
+            index=False,
+        )
 
 
 @click.option('--results-dir-1', help='GCS path directory to the raw associatr results for cohort 1')
 @click.option('--results-dir-2', help='GCS path directory to the raw associatr results for cohort 2')
 @click.option('--gene-list-dir-1', help='GCS path directory to the gene list for cohort 1')
 @click.option('--gene-list-dir-2', help='GCS path directory to the gene list for cohort 2')
+@click.option(
+    '--results-dirs',
+    help='Comma-separated GCS path directories to the raw associatr results for k cohorts (overrides --results-dir-1/2)',
+)
+@click.option(
+    '--gene-list-dirs',
+    help='Comma-separated GCS path directories to the gene lists for k cohorts, in the same order as --results-dirs',
+)
 @click.option('--cell-types', help='cell type')
 @click.option('--chromosomes', help='chromosomes')
 @click.option('--max-parallel-jobs', help='Maximum number of parallel jobs to run', default=500)
+@click.option('--job-cpu', help='Number of CPUs to use for each (cell type, chromosome) job', default=1)
 @click.option('--always-run', is_flag=True, help='Set job to always run')
 @click.command()
 def main(
@@ -167,9 +231,12 @@ def main(
     results_dir_2,
     gene_list_dir_1,
     gene_list_dir_2,
+    results_dirs,
+    gene_list_dirs,
     cell_types,
     chromosomes,
     max_parallel_jobs,
+    job_cpu,
     always_run,
 ):
     """
@@ -187,33 +254,39 @@ def main(
             job.depends_on(_dependent_jobs[-max_parallel_jobs])
         _dependent_jobs.append(job)
 
+    # k-cohort mode, otherwise fall back to the two-cohort options
+    input_dirs = results_dirs.split(',') if results_dirs else [results_dir_1, results_dir_2]
+    gene_dirs = gene_list_dirs.split(',') if gene_list_dirs else [gene_list_dir_1, gene_list_dir_2]
+    if len(input_dirs) != len(gene_dirs):
+        raise ValueError('The number of results directories and gene list directories must match')
+
     for cell_type in cell_types.split(','):
         for chromosome in chromosomes.split(','):
-            # get the intersection of genes tested in both cohorts
-            gene_file_path_1 = to_path(f'{gene_list_dir_1}/{cell_type}/{chromosome}_{cell_type}_gene_list.json')
-            gene_file_path_2 = to_path(f'{gene_list_dir_2}/{cell_type}/{chromosome}_{cell_type}_gene_list.json')
-            with open(gene_file_path_1) as f:
-                genes_1 = json.load(f)
-            with open(gene_file_path_2) as g:
-                genes_2 = json.load(g)
-            intersected_genes = list(set(genes_1) & set(genes_2))
-
-            # run meta-analysis for each gene
-            for gene in intersected_genes:
-                if to_path(
-                    output_path(
-                        f"meta_results/{cell_type}/{chromosome}/{gene}_100000bp_meta_results.tsv",
-                        "analysis",
-                    ),
-                ).exists():
-                    continue
-                j = get_batch(name='compute_meta').new_python_job(name=f'compute_meta_{cell_type}_{chromosome}_{gene}')
-                j.cpu(0.25)
-                if always_run:
-                    j.always_run()
-                j.image(image_path('r-meta'))
-                j.call(run_meta_gen, results_dir_1, results_dir_2, cell_type, chromosome, gene)
-                manage_concurrency_for_job(j)
+            # get the intersection of genes tested in all cohorts
+            cohort_genes = []
+            for gene_dir in gene_dirs:
+                with to_path(f'{gene_dir}/{cell_type}/{chromosome}_{cell_type}_gene_list.json').open() as f:
+                    cohort_genes.append(set(json.load(f)))
+            intersected_genes = sorted(set.intersection(*cohort_genes))
+
+            # skip genes that already have meta-analysis results (one listing per cell type and chromosome)
+            existing_genes = {
+                str(existing_file).split('/')[-1].split('_')[0]
+                for existing_file in to_path(output_path(f'meta_results/{cell_type}/{chromosome}', 'analysis')).glob(
+                    '*_100000bp_meta_results.tsv',
+                )
+            }
+            genes = [gene for gene in intersected_genes if gene not in existing_genes]
+            if not genes:
+                continue
+
+            # run meta-analysis for all genes of this cell type and chromosome in one job
+            j = get_batch(name='compute_meta').new_python_job(name=f'compute_meta_{cell_type}_{chromosome}')
+            j.cpu(job_cpu)
+            if always_run:
+                j.always_run()
+            j.call(run_meta_chromosome, input_dirs, cell_type, chromosome, genes)
+            manage_concurrency_for_job(j)
 
     get_batch().run(wait=False)
 
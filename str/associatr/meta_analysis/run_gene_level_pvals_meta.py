@@ -24,22 +24,23 @@ import hailtop.batch as hb
 from cpg_utils import to_path
 from cpg_utils.hail_batch import get_batch, reset_batch
 
-# store a mapping of the key description to the index
-VALUES_TO_INDEXES = [
-    ('chr', 0),
-    ('pos', 1),
-    ('n_samples_tested_1', 2),
-    ('n_samples_tested_2', 3),
-    ('coeff', 4),
-    ('se', 5),
-    ('pval_q', 6),
-    ('raw_pval', 7),
-    ('r2_1', 10),
-    ('r2_2', 11),
-    ('motif', 12),
-    ('ref_len', 14),
-    ('allele_frequency_1', 15),
-    ('allele_frequency_2', 16),
+# store a mapping of the key description to the meta_runner.py column (selected by name, as meta-analyses of more than
+# two cohorts insert further per-cohort columns)
+VALUES_TO_COLUMNS = [
+    ('chr', 'chr'),
+    ('pos', 'pos'),
+    ('n_samples_tested_1', 'n_samples_tested_1'),
+    ('n_samples_tested_2', 'n_samples_tested_2'),
+    ('coeff', 'coeff_meta'),
+    ('se', 'se_meta'),
+    ('pval_q', 'pval_q_meta'),
+    ('raw_pval', 'pval_meta'),
+    ('r2_1', 'r2_1'),
+    ('r2_2', 'r2_2'),
+    ('motif', 'motif'),
+    ('ref_len', 'ref_len'),
+    ('allele_frequency_1', 'allele_frequency_1'),
+    ('allele_frequency_2', 'allele_frequency_2'),
 ]
 
 
@@ -57,20 +58,20 @@ def process_single_file(gene_file: str):
 
     # read the raw results
     gene_results = pd.read_csv(gene_file, sep='\t')
-    pvals = gene_results.iloc[:, 7]  # stored in the 8th column
+    pvals = gene_results['pval_meta']
     # Find and store the attributes of the locus with lowest raw pval
-    # Find the minimum value in column 8
-    min_value = gene_results.iloc[:, 7].min()
-    # Find the rows with the minimum value in column 8
-    min_rows = gene_results[gene_results.iloc[:, 7] == min_value]
+    # Find the minimum raw pval
+    min_value = pvals.min()
+    # Find the rows with the minimum raw pval
+    min_rows = gene_results[pvals == min_value]
 
     # create a dictionary of {key: list}
-    row_dict: dict[str, list] = {key: [] for key, value in VALUES_TO_INDEXES}
+    row_dict: dict[str, list] = {key: [] for key, column in VALUES_TO_COLUMNS}
 
     # populate the dict
     for _index, row in min_rows.iterrows():
-        for key, value in VALUES_TO_INDEXES:
-            row_dict[key].append(row.iloc[value])
+        for key, column in VALUES_TO_COLUMNS:
+            row_dict[key].append(row[column])
 
     pvals = np.array(pvals)
     gene_name = gene_file.split('/')[-1].split('_')[0]
@@ -182,7 +183,7 @@ def cct(gene_files: list[str], cell_type: str, chromosome: str, og_weights=None)
                 'gene_name\tgene_level_pval\tchr\tpos\tn_samples_tested_1\tn_samples_tested_2\tcoeff\tse\tpval_q\tpval_pooled\tr2_1\tr2_2\tmotif\tref_len\tallele_freq_1\tallele_freq_2\n',
             )
             f.write(f'{gene_name}\t{pval}\t')
-            f.write('\t'.join([str(row_dict[key]) for key, _value in VALUES_TO_INDEXES]) + '\n')
+            f.write('\t'.join([str(row_dict[key]) for key, _column in VALUES_TO_COLUMNS]) + '\n')
 
 
 def bonferroni_compute(gene_files, cell_type, chromosome):
@@ -216,7 +217,7 @@ def bonferroni_compute(gene_files, cell_type, chromosome):
                 'gene_name\tgene_level_pval\tchr\tpos\tn_samples_tested_1\tn_samples_tested_2\tcoeff\tse\tpval_q\tpval_pooled\tr2_1\tr2_2\tmotif\tref_len\tallele_freq_1\tallele_freq_2\n',
             )
             f.write(f'{gene_name}\t{pval}\t')
-            f.write('\t'.join([str(row_dict[key]) for key, _value in VALUES_TO_INDEXES]) + '\n')
+            f.write('\t'.join([str(row_dict[key]) for key, _column in VALUES_TO_COLUMNS]) + '\n')
 
 
 @click.option('--input-dir', help='GCS path to the raw results of associaTR')
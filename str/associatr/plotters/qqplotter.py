@@ -2,13 +2,28 @@
 """
 This script plots a QQ plot of observed vs expected -log10(p-values) for each cell type.
 
+P-values are streamed (in chunks) into a thinning accumulator rather than held in memory: every p-value in the
+significant tail (p < --tail-pval) is kept, while the bulk is counted in fine log-spaced bins and plotted as one point
+per bin. The genomic inflation factor (lambda) is computed per cell type from the same accumulator and written to a TSV.
+
+P-values are read either from the raw_pval_extractor text files (--input-dir), or directly from the per-gene
+results files (--results-dir and --chromosomes, using the column at --pval-column-index).
+
 analysis-runner --dataset "bioheart" --description "plot qq plot" --access-level "test" \
-    --output-dir "str/associatr/tob_n1055_and_bioheart_n990" --memory=8G \
+    --output-dir "str/associatr/tob_n1055_and_bioheart_n990" \
     qqplotter.py \
     --input-dir=gs://cpg-bioheart-test/str/associatr/tob_n1055_and_bioheart_n990/DL_random_model/raw_pval_extractor \
     --cell-types=CD4_TCM,CD4_Naive,CD4_TEM,CD4_CTL,CD4_Proliferating,CD4_TCM_permuted,NK,NK_CD56bright,NK_Proliferating,CD8_TEM,CD8_TCM,CD8_Proliferating,CD8_Naive,Treg,B_naive,B_memory,B_intermediate,Plasmablast,CD14_Mono,CD16_Mono,cDC1,cDC2,pDC,dnT,gdT,MAIT,ASDC,HSPC,ILC \
     --title='associaTR BioHEART' --ylim=330
 
+analysis-runner --dataset "bioheart" --description "plot qq plot" --access-level "test" \
+    --output-dir "str/associatr/tob_n1055_and_bioheart_n990" \
+    qqplotter.py \
+    --results-dir=gs://cpg-bioheart-test/str/associatr/tob_n1055_and_bioheart_n990/DL_random_model/meta_results \
+    --chromosomes=1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22 \
+    --cell-types=CD4_TCM,CD4_TCM_permuted \
+    --title='associaTR BioHEART' --ylim=330
+
 
 """
 import click
@@ -23,29 +38,122 @@ from cpg_utils import to_path
 from cpg_utils.hail_batch import init_batch, output_path
 
 
+def new_qq_accumulator(tail_pval=1e-3, n_bins=3000):
+    """
+    Create an empty thinning accumulator.
+    The bulk (p >= tail_pval) is binned on -log10(p) in [0, -log10(tail_pval)), i.e. log-spaced in p.
+    """
+    return {
+        'n': 0,
+        'tail_pval': tail_pval,
+        'bin_edges': np.linspace(0, -np.log10(tail_pval), n_bins + 1),
+        'bin_counts': np.zeros(n_bins, dtype=np.int64),
+        'tail': [],
+    }
+
+
+def update_qq_accumulator(acc, pvals):
+    """
+    Add a chunk of p-values to the accumulator (missing values are dropped)
+    """
+    pvals = np.asarray(pvals, dtype=np.float64)
+    pvals = pvals[~np.isnan(pvals)]
+    acc['n'] += len(pvals)
+    is_tail = pvals < acc['tail_pval']
+    acc['tail'].append(pvals[is_tail])
+    log_pvals = -np.log10(pvals[~is_tail])
+    bins = np.clip(np.searchsorted(acc['bin_edges'], log_pvals, side='right') - 1, 0, len(acc['bin_counts']) - 1)
+    acc['bin_counts'] += np.bincount(bins, minlength=len(acc['bin_counts']))
+
+
+def thinned_qq_points(acc):
+    """
+    Return expected and observed -log10(p) of the thinned QQ points, and the genomic inflation factor (lambda).
+    Tail points are exact; each non-empty bulk bin contributes one point at its mid-rank.
+    An accumulator without p-values gives no points and a NaN lambda.
+    """
+    from scipy.stats import chi2
+
+    n = acc['n']
+    if n == 0:
+        return np.empty(0), np.empty(0), np.nan
+    # smallest p-values first, so that ranks run from the most significant test
+    tail = np.sort(np.concatenate(acc['tail']))
+    tail = np.maximum(tail, np.finfo(np.float64).tiny)
+    tail_expected = -np.log10(np.arange(1, len(tail) + 1) / n)
+
+    # bulk bins in order of decreasing -log10(p), i.e. increasing p
+    counts = acc['bin_counts'][::-1]
+    upper_edges = acc['bin_edges'][1:][::-1]
+    lower_edges = acc['bin_edges'][:-1][::-1]
+    rank_end = len(tail) + np.cumsum(counts)
+    mid_rank = rank_end - (counts - 1) / 2
+    non_empty = counts > 0
+    bulk_expected = -np.log10(mid_rank[non_empty] / n)
+    bulk_observed = ((upper_edges + lower_edges) / 2)[non_empty]
+
+    # median p-value, interpolated within its bin on the -log10 scale
+    median_rank = n / 2
+    if median_rank <= len(tail):
+        median_pval = tail[max(int(np.ceil(median_rank)) - 1, 0)]
+    else:
+        b = np.searchsorted(rank_end, median_rank)
+        frac = (median_rank - (rank_end[b] - counts[b])) / counts[b]
+        median_pval = 10 ** -(upper_edges[b] - frac * (upper_edges[b] - lower_edges[b]))
+    inflation = chi2.isf(median_pval, 1) / chi2.ppf(0.5, 1)
+
+    expected = np.concatenate([tail_expected, bulk_expected])
+    observed = np.concatenate([-np.log10(tail), bulk_observed])
+    return expected, observed, inflation
+
+
+def stream_extracted_pvals(input_dir, cell_type, chunksize=1_000_000):
+    """
+    Stream p-values (last column) from a raw_pval_extractor output file in chunks
+    """
+    with to_path(f'{input_dir}/{cell_type}_gene_tests_raw_pvals.txt').open() as f:
+        for chunk in pd.read_csv(f, sep='\t', header=None, usecols=[3], chunksize=chunksize):
+            yield chunk[3].to_numpy(dtype=np.float64)
+
+
+def stream_results_pvals(results_dir, cell_type, chromosomes, pval_column_index):
+    """
+    Stream p-values directly from the per-gene results files of a cell type, one gene file at a time
+    """
+    for chromosome in chromosomes.split(','):
+        for gene_file in to_path(f'{results_dir}/{cell_type}/chr{chromosome}').glob('*.tsv'):
+            yield pd.read_csv(gene_file, sep='\t', usecols=[pval_column_index]).iloc[:, 0].to_numpy(dtype=np.float64)
+
+
 @click.option('--title', help='Title of the QQ plot')
 @click.option('--ylim', help='Y-axis limit for the QQ plot', default=335)
-@click.option('--input-dir', help='GCS path directory to the input gene-level p-value files')
+@click.option('--input-dir', help='GCS path directory to the extracted raw p-value files (raw_pval_extractor.py)')
+@click.option('--results-dir', help='GCS path directory to the per-gene results files (alternative to --input-dir)')
+@click.option('--chromosomes', help='Comma-separated chromosome numbers (with --results-dir)')
+@click.option('--pval-column-index', help='Index of the p-value column in the results files', default=7)
+@click.option('--tail-pval', help='All p-values below this threshold are plotted without thinning', default=1e-3)
 @click.option('--cell-types', help='Comma-separated list of cell types to plot')
 @click.command()
-def main(input_dir, cell_types, title, ylim):
+def main(input_dir, results_dir, chromosomes, pval_column_index, tail_pval, cell_types, title, ylim):
     init_batch()
     cell_type_list = cell_types.split(',')
 
+    expected_log_pvals = {}
+    observed_log_pvals = {}
+    inflation = {}
     for cell_type in cell_type_list:
-        df = pd.read_csv(
-            f'{input_dir}/{cell_type}_gene_tests_raw_pvals.txt',
-            header=None,
-            names=['CHR', 'BP', 'raw_pval'],
-            sep='\t',
-        )
-        df = df.dropna()
-
-        globals()[f'observed_log_pvals_{cell_type}'] = -np.log10(df['raw_pval'])
-        globals()[f'n_{cell_type}'] = len(globals()[f'observed_log_pvals_{cell_type}'])
-        globals()[f'expected_log_pvals_{cell_type}'] = -np.log10(
-            np.arange(1, globals()[f'n_{cell_type}'] + 1) / globals()[f'n_{cell_type}'],
-        )
+        acc = new_qq_accumulator(tail_pval=tail_pval)
+        if results_dir:
+            chunks = stream_results_pvals(results_dir, cell_type, chromosomes, pval_column_index)
+        else:
+            chunks = stream_extracted_pvals(input_dir, cell_type)
+        for pvals in chunks:
+            update_qq_accumulator(acc, pvals)
+        if acc['n'] == 0:
+            print(f'{cell_type}: no p-values found, skipping....')
+            continue
+        expected_log_pvals[cell_type], observed_log_pvals[cell_type], inflation[cell_type] = thinned_qq_points(acc)
+        print(f'{cell_type}: {acc["n"]} tests, {len(expected_log_pvals[cell_type])} points plotted')
 
     cell_type_mapping = {
         'ASDC': 'ASDC',
@@ -116,21 +224,13 @@ def main(input_dir, cell_types, title, ylim):
         'lightskyblue',
     ]
 
-    # Pre-calculate sorted values
-    expected_sorted_values = {
-        cell_type: np.sort(globals()[f'expected_log_pvals_{cell_type}']) for cell_type in cell_type_list
-    }
-    observed_sorted_values = {
-        cell_type: np.sort(globals()[f'observed_log_pvals_{cell_type}']) for cell_type in cell_type_list
-    }
-
     # Loop through each cell type and plot the scatter plot
-    for i, cell_type in enumerate(cell_type_list):
+    for i, cell_type in enumerate(inflation):
         output_label = cell_type_mapping.get(cell_type, cell_type)
         color_index = i % len(colors)  # Get the index of the color to use for the current cell type
         ax.scatter(
-            expected_sorted_values[cell_type],
-            observed_sorted_values[cell_type],
+            expected_log_pvals[cell_type],
+            observed_log_pvals[cell_type],
             color=colors[color_index],
             label=output_label,
             s=9,
@@ -163,6 +263,13 @@ def main(input_dir, cell_types, title, ylim):
 
     ax.plot([0, 7], [0, 7], color='grey', linestyle='--')  # Add a reference line
 
+    # genomic inflation per cell type
+    pd.DataFrame({'cell_type': list(inflation), 'lambda_gc': list(inflation.values())}).to_csv(
+        output_path('summary_plots/publish/v1/qq_lambda_gc.tsv', 'analysis'),
+        sep='\t',
+        index=False,
+    )
+
     gcs_output_path = output_path('summary_plots/publish/v1/qq_plot.png', 'analysis')
     fig.tight_layout()
     fig.savefig('qqplot.png')
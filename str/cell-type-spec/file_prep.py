@@ -5,6 +5,10 @@
 This script is the first step in assessing cell type-specificity of eQTLs.
 It prepares input files for the next step, which is running the meta-analysis; and also outputs a file containing eQTLs with opposite signed betas for each cell type.
 
+A locus-keyed index of the meta-analysis results (coeff/se of every eQTL locus in every cell type) is built once, reading
+each gene's results file at most once per cell type. The index is also written out (prep_files/cross_celltype_eqtl_index.tsv)
+for reuse by meta_eqtls_runner.py.
+
 analysis-runner --dataset "bioheart" --description "eqtl_file_prep" --access-level "test" \
 --output-dir "str/associatr/cell-type-spec" file_prep.py --eqtl-file=gs://cpg-bioheart-test/str/associatr/cell-type-spec/estrs.csv \
 --associatr-dir=gs://cpg-bioheart-test/str/associatr/tob_n1055_and_bioheart_n990/DL_random_model/meta_results
@@ -14,91 +18,135 @@ analysis-runner --dataset "bioheart" --description "eqtl_file_prep" --access-lev
 
 """
 
-import logging
-
 import click
 import pandas as pd
 
 from cpg_utils.hail_batch import get_batch
 
+CELL_TYPES = 'CD4_TCM,CD4_Naive,CD4_TEM,CD4_CTL,CD4_Proliferating,CD4_TCM_permuted,NK,NK_CD56bright,NK_Proliferating,CD8_TEM,CD8_TCM,CD8_Proliferating,CD8_Naive,Treg,B_naive,B_memory,B_intermediate,Plasmablast,CD14_Mono,CD16_Mono,cDC1,cDC2,pDC,dnT,gdT,MAIT,ASDC,HSPC,ILC'
+
+# columns identifying an eQTL locus
+LOCUS_KEY = ['gene_name', 'chrom', 'pos', 'end', 'motif']
+
+
+def build_cross_celltype_index(eqtls, associatr_dir, max_workers=32):
+    """
+    Build a locus-keyed index of meta-analysis results across all cell types.
+    Every (cell type, gene) results file is read once and subset to the eQTL loci of that gene.
+
+    Returns:
+        long-format df with LOCUS_KEY, 'cell_type', 'coeff' and 'se' (one row per locus and cell type)
+    """
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+
+    import pandas as pd
 
-def meta_eqt_file_prep(cell_type_eqtls, cell_type, associatr_dir):
+    eqtl_loci = eqtls.rename(columns={'chr': 'chrom'})[LOCUS_KEY].drop_duplicates()
+    gene_loci = dict(list(eqtl_loci.groupby(['chrom', 'gene_name'])))
+
+    def read_gene(cell_type, chrom, gene):
+        file = f'{associatr_dir}/{cell_type}/{chrom}/{gene}_100000bp_meta_results.tsv'
+        try:
+            results = pd.read_csv(file, sep='\t', usecols=['pos', 'motif', 'ref_len', 'coeff_meta', 'se_meta'])
+        except FileNotFoundError:
+            logging.info(f'File {file} not found')
+            return None
+        results['end'] = (
+            (results['pos'].astype(float) + results['ref_len'].astype(float) * results['motif'].str.len().astype(float))
+            .round()
+            .astype(int)
+        )
+        results = results.merge(gene_loci[(chrom, gene)], on=['pos', 'end', 'motif'])
+        results['cell_type'] = cell_type
+        return results
+
+    # reading the per-gene files is I/O bound, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(read_gene, cell_type, chrom, gene)
+            for cell_type in CELL_TYPES.split(',')
+            for chrom, gene in gene_loci
+        ]
+        gene_results = [future.result() for future in futures]
+    gene_results = [results for results in gene_results if results is not None]
+    if not gene_results:
+        logging.info('No meta-analysis results found for the eQTL loci')
+        return pd.DataFrame(columns=[*LOCUS_KEY, 'cell_type', 'coeff', 'se'])
+    index = pd.concat(gene_results, ignore_index=True)
+
+    # a locus may be listed more than once in a results file: keep the first record, as before
+    index = index.drop_duplicates(subset=[*LOCUS_KEY, 'cell_type'])
+    return index.rename(columns={'coeff_meta': 'coeff', 'se_meta': 'se'})[[*LOCUS_KEY, 'cell_type', 'coeff', 'se']]
+
+
+def meta_eqt_file_prep(eqtls, associatr_dir):
     import pandas as pd
 
     from cpg_utils.hail_batch import output_path
 
-    meta_input_df = pd.DataFrame()
-    opposite_signed_betas = pd.DataFrame()
-    cell_type_list = 'CD4_TCM,CD4_Naive,CD4_TEM,CD4_CTL,CD4_Proliferating,CD4_TCM_permuted,NK,NK_CD56bright,NK_Proliferating,CD8_TEM,CD8_TCM,CD8_Proliferating,CD8_Naive,Treg,B_naive,B_memory,B_intermediate,Plasmablast,CD14_Mono,CD16_Mono,cDC1,cDC2,pDC,dnT,gdT,MAIT,ASDC,HSPC,ILC'
-    cell_type_array = cell_type_list.split(',')
-
-    for index, row in cell_type_eqtls.iterrows():
-        gene = row['gene_name']
-        chrom = row['chr']
-        pos = row['pos']
-        end = row['end']
-        motif = row['motif']
-        pval = row['pval_pooled']
-        for cell_type2 in cell_type_array:
-            if cell_type2 != cell_type:
-                file = f'{associatr_dir}/{cell_type2}/{chrom}/{gene}_100000bp_meta_results.tsv'
-                try:
-                    eqtl_df2 = pd.read_csv(file, sep='\t')
-                    eqtl_df2 = eqtl_df2[eqtl_df2['pos'] == pos]
-                    eqtl_df2['motif_len'] = eqtl_df2['motif'].str.len()
-                    eqtl_df2['end'] = (
-                        (
-                            eqtl_df2['pos'].astype(float)
-                            + eqtl_df2['ref_len'].astype(float) * eqtl_df2['motif_len'].astype(float)
-                        )
-                        .round()
-                        .astype(int)
-                    )
-                    eqtl_df2 = eqtl_df2[eqtl_df2['end'] == end]
-                    eqtl_df2 = eqtl_df2[eqtl_df2['motif'] == motif]
-                    eqtl_df2_coeff = eqtl_df2['coeff_meta'].iloc[0]
-                    eqtl_df2_se = eqtl_df2['se_meta'].iloc[0]
-
-                    ## add a row to the meta_input_df
-                    new_row = pd.DataFrame(
-                        {
-                            'chrom': [chrom],
-                            'pos': [pos],
-                            'end': [end],
-                            'motif': [motif],
-                            'gene_name': [gene],
-                            'celltype_main': [cell_type],
-                            'coeff_main': [row['coeff']],
-                            'se_main': [row['se']],
-                            'pval_main': [pval],
-                            'cell_type2': [cell_type2],
-                            'coeff_2': [eqtl_df2_coeff],
-                            'se_2': [eqtl_df2_se],
-                        },
-                    )
-                    meta_input_df = pd.concat([meta_input_df, new_row], ignore_index=True)
-                    if row['coeff'] * eqtl_df2_coeff < 0:
-                        opposite_signed_betas = pd.concat([opposite_signed_betas, new_row], ignore_index=True)
-                except FileNotFoundError:
-                    logging.info(f'File {file} not found')
-                    continue
-
-    o_file_path = output_path(f'prep_files/{cell_type}/meta_input_df.csv')
-    o_file_path_opposite = output_path(f'prep_files/{cell_type}/opposite_signed_betas.csv')
-    meta_input_df.to_csv(o_file_path, index=False)
-    opposite_signed_betas.to_csv(o_file_path_opposite, index=False)
+    index = build_cross_celltype_index(eqtls, associatr_dir)
+    index.to_csv(output_path('prep_files/cross_celltype_eqtl_index.tsv'), sep='\t', index=False)
+
+    # look up every eQTL in every other cell type as one join on the locus key
+    main = eqtls.rename(
+        columns={
+            'chr': 'chrom',
+            'cell_type': 'celltype_main',
+            'coeff': 'coeff_main',
+            'se': 'se_main',
+            'pval_pooled': 'pval_main',
+        },
+    )[[*LOCUS_KEY, 'celltype_main', 'coeff_main', 'se_main', 'pval_main']]
+    main['eqtl_order'] = range(len(main))
+    meta_input_df = main.merge(
+        index.rename(columns={'cell_type': 'cell_type2', 'coeff': 'coeff_2', 'se': 'se_2'}),
+        on=LOCUS_KEY,
+    )
+    meta_input_df = meta_input_df[meta_input_df['celltype_main'] != meta_input_df['cell_type2']]
+
+    # keep the eQTL order of the input file, then the order of CELL_TYPES
+    meta_input_df['cell_type2_order'] = meta_input_df['cell_type2'].map(
+        {c: i for i, c in enumerate(CELL_TYPES.split(','))},
+    )
+    meta_input_df = meta_input_df.sort_values(['eqtl_order', 'cell_type2_order'])
+    meta_input_df = meta_input_df[
+        [
+            'chrom',
+            'pos',
+            'end',
+            'motif',
+            'gene_name',
+            'celltype_main',
+            'coeff_main',
+            'se_main',
+            'pval_main',
+            'cell_type2',
+            'coeff_2',
+            'se_2',
+        ]
+    ]
+    opposite = meta_input_df['coeff_main'] * meta_input_df['coeff_2'] < 0
+
+    # write the meta-input and opposite-sign tables for each cell type in a single pass
+    for cell_type in eqtls['cell_type'].unique():
+        is_cell_type = meta_input_df['celltype_main'] == cell_type
+        o_file_path = output_path(f'prep_files/{cell_type}/meta_input_df.csv')
+        o_file_path_opposite = output_path(f'prep_files/{cell_type}/opposite_signed_betas.csv')
+        meta_input_df[is_cell_type].to_csv(o_file_path, index=False)
+        meta_input_df[is_cell_type & opposite].to_csv(o_file_path_opposite, index=False)
 
 
 @click.option('--eqtl-file', help='File containing eQTLs passing FDR threshold')
 @click.option('--associatr-dir', help='Directory containing associaTR raw outputs')
+@click.option('--job-cpu', help='Number of CPUs for the file prep job', default=4)
 @click.command()
-def main(eqtl_file, associatr_dir):
+def main(eqtl_file, associatr_dir, job_cpu):
     df = pd.read_csv(eqtl_file)
-    for cell_type in df['cell_type'].unique():
-        # for cell_type in ['ASDC']:
-        cell_type_eqtls = df[df['cell_type'] == cell_type]
-        j = get_batch(name='meta_eqt_file_prep').new_python_job(name=f'{cell_type}_meta_eqt_file_prep')
-        j.call(meta_eqt_file_prep, cell_type_eqtls, cell_type, associatr_dir)
+    # all cell types are prepared in one job, so that the cross-cell-type index is only built once
+    j = get_batch(name='meta_eqt_file_prep').new_python_job(name='meta_eqt_file_prep')
+    j.cpu(job_cpu)
+    j.call(meta_eqt_file_prep, df, associatr_dir)
 
     get_batch().run(wait=False)
 
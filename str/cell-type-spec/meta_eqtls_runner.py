@@ -11,11 +11,28 @@ analysis-runner --dataset "bioheart" --description "meta_eqtls_runner" --access-
 --output-dir "str/associatr/cell-type-spec" meta_eqtls_runner.py --file-input-dir=gs://cpg-bioheart-test/str/associatr/cell-type-spec/prep_files \
 --cell-types=ASDC
 
+With --index-file (the cross-cell-type index written by file_prep.py), all cell types are instead analysed in a single
+job: eQTL x cell-type beta/SE matrices are built from the index, and the multi-way Cochran's Q/I^2 across all cell types
+plus every pairwise (main cell type vs other cell type) DerSimonian-Laird random-effects contrast are computed as array
+operations. One table per main cell type is written, with the pairwise columns above plus the multi-way statistics.
+
+analysis-runner --dataset "bioheart" --description "meta_eqtls_runner" --access-level "test" \
+--output-dir "str/associatr/cell-type-spec" meta_eqtls_runner.py \
+--index-file=gs://cpg-bioheart-test/str/associatr/cell-type-spec/prep_files/cross_celltype_eqtl_index.tsv \
+--eqtl-file=gs://cpg-bioheart-test/str/associatr/cell-type-spec/estrs.csv
+
 ## --cell-types=CD4_TCM,CD4_Naive,CD4_TEM,CD4_CTL,CD4_Proliferating,CD4_TCM_permuted,NK,NK_CD56bright,NK_Proliferating,CD8_TEM,CD8_TCM,CD8_Proliferating,CD8_Naive,Treg,B_naive,B_memory,B_intermediate,Plasmablast,CD14_Mono,CD16_Mono,cDC1,cDC2,pDC,dnT,gdT,MAIT,ASDC,HSPC,ILC
 
 
 """
 
+import sys
+from pathlib import Path
+
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
+
 
 def run_meta_gen(file_path, cell_type):
     """
@@ -129,21 +146,138 @@ def run_meta_gen(file_path, cell_type):
     )
 
 
+def pairwise_random_effects(coeff_1, se_1, coeff_2, se_2, level=0.95):
+    """
+    Two-study DerSimonian-Laird random-effects meta-analysis, broadcast over arrays of any shape, with meta_runner.py's
+    random_effects_meta (so the estimator is shared with the cohort meta-analysis).
+    Matches R's meta::metagen(c(coeff_1, coeff_2), c(se_1, se_2), random = TRUE, method.tau = 'DL').
+    """
+    import numpy as np
+    from meta_runner import random_effects_meta
+
+    coeff_1, se_1, coeff_2, se_2 = np.broadcast_arrays(coeff_1, se_1, coeff_2, se_2)
+    meta = random_effects_meta(
+        np.column_stack([coeff_1.ravel(), coeff_2.ravel()]),
+        np.column_stack([se_1.ravel(), se_2.ravel()]),
+        level,
+    )
+    # tau2 is not part of metagen's summary columns
+    return {key: value.reshape(coeff_1.shape) for key, value in meta.items() if key != 'tau2'}
+
+
+def multiway_heterogeneity(coeffs, ses):
+    """
+    Cochran's Q and I^2 across all available cell types for each eQTL (row); missing cell types are NaN.
+    """
+    import numpy as np
+    from scipy.stats import chi2
+
+    w = np.where(np.isnan(coeffs) | np.isnan(ses), 0, 1 / ses**2)
+    coeffs = np.nan_to_num(coeffs)
+    n_celltypes = (w > 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coeff_fixed = (w * coeffs).sum(axis=1) / w.sum(axis=1)
+        q = (w * (coeffs - coeff_fixed[:, None]) ** 2).sum(axis=1)
+        df = n_celltypes - 1
+        pval_q = np.where(df > 0, chi2.sf(q, np.maximum(df, 1)), np.nan)
+        i2 = np.where(q > 0, np.maximum(0, (q - df) / q), 0)
+    return {'n_celltypes_all': n_celltypes, 'q_all': q, 'pval_q_all': pval_q, 'i2_all': i2}
+
+
+def run_all_celltype_heterogeneity(index_file, eqtl_file, *, localise_modules):
+    """
+    Assess cell type-specificity of all eQTLs across all cell types in one go, from the cross-cell-type index
+    """
+    import numpy as np
+    import pandas as pd
+
+    from cpg_utils.hail_batch import output_path
+
+    # meta_runner.py, for the pairwise random-effects estimator
+    localise_modules()
+
+    locus_key = ['gene_name', 'chrom', 'pos', 'end', 'motif']
+    index = pd.read_csv(index_file, sep='\t')
+    eqtls = pd.read_csv(eqtl_file).rename(
+        columns={
+            'chr': 'chrom',
+            'cell_type': 'celltype_main',
+            'coeff': 'coeff_main',
+            'se': 'se_main',
+            'pval_pooled': 'pval_main',
+        },
+    )
+
+    # eQTL x cell-type matrices of betas and SEs (NaN where the locus was not tested in a cell type)
+    cell_types = list(index['cell_type'].unique())
+    coeffs = index.pivot_table(index=locus_key, columns='cell_type', values='coeff', aggfunc='first')
+    ses = index.pivot_table(index=locus_key, columns='cell_type', values='se', aggfunc='first')
+    rows = pd.MultiIndex.from_frame(eqtls[locus_key])
+    coeffs = coeffs.reindex(index=rows, columns=cell_types).to_numpy()
+    ses = ses.reindex(index=rows, columns=cell_types).to_numpy()
+
+    multiway = multiway_heterogeneity(coeffs, ses)
+    pairwise = pairwise_random_effects(
+        eqtls['coeff_main'].to_numpy()[:, None],
+        eqtls['se_main'].to_numpy()[:, None],
+        coeffs,
+        ses,
+    )
+
+    # long format: one row per eQTL and other cell type where the locus was tested
+    eqtl_idx, celltype_idx = np.nonzero(
+        ~np.isnan(coeffs) & (np.array(cell_types) != eqtls['celltype_main'].to_numpy()[:, None]),
+    )
+    meta_df = eqtls.iloc[eqtl_idx][
+        ['chrom', 'pos', 'end', 'gene_name', 'motif', 'celltype_main', 'coeff_main', 'se_main', 'pval_main']
+    ]
+    meta_df = meta_df.reset_index(drop=True).assign(
+        cell_type2=np.array(cell_types)[celltype_idx],
+        coeff_2=coeffs[eqtl_idx, celltype_idx],
+        se_2=ses[eqtl_idx, celltype_idx],
+        **{key: value[eqtl_idx, celltype_idx] for key, value in pairwise.items()},
+        **{key: value[eqtl_idx] for key, value in multiway.items()},
+    )
+
+    # write one table per main cell type
+    for cell_type, cell_type_df in meta_df.groupby('celltype_main', sort=False):
+        cell_type_df.to_csv(
+            f'{output_path(f"meta_results/{cell_type}/meta_results.tsv", "analysis")}',
+            sep='\t',
+            index=False,
+        )
+
+
 import click
 
 from cpg_utils.hail_batch import get_batch, image_path
 
 
-@click.option('--file-input-dir', required=True, help='Directory containing input files for meta-analysis')
-@click.option('--cell-types', required=True, help='Comma-separated list of cell types to compare')
+@click.option('--file-input-dir', help='Directory containing input files for meta-analysis')
+@click.option('--cell-types', help='Comma-separated list of cell types to compare')
+@click.option('--index-file', help='Cross-cell-type eQTL index from file_prep.py (runs all cell types in one job)')
+@click.option('--eqtl-file', help='File containing eQTLs passing FDR threshold (required with --index-file)')
 @click.command()
-def main(file_input_dir, cell_types):
+def main(file_input_dir, cell_types, index_file, eqtl_file):
     b = get_batch(name='meta_eqtl_cell_spec_runner')
-    for cell_type in cell_types.split(','):
-        file_path = f'{file_input_dir}/{cell_type}/meta_input_df.csv'
-        meta_job = b.new_python_job(name=f'{cell_type}_meta_eqtl_cell_spec_runner')
-        meta_job.image(image_path('r-meta'))
-        meta_job.call(run_meta_gen, file_path, cell_type)
+    if index_file:
+        if not eqtl_file:
+            raise ValueError('--eqtl-file is required with --index-file')
+        meta_job = b.new_python_job(name='all_celltypes_meta_eqtl_cell_spec_runner')
+        meta_job.call(
+            run_all_celltype_heterogeneity,
+            index_file,
+            eqtl_file,
+            localise_modules=ship_modules(__file__, '../associatr/meta_analysis/meta_runner.py'),
+        )
+    else:
+        if not (file_input_dir and cell_types):
+            raise ValueError('--file-input-dir and --cell-types are required without --index-file')
+        for cell_type in cell_types.split(','):
+            file_path = f'{file_input_dir}/{cell_type}/meta_input_df.csv'
+            meta_job = b.new_python_job(name=f'{cell_type}_meta_eqtl_cell_spec_runner')
+            meta_job.image(image_path('r-meta'))
+            meta_job.call(run_meta_gen, file_path, cell_type)
     b.run(wait=False)
 
 
@@ -3,6 +3,11 @@
 """
 This script shards the UKBB SNP+STR catalog into chromosome-specific files.
 
+Each catalog is streamed in fixed-size chunks (one decompression pass, constant memory), with every chunk appended to
+22 per-chromosome spill files at once. The combined catalogs list the STR rows ahead of the SNP rows, so each spill file
+is then position-sorted on disk (GNU sort, constant memory), bgzipped (readable as plain gzip) and tabix-indexed
+(`.tbi`). All phenotypes are sharded in one job, in a pool of `--job-cpu` processes.
+
 analysis-runner --dataset "bioheart" --description "Liftover variants from hg19 to hg38" --access-level "test" \
     --output-dir "str/associatr/liftover" \
     --memory "4G" \
@@ -10,33 +15,105 @@ analysis-runner --dataset "bioheart" --description "Liftover variants from hg19
     catalog_sharder.py
 """
 
-import pandas as pd
+import sys
+from pathlib import Path
+
+import click
 
 from cpg_utils import to_path
 from cpg_utils.hail_batch import get_batch
 
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
+
+CHROMOSOMES = [f'chr{chrom_num}' for chrom_num in range(1, 23)]
 
-def sharder(phenotype):
+
+def sharder(phenotype, chunksize=500_000):
     import gzip
+    import os
+    import shutil
+    import subprocess
+    import tempfile
+
+    import pandas as pd
+    import pysam
 
     gwas_file = f'gs://cpg-bioheart-test/str/gymrek-ukbb-snp-str-gwas-catalogs/white_british_{phenotype}_snp_str_gwas_results_hg38.tab.gz'
+    local_dir = tempfile.mkdtemp()
+    spill_paths = {chrom: f'{local_dir}/{chrom}_unsorted.tab' for chrom in CHROMOSOMES}
+    spill_files = {}
     with gzip.open(to_path(gwas_file), 'rb') as f:
-        gwas = pd.read_csv(
-            f,
-            sep='\t',
-        )
+        for chunk in pd.read_csv(f, sep='\t', chunksize=chunksize):
+            if not spill_files:
+                columns = list(chunk.columns)
+                spill_files = {chrom: open(path, 'w') for chrom, path in spill_paths.items()}  # noqa: SIM115
+            for chrom, gwas_chrom in chunk.groupby('chromosome', sort=False):
+                if chrom in spill_files:
+                    gwas_chrom.to_csv(spill_files[chrom], sep='\t', index=False, header=False)
+    for spill_file in spill_files.values():
+        spill_file.close()
+    if not spill_files:
+        print(f'{phenotype} catalog is empty: skipping....')
+        return
 
-    for chrom_num in range(1, 23):
-        chrom = f'chr{chrom_num}'
-        gwas_chrom = gwas[gwas['chromosome'] == chrom]
-        gwas_chrom.to_csv(
-            f'gs://cpg-bioheart-test/str/gymrek-ukbb-snp-str-gwas-catalogs/chr-specific/white_british_{phenotype}_snp_str_gwas_results_hg38_{chrom}.tab.gz',
-            sep='\t',
-            index=False,
+    position_key = str(columns.index('position') + 1)
+    for chrom, spill_path in spill_paths.items():
+        # sort by position on disk (stable, so that rows at the same position keep the catalog order)
+        local_path = f'{local_dir}/{chrom}.tab'
+        with open(local_path, 'w') as f:
+            f.write('\t'.join(columns) + '\n')
+            f.flush()
+            subprocess.run(
+                ['sort', '-s', '-n', '-t', '\t', '-k', f'{position_key},{position_key}', '-T', local_dir, spill_path],
+                stdout=f,
+                check=True,
+                env={**os.environ, 'LC_ALL': 'C'},
+            )
+        os.remove(spill_path)
+        # bgzip (to {local_path}.gz) and index
+        pysam.tabix_index(
+            local_path,
+            seq_col=columns.index('chromosome'),
+            start_col=columns.index('position'),
+            end_col=columns.index('position'),
+            line_skip=1,
+            force=True,
         )
+        for suffix in ['.gz', '.gz.tbi']:
+            with open(local_path + suffix, 'rb') as src, to_path(
+                f'gs://cpg-bioheart-test/str/gymrek-ukbb-snp-str-gwas-catalogs/chr-specific/white_british_{phenotype}_snp_str_gwas_results_hg38_{chrom}.tab{suffix}',
+            ).open('wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(local_path + suffix)
+    print(f'Sharded {phenotype}')
+
+
+def shard_catalogs(phenotypes, max_workers, *, localise_modules):
+    """
+    Shard the catalogs of all phenotypes, one phenotype per process
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    # workers look the sharder up by module (this function is sent to the job by value, as part of __main__), so this
+    # script is shipped with the job (catalog_sharder.py, with the job_modules.py it imports)
+    localise_modules()
+    from catalog_sharder import sharder
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # list() re-raises any failure of a worker
+        list(executor.map(sharder, phenotypes))
 
 
-def main():
+@click.option('--job-cpu', help='CPU of the sharder job (one phenotype is sharded per CPU)', default=8)
+@click.option(
+    '--job-storage',
+    help='Storage of the sharder job (holds the uncompressed shards of one phenotype per CPU)',
+    default='50G',
+)
+@click.command()
+def main(job_cpu, job_storage):
     b = get_batch(name='catalog sharder')
     phenotypes = [
         "alanine_aminotransferase",
@@ -83,11 +160,15 @@ def main():
         "vitamin_d",
         "white_blood_cell_count",
     ]
-    for pheno in phenotypes:
-        liftover_job = b.new_python_job('Catalog sharder for' + pheno)
-        liftover_job.memory('32G')
-        liftover_job.storage('10G')
-        liftover_job.call(sharder, pheno)
+    sharder_job = b.new_python_job('Catalog sharder')
+    sharder_job.cpu(job_cpu)
+    sharder_job.storage(job_storage)
+    sharder_job.call(
+        shard_catalogs,
+        phenotypes,
+        max(1, int(job_cpu)),
+        localise_modules=ship_modules(__file__, 'catalog_sharder.py', '../helper/job_modules.py'),
+    )
     b.run(wait=False)
 
 
@@ -0,0 +1,143 @@
+"""
+NumPy implementation of coloc's `coloc.abf` (Wakefield approximate Bayes factors and the posterior probabilities of
+the five colocalisation hypotheses H0-H4), for datasets given as beta and varbeta per SNP; and of coloc's
+`coloc.bf_bf` for multiple signals per trait given as log Bayes factors (eg SuSiE effects), over all pairs at once.
+
+Defaults follow coloc: priors p1 = p2 = 1e-4 and p12 = 1e-5 (5e-6 for bf_bf, as coloc.susie); prior effect size SD
+0.15 * sdY for quantitative traits and 0.2 for case-control traits.
+"""
+
+import numpy as np
+import pandas as pd
+
+PP_COLUMNS = ['PP.H0.abf', 'PP.H1.abf', 'PP.H2.abf', 'PP.H3.abf', 'PP.H4.abf']
+
+
+def approx_bf_estimates(z: np.ndarray, V: np.ndarray, trait_type: str, sdY: float = 1.0) -> np.ndarray:
+    """
+    Log Wakefield approximate Bayes factors from z-scores and effect size variances
+    """
+    sd_prior = 0.15 * sdY if trait_type == 'quant' else 0.2
+    r = sd_prior**2 / (sd_prior**2 + V)
+    return 0.5 * (np.log(1 - r) + r * z**2)
+
+
+def logsum(x: np.ndarray, axis: int = -1) -> np.ndarray:
+    """
+    log(sum(exp(x))) along an axis, computed stably
+    """
+    my = np.max(x, axis=axis, keepdims=True)
+    return np.squeeze(my, axis=axis) + np.log(np.sum(np.exp(x - my), axis=axis))
+
+
+def logdiff(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    log(exp(x) - exp(y)), computed stably (elementwise)
+    """
+    my = np.maximum(x, y)
+    return my + np.log(np.exp(x - my) - np.exp(y - my))
+
+
+def combine_abf_pairs(
+    l1: np.ndarray,
+    l2: np.ndarray,
+    p1: float = 1e-4,
+    p2: float = 1e-4,
+    p12: float = 1e-5,
+) -> np.ndarray:
+    """
+    Posterior probabilities of H0-H4 of every pair of signals, from the log ABFs of the signals of the two traits
+    over the same SNPs (l1: signals1 x SNPs, l2: signals2 x SNPs)
+
+    Returns:
+        signals1 x signals2 x 5 array
+    """
+    ls1 = logsum(l1)[:, None]
+    ls2 = logsum(l2)[None, :]
+    lsum = logsum(l1[:, None, :] + l2[None, :, :])
+    all_abf = np.stack(
+        np.broadcast_arrays(
+            np.zeros_like(lsum),
+            np.log(p1) + ls1,
+            np.log(p2) + ls2,
+            np.log(p1) + np.log(p2) + logdiff(ls1 + ls2, lsum),
+            np.log(p12) + lsum,
+        ),
+        axis=-1,
+    )
+    return np.exp(all_abf - logsum(all_abf)[..., None])
+
+
+def combine_abf(l1: np.ndarray, l2: np.ndarray, p1: float = 1e-4, p2: float = 1e-4, p12: float = 1e-5) -> np.ndarray:
+    """
+    Posterior probabilities of H0-H4 from the log ABFs of the two traits over the same SNPs
+    """
+    return combine_abf_pairs(l1[None, :], l2[None, :], p1, p2, p12)[0, 0]
+
+
+def dataset_labf(dataset: pd.DataFrame, trait_type: str, sdY: float = 1.0) -> pd.Series:
+    """
+    Log ABF of each SNP of a dataset (with snp, beta and varbeta columns), indexed by SNP
+    """
+    z = dataset['beta'].to_numpy() / np.sqrt(dataset['varbeta'].to_numpy())
+    return pd.Series(approx_bf_estimates(z, dataset['varbeta'].to_numpy(), trait_type, sdY), index=dataset['snp'])
+
+
+def coloc_abf(
+    dataset1: pd.DataFrame,
+    dataset2: pd.DataFrame,
+    type1: str,
+    type2: str,
+    sdY1: float = 1.0,
+    sdY2: float = 1.0,
+    p1: float = 1e-4,
+    p2: float = 1e-4,
+    p12: float = 1e-5,
+) -> dict | None:
+    """
+    Colocalisation of two traits over their shared SNPs (datasets with snp, beta and varbeta columns)
+
+    Returns:
+        dict with nsnps and PP.H0.abf-PP.H4.abf (as coloc.abf's summary), or None if the datasets share no SNP
+    """
+    l1 = dataset_labf(dataset1, type1, sdY1)
+    l2 = dataset_labf(dataset2, type2, sdY2)
+    l1, l2 = l1.align(l2, join='inner')
+    if l1.empty:
+        return None
+    return {'nsnps': len(l1), **dict(zip(PP_COLUMNS, combine_abf(l1.to_numpy(), l2.to_numpy(), p1, p2, p12)))}
+
+
+def coloc_bf_bf(
+    lbf1: pd.DataFrame,
+    lbf2: pd.DataFrame,
+    p1: float = 1e-4,
+    p2: float = 1e-4,
+    p12: float = 5e-6,
+) -> pd.DataFrame:
+    """
+    Colocalisation of every pair of signals of two traits from their log Bayes factors (as coloc's `coloc.bf_bf`,
+    eg the `lbf_variable` of SuSiE effects with a credible set, as in `coloc.susie`), over their shared SNPs
+
+    Args:
+        lbf1, lbf2: log BFs, one row per signal (indexed by signal) and one column per SNP
+
+    Returns:
+        one row per pair of signals: nsnps, hit1, hit2 (SNP with the largest log BF of each signal),
+        PP.H0.abf-PP.H4.abf, idx1, idx2 (the signals); empty if the traits share no SNP or either has no signal
+    """
+    lbf1, lbf2 = lbf1.align(lbf2, join='inner', axis=1)
+    if lbf1.shape[1] == 0 or lbf1.empty or lbf2.empty:
+        return pd.DataFrame(columns=['nsnps', 'hit1', 'hit2', *PP_COLUMNS, 'idx1', 'idx2'])
+    l1, l2 = lbf1.to_numpy(dtype=float), lbf2.to_numpy(dtype=float)
+    pp = combine_abf_pairs(l1, l2, p1, p2, p12).reshape(-1, len(PP_COLUMNS))
+    idx1, idx2 = np.meshgrid(np.arange(len(l1)), np.arange(len(l2)), indexing='ij')
+    idx1, idx2 = idx1.ravel(), idx2.ravel()
+    snps = lbf1.columns.to_numpy()
+    results = pd.DataFrame(pp, columns=PP_COLUMNS)
+    results.insert(0, 'nsnps', lbf1.shape[1])
+    results.insert(1, 'hit1', snps[np.argmax(l1, axis=1)][idx1])
+    results.insert(2, 'hit2', snps[np.argmax(l2, axis=1)][idx2])
+    results['idx1'] = lbf1.index.to_numpy()[idx1]
+    results['idx2'] = lbf2.index.to_numpy()[idx2]
+    return results
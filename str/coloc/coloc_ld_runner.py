@@ -11,9 +11,9 @@ Workflow:
 2) Extract the coordinates of the cis-window (gene +/- 100kB) for each gene using a gene annotation file.
 3) Extract the top STR locus (ie passed FDR 5% threshold) for each gene in 1). May be multiple STRs per gene (if tied for smallest ACAT-corrected p-value).
 4) Run LD parser() which:
-- Extracts GTs for all SNPs (from a chr-specific VCF) in the cis-window for a gene.
+- Extracts GTs for all SNPs (from a chr-specific VCF) in the cis-window for a gene, into one preallocated array.
 - Extracts GTs for the specified STR locus associated with the gene.
-- Calculates pairwise correlation of every SNP locus with the target STR locus.
+- Calculates pairwise correlation of every SNP locus with the target STR locus (one matrix-vector product, see ld_utils.py).
 - Save the SNP with the highest absolute correlation to a TSV file. Output to GCP
 
 analysis-runner --dataset "bioheart" \
@@ -30,9 +30,12 @@ analysis-runner --dataset "bioheart" \
 """
 
 import ast
+import sys
+from pathlib import Path
 
 import click
 import pandas as pd
+from gwas_windows import cis_windows
 
 from hailtop.batch import ResourceGroup
 
@@ -40,6 +43,10 @@ from cpg_utils import to_path
 from cpg_utils.config import output_path
 from cpg_utils.hail_batch import get_batch
 
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
+
 
 def ld_parser(
     snp_vcf_path: ResourceGroup,
@@ -49,51 +56,36 @@ def ld_parser(
     gwas_snp_path: str,
     gene: str,
     celltype: str,
+    *,
+    localise_modules,
 ) -> str:
     import pandas as pd
     from cyvcf2 import VCF
 
-    # create empty DF to store the relevant GTs (SNPs)
-    df = pd.DataFrame(columns=['individual'])
+    # ld_utils.py, shipped with the job
+    localise_modules()
+    from ld_utils import correlate_with, read_snp_window, read_str_dosage, shared_samples
 
     # cyVCF2 reads the SNP VCF
     vcf = VCF(snp_vcf_path['vcf'])
-    df['individual'] = vcf.samples
     print('Reading SNP VCF with VCF()')
 
     print('Starting to subset VCF for window...')
-    for variant in vcf(window):
-        geno = variant.gt_types  # extracts GTs as a numpy array
-        locus = variant.CHROM + ':' + str(variant.POS)
-        df_to_append = pd.DataFrame(geno, columns=[locus])  # creates a temp df to store the GTs for one locus
-
-        # concatenate results to the main df
-        df = pd.concat([df, df_to_append], axis=1)
+    loci, genotypes = read_snp_window(vcf, window)
     print("Finished subsetting VCF for window")
 
     # extract GTs for the one STR
     str_vcf = VCF(str_vcf_path['vcf'])
-    for variant in str_vcf(str_locus):
-        print(f'Captured STR with POS:{variant.POS}')
-        ds = variant.format('DS')
-        ds_list = []
-        for i in range(len(ds)):
-            ds_list.append(ds[i][0])
-        target_data = {'individual': str_vcf.samples, str_locus: ds_list}
-        target_df = pd.DataFrame(target_data)
-        break  # take the first STR locus
-
-    # merge the two dataframes
-    merged_df = df.merge(target_df, on='individual')
-
-    # calculate pairwise correlation of every SNP locus with target STR locus
-    correlation_series = merged_df.drop(columns='individual').corrwith(merged_df[str_locus])
-
-    correlation_df = pd.DataFrame(correlation_series, columns=['correlation'])
-    correlation_df['locus'] = correlation_df.index
+    dosage = read_str_dosage(str_vcf, str_locus)
+    if dosage is None:
+        raise ValueError(f'No STR at {str_locus} in the STR VCF')
 
-    # drop the STR locus from the list of SNPs (it will automatically have a correlation of 1)
-    correlation_df = correlation_df[correlation_df['locus'] != str_locus]
+    # calculate pairwise correlation of every SNP locus with target STR locus (samples in both VCFs)
+    snp_cols, str_cols = shared_samples(vcf.samples, str_vcf.samples)
+    correlation_df = pd.DataFrame(
+        {'correlation': correlate_with(genotypes[:, snp_cols], dosage[str_cols]), 'locus': loci},
+        index=loci,
+    )
 
     # keep only the SNPs that are in the GWAS catalog
     gwas_snps = pd.read_csv(gwas_snp_path)
@@ -156,6 +148,8 @@ def main(
     pp_h4_cutoff: float,
 ):
     b = get_batch()
+    # read in the gene annotation file once, for the cis-window coordinates (gene +/- 100kB) of every gene
+    gene_annotation_table = pd.read_csv(gene_annotation_file)
     for celltype in celltypes.split(','):
         # read in STR eGene annotation file
         str_fdr_file = f'{str_fdr_dir}/{celltype}_qval.tsv'
@@ -166,19 +160,16 @@ def main(
         coloc_results = pd.read_csv(coloc_result_file)
         # subset results for posterior probability of a shared causal variant >=pp_h4_cutoff
         coloc_results = coloc_results[coloc_results['PP.H4.abf'] >= pp_h4_cutoff]
+        windows = cis_windows(gene_annotation_table, coloc_results['gene'].unique()).set_index('gene')
 
         # obtain inputs for LD parsing for each entry in `coloc_results`:
-        for index, row in coloc_results.iterrows():
-            gene = row['gene']
+        for gene in coloc_results['gene']:
+            if gene not in windows.index:
+                continue
             # obtain snp cis-window coordinates for the gene
-            gene_annotation_table = pd.read_csv(gene_annotation_file)
-            gene_table = gene_annotation_table[
-                gene_annotation_table['gene_ids'] == gene
-            ]  # subset to particular ENSG ID
-            start_snp_window = float(gene_table['start'].astype(float)) - 100000  # +-100kB window around gene
-            end_snp_window = float(gene_table['end'].astype(float)) + 100000  # +-100kB window around gene
-            chr = gene_table['chr'].iloc[0][3:]
-            snp_window = f'{chr}:{start_snp_window}-{end_snp_window}'
+            chrom, start_snp_window, end_snp_window = windows.loc[gene, ['chrom', 'start', 'end']]
+            chr = chrom[3:]
+            snp_window = f'{chr}:{max(int(start_snp_window), 1)}-{int(end_snp_window)}'
             print('Obtained SNP window coordinates')
 
             # obtain top STR locus for the gene
@@ -222,6 +213,7 @@ def main(
                     gwas_snp_path,
                     gene,
                     celltype,
+                    localise_modules=ship_modules(__file__, 'ld_utils.py'),
                 )
 
                 b.write_output(result.as_str(), write_path)
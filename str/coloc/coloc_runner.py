@@ -3,10 +3,11 @@
 """
 This script performs SNP-only colocalisation analysis betweeen eGenes identified by pseudobulk STR analysis and GWAS signals.
 Assumes that the SNP GWAS data has been pre-processed with the following columns: 'chromosome', 'position' (hg38 bp), 'snp'(chromosome_position_refallele_effectallele), 'beta', 'varbeta'
+and ingested into a GWAS store (`gwas_store.py`), from which each job queries its own cis-window.
 
 1) Identify eGenes where at least one STR has pval < 5e-8
 2) Extract the SNP GWAS data for the cis-window (gene +/- 100kB)
-3) Run coloc for each eGene (if the SNP GWAS data has at least one variant with pval <5e-8)
+3) Run coloc (NumPy implementation of coloc.abf, see `coloc_abf.py`) for each eGene, all eGenes of a cell type in one job
 4) Write the results to a TSV file
 
 analysis-runner --dataset "bioheart" \
@@ -16,43 +17,47 @@ analysis-runner --dataset "bioheart" \
     --image "australia-southeast1-docker.pkg.dev/analysis-runner/images/driver:d4922e3062565ff160ac2ed62dcdf2fba576b75a-hail-8f6797b033d2e102575c40166cf0c977e91f834e" \
     --output-dir "str/associatr" \
     coloc_runner.py \
-    --snp-gwas-file=gs://cpg-bioheart-test/str/gwas_catalog/gcst/gcst-gwas-catalogs/ibd_EAS_EUR_SiKJEF_meta_IBD.tsv \
+    --gwas-store-dir=gs://cpg-bioheart-test/str/gwas_catalog/gcst/gwas-store/ibd_EAS_EUR_SiKJEF_meta_IBD \
     --pheno-output-name="ibd_liu2023" \
     --celltypes "NK"
 
+Matrix mode: several phenotypes (comma separated, paired in order) are tested in one pass, reading each gene's eQTL
+statistics once, and written as a gene x phenotype x cell type table
+(`coloc-snp-only/sig_str_filter_only/{matrix-output-name}/all_celltypes_coloc_matrix.tsv`, with PP.H4 pivoted to
+one column per phenotype in `all_celltypes_pp_h4.tsv`):
+
+    coloc_runner.py \
+    --gwas-store-dir=gs://cpg-bioheart-test/str/gwas_catalog/gcst/gwas-store/ibd_EAS_EUR_SiKJEF_meta_IBD,gs://cpg-bioheart-test/str/gwas_catalog/gcst/gwas-store/GCST011071 \
+    --pheno-output-name="ibd_liu2023,covid_GCST011071" \
+    --matrix-output-name="ibd_covid" \
+    --celltypes "NK,CD4_TCM"
+
 """
 
+import sys
+from pathlib import Path
+
 import click
 import pandas as pd
+from gwas_store import gwas_store_inputs
+from gwas_windows import cis_windows
 
 import hailtop.batch as hb
 
 from cpg_utils import to_path
-from cpg_utils.hail_batch import get_batch, image_path, output_path
+from cpg_utils.hail_batch import get_batch, output_path
 
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
 
-def coloc_runner(gwas, eqtl_file_path, celltype, pheno_output_name):
-    import rpy2.robjects as ro
-    from rpy2.robjects import pandas2ri
 
-    from cpg_utils.hail_batch import output_path
+def load_eqtl(eqtl_file_path: str) -> pd.DataFrame:
+    """
+    eQTL summary statistics of a gene (associaTR meta-analysis results), keyed by the coloc SNP ID
+    """
+    import pandas as pd
 
-    ro.r('library(coloc)')
-    ro.r('library(tidyverse)')
-
-    with (ro.default_converter + pandas2ri.converter).context():
-        gwas_r = ro.conversion.get_conversion().py2rpy(gwas)
-    ro.globalenv['gwas_r'] = gwas_r
-    ro.r(
-        '''
-    gwas_r = gwas_r %>% select(beta, varbeta, position,snp)
-    gwas_r = gwas_r %>% filter((beta!=0) | (varbeta!=0))
-    gwas_r = gwas_r %>% distinct(snp, .keep_all = TRUE)
-    gwas_r = gwas_r%>% as.list()
-    gwas_r$type = 'cc'
-
-    ''',
-    )
     eqtl = pd.read_csv(
         eqtl_file_path,
         sep='\t',
@@ -62,45 +67,119 @@ def coloc_runner(gwas, eqtl_file_path, celltype, pheno_output_name):
     eqtl['position'] = eqtl['pos']
     eqtl['snp'] = eqtl['chr'] + '_' + eqtl['position'].astype(str) + '_' + eqtl['motif']
     eqtl['snp'] = eqtl['snp'].str.replace('-', '_', regex=False)
-    gene = eqtl_file_path.split('/')[-1].split('_')[0]
-    with (ro.default_converter + pandas2ri.converter).context():
-        eqtl_r = ro.conversion.get_conversion().py2rpy(eqtl)
-    ro.globalenv['eqtl_r'] = eqtl_r
-    ro.globalenv['gene'] = gene
-    ro.r(
-        '''
-    eqtl_r = eqtl_r %>% filter(!is.na(beta))
-    eqtl_r = eqtl_r %>% distinct(snp, .keep_all = TRUE)
-    eqtl_r$varbeta = eqtl_r$se**2
-    eqtl_r$position = eqtl_r$pos
-    eqtl_r = eqtl_r %>% select(beta, varbeta, position, snp)
-
-    eqtl_r = eqtl_r %>% as.list()
-    eqtl_r$type = 'quant'
-    eqtl_r$sdY = 1
-
-
-    my.res <- coloc.abf(dataset1=gwas_r,
-                    dataset2=eqtl_r)
-
-    p_df <- data.frame(gene,my.res$summary[1], my.res$summary[2], my.res$summary[3], my.res$summary[4], my.res$summary[5], my.res$summary[6])
-    names(p_df) <- c('gene', 'nsnps_coloc_tested','PP.H0.abf','PP.H1.abf','PP.H2.abf','PP.H3.abf','PP.H4.abf')
-    ''',
-    )
+    eqtl = eqtl[eqtl['beta'].notna()].drop_duplicates('snp')
+    eqtl['varbeta'] = eqtl['se'] ** 2
+    return eqtl
+
+
+def coloc_runner(
+    genes: list[tuple],
+    gwas_keys: list[tuple[str, str]],
+    celltype: str,
+    matrix_output_name: str | None,
+    *gwas_inputs,
+    localise_modules,
+):
+    """
+    Run coloc (`coloc_abf.py`) for every eGene of a cell type, against every phenotype.
+
+    Each gene's eQTL statistics are read once, and tested against the cis-window slice of each phenotype's GWAS.
+
+    Args:
+        genes: (gene, chrom, cis-window start, cis-window end, eQTL file) of each eGene
+        gwas_keys: (phenotype output name, chromosome) of the GWAS store files in `gwas_inputs` (chromosomes missing
+            from a phenotype's store are not listed, and their genes are skipped for that phenotype)
+        matrix_output_name: if set, write the results of all genes and phenotypes as one gene x phenotype table
+            (`{matrix_output_name}/{celltype}_coloc_matrix.tsv`), instead of one file per gene and phenotype
+    """
+    import pandas as pd
+
+    from cpg_utils.hail_batch import output_path
+
+    # coloc_abf.py and gwas_store.py, shipped with the job
+    localise_modules()
+    from coloc_abf import PP_COLUMNS, coloc_abf
+    from gwas_store import query_gwas
+
+    gwas_files = dict(zip(gwas_keys, gwas_inputs))
+    phenos = list(dict.fromkeys(pheno for pheno, _ in gwas_keys))
+    results = []
+    for gene, chrom, start, end, eqtl_file_path in genes:
+        eqtl = load_eqtl(eqtl_file_path)
+        for pheno in phenos:
+            if (pheno, chrom) not in gwas_files:
+                print(f'No SNP GWAS store file for {chrom} ({pheno}): skipping {gene}....')
+                continue
+            # extract the SNP GWAS data for the cis-window by region query
+            gwas = query_gwas(gwas_files[(pheno, chrom)]['bgz'], chrom, start, end)
+            gwas = gwas[['beta', 'varbeta', 'position', 'snp']]
+            gwas = gwas[(gwas['beta'] != 0) | (gwas['varbeta'] != 0)]
+            gwas = gwas.drop_duplicates('snp')
+            if gwas.empty:
+                print(f'No SNP GWAS data for {gene} in the cis-window ({pheno}): skipping....')
+                continue
 
-    # convert to pandas df
-    with (ro.default_converter + pandas2ri.converter).context():
-        pd_p4_df = ro.conversion.get_conversion().rpy2py(ro.r('p_df'))
+            result = coloc_abf(gwas, eqtl, type1='cc', type2='quant', sdY2=1)
+            if result is None:
+                print(f'No SNPs shared by the GWAS ({pheno}) and eQTL data for {gene}: skipping....')
+                continue
+            pd_p4_df = pd.DataFrame(
+                {'gene': [gene], 'nsnps_coloc_tested': [result['nsnps']], **{pp: [result[pp]] for pp in PP_COLUMNS}},
+            )
 
-    # add cell type and chrom annotation to df
-    pd_p4_df['celltype'] = celltype
-    pd_p4_df['chrom'] = eqtl['chr'].iloc[0]
+            # add cell type and chrom annotation to df
+            pd_p4_df['celltype'] = celltype
+            pd_p4_df['chrom'] = eqtl['chr'].iloc[0]
 
-    # write to GCS
-    pd_p4_df.to_csv(
-        output_path(f"coloc-snp-only/sig_str_filter_only/{pheno_output_name}/{celltype}/{gene}_100kb.tsv", 'analysis'),
+            if matrix_output_name:
+                pd_p4_df.insert(1, 'phenotype', pheno)
+                results.append(pd_p4_df)
+                continue
+            # write to GCS
+            pd_p4_df.to_csv(
+                output_path(
+                    f"coloc-snp-only/sig_str_filter_only/{pheno}/{celltype}/{gene}_100kb.tsv",
+                    'analysis',
+                ),
+                sep='\t',
+                index=False,
+            )
+
+    if matrix_output_name and results:
+        pd.concat(results, ignore_index=True).to_csv(
+            output_path(
+                f'coloc-snp-only/sig_str_filter_only/{matrix_output_name}/{celltype}_coloc_matrix.tsv',
+                'analysis',
+            ),
+            sep='\t',
+            index=False,
+        )
+
+
+def combine_coloc_matrix(matrix_output_name: str, celltypes: list[str]):
+    """
+    Concatenate the per-cell-type coloc matrices into the gene x phenotype x cell type table,
+    and pivot PP.H4 to one row per gene and cell type and one column per phenotype
+    """
+    import pandas as pd
+
+    from cpg_utils import to_path
+    from cpg_utils.hail_batch import output_path
+
+    matrix_dir = f'coloc-snp-only/sig_str_filter_only/{matrix_output_name}'
+    matrices = []
+    for celltype in celltypes:
+        matrix_path = output_path(f'{matrix_dir}/{celltype}_coloc_matrix.tsv', 'analysis')
+        if to_path(matrix_path).exists():
+            matrices.append(pd.read_csv(matrix_path, sep='\t'))
+    if not matrices:
+        print('No coloc results to combine')
+        return
+    matrix = pd.concat(matrices, ignore_index=True)
+    matrix.to_csv(output_path(f'{matrix_dir}/all_celltypes_coloc_matrix.tsv', 'analysis'), sep='\t', index=False)
+    matrix.pivot_table(index=['gene', 'celltype'], columns='phenotype', values='PP.H4.abf').to_csv(
+        output_path(f'{matrix_dir}/all_celltypes_pp_h4.tsv', 'analysis'),
         sep='\t',
-        index=False,
     )
 
 
@@ -115,16 +194,34 @@ def coloc_runner(gwas, eqtl_file_path, celltype, pheno_output_name):
     default='gs://cpg-bioheart-test/str/associatr/common_variants_snps/tob_n1055_and_bioheart_n990/meta_results/meta_results',
 )
 @click.option(
-    '--snp-gwas-file',
-    help='Path to the SNP GWAS file',
-    default='gs://cpg-bioheart-test/str/gwas_catalog/gcst/gcst-gwas-catalogs/GCST011071_parsed.tsv',
+    '--gwas-store-dir',
+    help='Path to the SNP GWAS store (see gwas_store.py), or comma separated paths (one per phenotype)',
+    default='gs://cpg-bioheart-test/str/gwas_catalog/gcst/gwas-store/GCST011071',
 )
 @click.option('--celltypes', help='Cell types to run', default='ASDC')
 @click.option('--max-parallel-jobs', help='Maximum number of parallel jobs to run', default=500)
-@click.option('--pheno-output-name', help='Phenotype output name', default='covid_GCST011071')
-@click.option('--job-cpu', help='Number of CPUs to use for each job', default=0.25)
+@click.option(
+    '--pheno-output-name',
+    help='Phenotype output name, or comma separated names (in the order of --gwas-store-dir)',
+    default='covid_GCST011071',
+)
+@click.option(
+    '--matrix-output-name',
+    help='Output name of the gene x phenotype x cell type matrix (default: one file per gene, phenotype and cell type)',
+    default=None,
+)
+@click.option('--job-cpu', help='Number of CPUs to use for each job', default=1)
 @click.command()
-def main(snp_cis_dir, egenes_file, celltypes, snp_gwas_file, pheno_output_name, max_parallel_jobs, job_cpu):
+def main(
+    snp_cis_dir,
+    egenes_file,
+    celltypes,
+    gwas_store_dir,
+    pheno_output_name,
+    matrix_output_name,
+    max_parallel_jobs,
+    job_cpu,
+):
     # Setup MAX concurrency by genes
     _dependent_jobs: list[hb.batch.job.Job] = []
 
@@ -136,14 +233,20 @@ def main(snp_cis_dir, egenes_file, celltypes, snp_gwas_file, pheno_output_name,
             job.depends_on(_dependent_jobs[-max_parallel_jobs])
         _dependent_jobs.append(job)
 
+    # GWAS store of each phenotype
+    phenos, store_dirs = pheno_output_name.split(','), gwas_store_dir.split(',')
+    if len(phenos) != len(store_dirs):
+        raise ValueError('--pheno-output-name and --gwas-store-dir must list the same number of phenotypes')
+    if len(set(phenos)) != len(phenos):
+        raise ValueError('--pheno-output-name lists a phenotype more than once')
+    gwas_store_dirs = dict(zip(phenos, store_dirs))
+    if len(gwas_store_dirs) > 1 and not matrix_output_name:
+        print('Several phenotypes given without --matrix-output-name: writing one file per gene and phenotype')
+
     # read in gene annotation file
     var_table = pd.read_csv(
         'gs://cpg-bioheart-test/str/240_libraries_tenk10kp1_v2/concatenated_gene_info_donor_info_var.csv',
     )
-    hg38_map = pd.read_csv(
-        snp_gwas_file,
-        sep='\t',
-    )
 
     # read in eGenes file
     egenes = pd.read_csv(
@@ -164,59 +267,90 @@ def main(snp_cis_dir, egenes_file, celltypes, snp_gwas_file, pheno_output_name,
         '',
         regex=False,
     )  # remove .tsv from gene names (artefact of the data file)
-    b = get_batch(name=f'Run coloc:{pheno_output_name}')
+    # extract the coordinates for the cis-window (gene +/- 100kB) of every eGene at once
+    windows = cis_windows(var_table, result_df_cfm_str['gene'].unique()).set_index('gene')
+
+    b = get_batch(name=f'Run coloc:{matrix_output_name or pheno_output_name}')
+    gwas_inputs: dict[tuple[str, str], hb.ResourceGroup | None] = (
+        {}
+    )  # GWAS store files of each phenotype and chromosome
+    coloc_jobs = []
 
     for celltype in celltypes.split(','):
         result_df_cfm_str_celltype = result_df_cfm_str[
             result_df_cfm_str['celltype'] == celltype
         ]  # filter for the celltype of interest
-        for gene in result_df_cfm_str_celltype['gene']:
-            chrom = result_df_cfm_str_celltype[result_df_cfm_str_celltype['gene'] == gene]['chr'].iloc[0]
-            if to_path(
+        if (
+            matrix_output_name
+            and to_path(
                 output_path(
-                    f"coloc-snp-only/sig_str_filter_only/{pheno_output_name}/{celltype}/{gene}_100kb.tsv",
+                    f'coloc-snp-only/sig_str_filter_only/{matrix_output_name}/{celltype}_coloc_matrix.tsv',
                     'analysis',
                 ),
-            ).exists():
+            ).exists()
+        ):
+            continue
+        genes = []
+        for gene, chrom in zip(result_df_cfm_str_celltype['gene'], result_df_cfm_str_celltype['chr']):
+            if not matrix_output_name and all(
+                to_path(
+                    output_path(
+                        f"coloc-snp-only/sig_str_filter_only/{pheno}/{celltype}/{gene}_100kb.tsv",
+                        'analysis',
+                    ),
+                ).exists()
+                for pheno in gwas_store_dirs
+            ):
+                continue
+            if gene not in windows.index:
                 continue
             if to_path(f'{snp_cis_dir}/{celltype}/{chrom}/{gene}_100000bp_meta_results.tsv').exists():
                 print('Cis results for ' + gene + ' exist: proceed with coloc')
-
-                # extract the coordinates for the cis-window (gene +/- 100kB)
-                gene_table = var_table[var_table['gene_ids'] == gene]
-                start = float(gene_table['start'].astype(float)) - 100000
-                end = float(gene_table['end'].astype(float)) + 100000
-                chrom = gene_table['chr'].iloc[0]
-                hg38_map_chr = hg38_map[hg38_map['chromosome'] == (chrom)]
-                hg38_map_chr_start = hg38_map_chr[hg38_map_chr['position'] >= start]
-                hg38_map_chr_start_end = hg38_map_chr_start[hg38_map_chr_start['position'] <= end]
-                if hg38_map_chr_start_end.empty:
-                    print('No SNP GWAS data for ' + gene + ' in the cis-window: skipping....')
-                    continue
-                # check if the p-value column contains at least one value which is <=5e-8:
-                # if hg38_map_chr_start_end['p_value'].min() > 5e-8:
-                # print('No significant SNP GWAS data for ' + gene + ' in the cis-window: skipping....')
-                # continue
-                # print('Extracted SNP GWAS data for ' + gene)
-
-                # run coloc
-                coloc_job = b.new_python_job(
-                    f'Coloc for {gene}: {celltype}',
-                )
-                f'{snp_cis_dir}/{celltype}/{chrom}/{gene}_100000bp_meta_results.tsv'
-                coloc_job.image(image_path('r-meta'))
-                coloc_job.cpu(job_cpu)
-                coloc_job.call(
-                    coloc_runner,
-                    hg38_map_chr_start_end,
-                    f'{snp_cis_dir}/{celltype}/{chrom}/{gene}_100000bp_meta_results.tsv',
-                    celltype,
-                    pheno_output_name,
+                chrom, start, end = windows.loc[gene, ['chrom', 'start', 'end']]
+                genes.append(
+                    (gene, chrom, start, end, f'{snp_cis_dir}/{celltype}/{chrom}/{gene}_100000bp_meta_results.tsv'),
                 )
-                manage_concurrency_for_job(coloc_job)
-
             else:
                 print('No cis results for ' + gene + ' exist: skipping....')
+        if not genes:
+            continue
+
+        # run coloc for all eGenes of the cell type in one job
+        coloc_job = b.new_python_job(
+            f'Coloc for {celltype}',
+        )
+        coloc_job.cpu(job_cpu)
+        # the job only localises the chromosomes of the GWAS stores it needs, and queries each cis-window
+        chroms = sorted({chrom for _, chrom, _, _, _ in genes})
+        gwas_keys = []
+        for pheno in gwas_store_dirs:
+            for chrom in chroms:
+                if (pheno, chrom) not in gwas_inputs:
+                    store_files = gwas_store_inputs(gwas_store_dirs[pheno], chrom)
+                    # the store has no file for chromosomes without GWAS variants
+                    if all(to_path(path).exists() for path in store_files.values()):
+                        gwas_inputs[(pheno, chrom)] = b.read_input_group(**store_files)
+                    else:
+                        print(f'No SNP GWAS store file for {chrom} ({pheno}): skipping its genes....')
+                        gwas_inputs[(pheno, chrom)] = None
+                if gwas_inputs[(pheno, chrom)] is not None:
+                    gwas_keys.append((pheno, chrom))
+        coloc_job.call(
+            coloc_runner,
+            genes,
+            gwas_keys,
+            celltype,
+            matrix_output_name,
+            *[gwas_inputs[key] for key in gwas_keys],
+            localise_modules=ship_modules(__file__, 'coloc_abf.py', 'gwas_store.py'),
+        )
+        manage_concurrency_for_job(coloc_job)
+        coloc_jobs.append(coloc_job)
+
+    if matrix_output_name:
+        combine_job = b.new_python_job('Combine coloc matrices')
+        combine_job.depends_on(*coloc_jobs)
+        combine_job.call(combine_coloc_matrix, matrix_output_name, celltypes.split(','))
 
     b.run(wait=False)
 
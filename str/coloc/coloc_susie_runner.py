@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+"""
+This script performs SuSiE-coloc (multiple causal variants per trait) between eGenes fine-mapped by SuSiE and GWAS signals.
+Assumes that SuSiE has been run (`str/fine-mapping/susie_runner.py`) both for the eQTLs (`{gene}_fit.npz` per cell type)
+and, in GWAS mode, for the GWAS over each gene's cached LD (`susie_gwas/{pheno}/{chrom}/{gene}_fit.npz`),
+so that no fitting is needed here.
+
+1) Read the log Bayes factors (`lbf_variable`) of the effects with a credible set of the eQTL and GWAS fits of each gene
+2) Run coloc's bf_bf (`coloc_abf.py`) for every pair of effects at once, over the variants shared by both fits.
+   The GWAS is fitted over the SNPs of the GWAS store only, so eQTL variants without GWAS statistics (in particular every
+   STR) are left out of the colocalisation: a warning gives their number and the posterior mass of the eQTL effects on
+   them (a large mass means an STR-driven eQTL signal that SNP-only coloc cannot assess).
+3) Write the results of all eGenes of a cell type (one row per pair of effects) to a TSV file
+
+analysis-runner --dataset "bioheart" \
+    --description "Run SuSiE-coloc for eGenes identified by STR analysis" \
+    --access-level "test" \
+    --image "australia-southeast1-docker.pkg.dev/analysis-runner/images/driver:d4922e3062565ff160ac2ed62dcdf2fba576b75a-hail-8f6797b033d2e102575c40166cf0c977e91f834e" \
+    --output-dir "str/associatr" \
+    coloc_susie_runner.py \
+    --eqtl-susie-dir=gs://cpg-bioheart-test-analysis/str/associatr/fine_mapping/v2/susie \
+    --gwas-susie-dir=gs://cpg-bioheart-test-analysis/str/associatr/fine_mapping/v2/susie_gwas/ibd_liu2023 \
+    --pheno-output-name="ibd_liu2023" \
+    --celltypes "CD4_TCM" \
+    --chromosomes "chr22"
+
+"""
+
+import sys
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+import hailtop.batch as hb
+
+from cpg_utils import to_path
+from cpg_utils.hail_batch import get_batch, output_path
+
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
+
+
+def read_fit_lbf(path: str) -> pd.DataFrame:
+    """
+    Log Bayes factors of the effects with a credible set of a persisted SuSiE fit (see susie_rss.write_fit),
+    one row per effect (numbered from 1, as in susieR) and one column per variant
+    """
+    import pandas as pd
+
+    from cpg_utils import to_path
+
+    with to_path(path).open('rb') as f, np.load(f) as npz:
+        # fits persisted without their credible sets fall back to all effects with a non-zero prior variance
+        effects = npz['cs_index'] if 'cs_index' in npz.files else np.flatnonzero(npz['V'] > 1e-9)
+        return pd.DataFrame(npz['lbf_variable'][effects], index=effects + 1, columns=npz['varid'])
+
+
+def warn_dropped_variants(gene: str, eqtl_lbf: pd.DataFrame, gwas_lbf: pd.DataFrame):
+    """
+    Warn about the eQTL variants missing from the GWAS fit (eg STRs), which coloc's bf_bf leaves out, with the largest
+    posterior mass (over the eQTL effects) on them
+    """
+    import logging
+
+    import numpy as np
+
+    dropped = ~eqtl_lbf.columns.isin(gwas_lbf.columns)
+    if not dropped.any() or eqtl_lbf.empty:
+        return
+    # STR variant IDs ('chr:pos_motif') have no '-', unlike SNPs ('chr:pos_ref-alt')
+    n_str = sum('-' not in varid for varid in eqtl_lbf.columns[dropped])
+    lbf = eqtl_lbf.to_numpy(dtype=float)
+    alpha = np.exp(lbf - lbf.max(axis=1, keepdims=True))
+    alpha /= alpha.sum(axis=1, keepdims=True)
+    logging.warning(
+        f'{gene}: {dropped.sum()} eQTL variants ({n_str} STRs) are not in the GWAS fit and are left out of coloc '
+        f'(up to {alpha[:, dropped].sum(axis=1).max():.1%} of the posterior of an eQTL effect)',
+    )
+
+
+def coloc_susie_runner(
+    genes: list[tuple[str, str]],
+    eqtl_susie_dir: str,
+    gwas_susie_dir: str,
+    celltype: str,
+    *,
+    localise_modules,
+) -> str:
+    """
+    Run SuSiE-coloc for every eGene of a cell type, returning the results as TSV (header only if no eGene has results)
+
+    Args:
+        genes: (gene, chrom) of each eGene with both an eQTL and a GWAS fit
+    """
+    import pandas as pd
+
+    # coloc_abf.py, shipped with the job
+    localise_modules()
+    from coloc_abf import PP_COLUMNS, coloc_bf_bf
+
+    results = []
+    for gene, chrom in genes:
+        gwas_lbf = read_fit_lbf(f'{gwas_susie_dir}/{chrom}/{gene}_fit.npz')
+        eqtl_lbf = read_fit_lbf(f'{eqtl_susie_dir}/{celltype}/{chrom}/{gene}_fit.npz')
+        warn_dropped_variants(gene, eqtl_lbf, gwas_lbf)
+        # dataset 1 is the GWAS, dataset 2 the eQTLs (as in coloc_runner.py)
+        gene_results = coloc_bf_bf(gwas_lbf, eqtl_lbf)
+        if gene_results.empty:
+            print(f'No credible sets (or shared variants) in the GWAS and eQTL fits for {gene}: skipping....')
+            continue
+        gene_results.insert(0, 'gene', gene)
+        # add cell type and chrom annotation to df
+        gene_results['celltype'] = celltype
+        gene_results['chrom'] = chrom
+        results.append(gene_results)
+    if not results:
+        # header-only table, so that the cell type's output reads as a table without colocalisations
+        columns = ['gene', 'nsnps', 'hit1', 'hit2', *PP_COLUMNS, 'idx1', 'idx2', 'celltype', 'chrom']
+        return pd.DataFrame(columns=columns).to_csv(sep='\t', index=False)
+    return pd.concat(results, ignore_index=True).to_csv(sep='\t', index=False)
+
+
+@click.option('--eqtl-susie-dir', help='Directory of the eQTL SuSiE fits (susie_runner.py output, {celltype}/{chrom})')
+@click.option(
+    '--gwas-susie-dir',
+    help='Directory of the GWAS SuSiE fits of a phenotype (susie_runner.py GWAS mode output, {chrom})',
+)
+@click.option('--pheno-output-name', help='Phenotype output name', default='covid_GCST011071')
+@click.option('--celltypes', help='Cell types comma separated', default='ASDC')
+@click.option('--chromosomes', help='Chromosomes comma separated')
+@click.option('--max-parallel-jobs', help='Maximum number of parallel jobs to run', default=500)
+@click.option('--job-cpu', help='Number of CPUs to use for each job', default=1)
+@click.command()
+def main(eqtl_susie_dir, gwas_susie_dir, pheno_output_name, celltypes, chromosomes, max_parallel_jobs, job_cpu):
+    # Setup MAX concurrency by genes
+    _dependent_jobs: list[hb.batch.job.Job] = []
+
+    def manage_concurrency_for_job(job: hb.batch.job.Job):
+        """
+        To avoid having too many jobs running at once, we have to limit concurrency.
+        """
+        if len(_dependent_jobs) >= max_parallel_jobs:
+            job.depends_on(_dependent_jobs[-max_parallel_jobs])
+        _dependent_jobs.append(job)
+
+    # genes with a GWAS fit, on each chromosome
+    gwas_genes = {
+        chrom: {path.name.removesuffix('_fit.npz') for path in to_path(f'{gwas_susie_dir}/{chrom}').glob('*_fit.npz')}
+        for chrom in chromosomes.split(',')
+    }
+
+    b = get_batch(name=f'Run SuSiE-coloc:{pheno_output_name}')
+    for celltype in celltypes.split(','):
+        write_path = output_path(f'coloc-susie/{pheno_output_name}/{celltype}_coloc_susie.tsv', 'analysis')
+        if to_path(write_path).exists():
+            continue
+        genes = []
+        for chrom in chromosomes.split(','):
+            for path in to_path(f'{eqtl_susie_dir}/{celltype}/{chrom}').glob('*_fit.npz'):
+                gene = path.name.removesuffix('_fit.npz')
+                if gene in gwas_genes[chrom]:
+                    genes.append((gene, chrom))
+        if not genes:
+            print(f'No eGenes with both eQTL and GWAS fits for {celltype}: skipping....')
+            continue
+
+        # run SuSiE-coloc for all eGenes of the cell type in one job
+        coloc_job = b.new_python_job(f'SuSiE-coloc for {celltype}')
+        coloc_job.cpu(job_cpu)
+        result = coloc_job.call(
+            coloc_susie_runner,
+            genes,
+            eqtl_susie_dir,
+            gwas_susie_dir,
+            celltype,
+            localise_modules=ship_modules(__file__, 'coloc_abf.py'),
+        )
+        b.write_output(result.as_str(), write_path)
+        manage_concurrency_for_job(coloc_job)
+
+    b.run(wait=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,7 @@ import gzip
 
 import click
 import pandas as pd
+from gwas_windows import cis_windows, window_bounds, window_stats
 
 import hailtop.batch as hb
 
@@ -170,6 +171,14 @@ def main(snp_cis_dir, egenes_file, celltypes, pheno_output_name, max_parallel_jo
 
             with gzip.open(to_path(chr_gwas_file), 'rb') as f:
                 hg38_map = pd.read_csv(f, sep='\t')
+            hg38_map_chr = hg38_map[hg38_map['chromosome'] == (chrom)].sort_values('position', kind='stable')
+
+            # variant counts and minimum p-value of the cis-window (gene +/- 100kB) of every gene at once
+            chrom_windows = cis_windows(var_table, result_df_cfm_str_celltype_chrom['gene']).set_index('gene')
+            lo, hi = window_bounds(hg38_map_chr['position'].to_numpy(), chrom_windows['start'], chrom_windows['end'])
+            n_variants, min_p = window_stats(hg38_map_chr['p_value'].to_numpy(), lo, hi)
+            chrom_windows['lo'], chrom_windows['hi'] = lo, hi
+            chrom_windows['n_variants'], chrom_windows['min_p_value'] = n_variants, min_p
 
             for gene in result_df_cfm_str_celltype_chrom['gene']:
                 if to_path(
@@ -179,23 +188,20 @@ def main(snp_cis_dir, egenes_file, celltypes, pheno_output_name, max_parallel_jo
                     ),
                 ).exists():
                     continue
+                if gene not in chrom_windows.index:
+                    continue
                 if to_path(f'{snp_cis_dir}/{celltype}/{chrom}/{gene}_100000bp_meta_results.tsv').exists():
                     print('Cis results for ' + gene + ' exist: proceed with coloc')
 
-                    # extract the coordinates for the cis-window (gene +/- 100kB)
-                    gene_table = var_table[var_table['gene_ids'] == gene]
-                    start = float(gene_table['start'].astype(float)) - 100000
-                    end = float(gene_table['end'].astype(float)) + 100000
-                    hg38_map_chr = hg38_map[hg38_map['chromosome'] == (chrom)]
-                    hg38_map_chr_start = hg38_map_chr[hg38_map_chr['position'] >= start]
-                    hg38_map_chr_start_end = hg38_map_chr_start[hg38_map_chr_start['position'] <= end]
-                    if hg38_map_chr_start_end.empty:
+                    gene_window = chrom_windows.loc[gene]
+                    if gene_window['n_variants'] == 0:
                         print('No GWAS data for ' + gene + ' in the cis-window: skipping....')
                         continue
                     # check if the p-value column contains at least one value which is <=5e-8:
-                    if hg38_map_chr_start_end['p_value'].min() > 5e-8:
+                    if not gene_window['min_p_value'] <= 5e-8:
                         print('No significant SNP STR GWAS data for ' + gene + ' in the cis-window: skipping....')
                         continue
+                    hg38_map_chr_start_end = hg38_map_chr.iloc[int(gene_window['lo']) : int(gene_window['hi'])]
                     print('Extracted GWAS data for ' + gene)
 
                     # run coloc
@@ -2,6 +2,8 @@
 
 """
 This script outputs a list of genes that have at least one SNP with pval <5e-8 in the GWAS catalog.
+The GWAS catalog is read from a GWAS store (`gwas_store.py`), one chromosome at a time, and all cis-windows of the
+chromosome are scanned at once (`gwas_windows.py`).
 
 analysis-runner --dataset "bioheart" \
     --description "identify genomewide sig genes" \
@@ -10,12 +12,16 @@ analysis-runner --dataset "bioheart" \
     --image "australia-southeast1-docker.pkg.dev/analysis-runner/images/driver:d4922e3062565ff160ac2ed62dcdf2fba576b75a-hail-8f6797b033d2e102575c40166cf0c977e91f834e" \
     --output-dir "str/associatr" \
     gwas_hit_genes.py \
-    --snp-gwas-file=gs://cpg-bioheart-test/str/gwas_catalog/gcst/gcst-gwas-catalogs/GCST90027158.h_parsed.tsv \
+    --gwas-store-dir=gs://cpg-bioheart-test/str/gwas_catalog/gcst/gwas-store/GCST90027158.h \
     --pheno-output-name="alzheimer_GCST90027158"
 
 """
+import tempfile
+
 import click
 import pandas as pd
+from gwas_store import localise_gwas_store, read_gwas_chromosome
+from gwas_windows import cis_windows, window_bounds, window_stats
 
 
 @click.option(
@@ -24,22 +30,17 @@ import pandas as pd
     default='gs://cpg-bioheart-test-analysis/str/associatr/fine_mapping/susie_finemap/all_cell_types_all_genes_sig_only.tsv',
 )
 @click.option(
-    '--snp-gwas-file',
-    help='Path to the SNP GWAS file',
-    default='gs://cpg-bioheart-test/str/gwas_catalog/gcst/gcst-gwas-catalogs/GCST011071_parsed.tsv',
+    '--gwas-store-dir',
+    help='Path to the SNP GWAS store (see gwas_store.py)',
+    default='gs://cpg-bioheart-test/str/gwas_catalog/gcst/gwas-store/GCST011071',
 )
 @click.option('--pheno-output-name', help='Phenotype output name', default='covid_GCST011071')
 @click.command()
-def main(egenes_file, snp_gwas_file, pheno_output_name):
-    gwas_sig_genes = []
+def main(egenes_file, gwas_store_dir, pheno_output_name):
     # read in gene annotation file
     var_table = pd.read_csv(
         'gs://cpg-bioheart-test/str/240_libraries_tenk10kp1_v2/concatenated_gene_info_donor_info_var.csv',
     )
-    hg38_map = pd.read_csv(
-        snp_gwas_file,
-        sep='\t',
-    )
 
     # read in eGenes file
     egenes = pd.read_csv(
@@ -61,25 +62,25 @@ def main(egenes_file, snp_gwas_file, pheno_output_name):
         regex=False,
     )  # remove .tsv from gene names (artefact of the data file)
 
-    for gene in result_df_cfm_str['gene']:
-        chrom = result_df_cfm_str[result_df_cfm_str['gene'] == gene]['chr'].iloc[0]
+    # extract the coordinates for the cis-window (gene +/- 100kB)
+    windows = cis_windows(var_table, result_df_cfm_str['gene'])
+    windows['min_p_value'] = float('nan')
 
-        # extract the coordinates for the cis-window (gene +/- 100kB)
-        gene_table = var_table[var_table['gene_ids'] == gene]
-        start = float(gene_table['start'].astype(float)) - 100000
-        end = float(gene_table['end'].astype(float)) + 100000
-        chrom = gene_table['chr'].iloc[0]
-        hg38_map_chr = hg38_map[hg38_map['chromosome'] == (chrom)]
-        hg38_map_chr_start = hg38_map_chr[hg38_map_chr['position'] >= start]
-        hg38_map_chr_start_end = hg38_map_chr_start[hg38_map_chr_start['position'] <= end]
-        if hg38_map_chr_start_end.empty:
-            print('No SNP GWAS data for ' + gene + ' in the cis-window: skipping....')
+    local_dir = tempfile.mkdtemp()
+    for chrom, chrom_windows in windows.groupby('chrom', sort=False):
+        gwas_file = localise_gwas_store(gwas_store_dir, chrom, local_dir)
+        if gwas_file is None:
+            print(f'No SNP GWAS data for {len(chrom_windows)} genes on {chrom}: skipping....')
             continue
-        # check if the p-value column contains at least one value which is <=5e-8:
-        if hg38_map_chr_start_end['p_value'].min() > 5e-8:
-            print('No significant SNP GWAS data for ' + gene + ' in the cis-window: skipping....')
-            continue
-        gwas_sig_genes.append(gene)
+        gwas = read_gwas_chromosome(gwas_file, columns=['position', 'p_value'])
+        lo, hi = window_bounds(gwas['position'].to_numpy(), chrom_windows['start'], chrom_windows['end'])
+        n_variants, min_p = window_stats(gwas['p_value'].to_numpy(), lo, hi)
+        for gene in chrom_windows['gene'][n_variants == 0]:
+            print('No SNP GWAS data for ' + gene + ' in the cis-window: skipping....')
+        windows.loc[chrom_windows.index, 'min_p_value'] = min_p
+
+    # genes with at least one SNP with p-value <=5e-8 in the cis-window
+    gwas_sig_genes = windows.loc[windows['min_p_value'] <= 5e-8, 'gene'].tolist()
 
     # write list to a csv file
     output_file = (
@@ -11,6 +11,12 @@ Workflow:
 3) Select the lead SNP from 2) (ie SNP with the lowest p-value)
 4) Calculate pairwise correlation of the lead eSTR locus with the lead SNP.
 
+Steps 1-3 collect the (lead SNP, eSTR) pairs of all phenotypes (`--phenotype` and `--gwas-file` comma separated, in
+the same order) and cell types once, reading each GWAS catalog and the gene annotation file once.
+Step 4 runs one job per chromosome, which reads the genotypes of all its lead SNPs and eSTRs in one sorted sweep of
+each VCF and correlates every pair at once. The results are combined into one table across phenotypes and cell types
+(`gwas_ld/{output-name}/all_gwas_ld_results.csv`).
+
 analysis-runner --dataset "bioheart" \
     --description "Calculate LD between STR and SNPs" \
     --access-level "full" \
@@ -25,15 +31,23 @@ analysis-runner --dataset "bioheart" \
 """
 
 import ast
+import sys
+from pathlib import Path
 
 import click
+import numpy as np
 import pandas as pd
+from gwas_windows import cis_windows, window_bounds
 
 import hailtop.batch as hb
 
 from cpg_utils.config import output_path
 from cpg_utils.hail_batch import get_batch
 
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
+
 
 # Function to process each element in the 'chr' column
 def process_chr_element(element):
@@ -49,136 +63,112 @@ def process_chr_element(element):
         return None
 
 
-def ld_parser(
-    snp_vcf_path,
-    str_vcf_path,
-    phenotype,
-    celltype,
-    gene_annotation_file,
-    str_fdr_dir,
-    gwas_file,
-    chromosome,
-):
-    from cyvcf2 import VCF
-
-    from cpg_utils import to_path
-
-    # read in gwas catalog file
-    gwas_catalog_orig = pd.read_csv(gwas_file)
-    # read in gene_annotation_table
+def collect_ld_pairs(
+    gwas_files: dict[str, str],
+    celltypes: list[str],
+    gene_annotation_file: str,
+    str_fdr_dir: str,
+    chromosomes: list[str],
+) -> pd.DataFrame:
+    """
+    (lead SNP, eSTR) pairs of every phenotype, cell type and eGene on the chromosomes
+
+    Returns:
+        one row per pair: phenotype, celltype, gene, chromosome, snp_pos, str_pos
+    """
     gene_annotation_table = pd.read_csv(gene_annotation_file)
-    # load in the str fdr file
-    str_fdr_file = f'{str_fdr_dir}/{celltype}_qval.tsv'
-    str_fdr = pd.read_csv(str_fdr_file, sep='\t')
-    str_fdr = str_fdr[str_fdr['qval'] < 0.05]  # subset to eGenes passing FDR 5% threshold
-
-    # Apply the function to the 'chr' column and create a new 'chrom' column
-    str_fdr['chrom_num'] = str_fdr['chr'].apply(process_chr_element)
-    str_fdr = str_fdr[str_fdr['chrom_num'] == str(chromosome)]  # subset to the chromosome
-
-    for gene in str_fdr['gene_name']:
-        print(f'Processing gene: {gene}')
-
-        # obtain snp cis-window coordinates for the gene
-        gene_table = gene_annotation_table[gene_annotation_table['gene_ids'] == gene]  # subset to particular ENSG ID
-        start_snp_window = float(gene_table['start'].iloc[0]) - 100000  # +-100kB window around gene
-        end_snp_window = float(gene_table['end'].iloc[0]) + 100000
-        chrom = gene_table['chr'].iloc[0][3:]
-        print('Obtained SNP window coordinates')
-
-        # subset the gwas catalog to the snp_window
-        gwas_catalog = gwas_catalog_orig[gwas_catalog_orig['CHR'] == int(chrom)]
-        gwas_catalog = gwas_catalog[gwas_catalog['BP'] >= start_snp_window]
-        gwas_catalog = gwas_catalog[gwas_catalog['BP'] <= end_snp_window]
-
-        if gwas_catalog.empty:
-            print('No SNP GWAS data for ' + gene + ' in the cis-window: skipping....')
-            continue
-
-        # obtain lead SNP (lowest p-value) in the snp_window of the GWAS
-        lowest_p_row = gwas_catalog.loc[gwas_catalog['P'].idxmin()]
-        lead_snp_chr = lowest_p_row['CHR']
-        lead_snp_bp = lowest_p_row['BP']
-        lead_snp_end = lowest_p_row['BP'] + 1
-        lead_snp_locus = f'{lead_snp_chr}:{lead_snp_bp}-{lead_snp_end}'
-
-        # obtain top STR locus for the gene (if multiple are tied - iterate over each)
-        str_fdr_gene = str_fdr[str_fdr['gene_name'] == gene]
-        for estr in zip(
-            ast.literal_eval(str_fdr_gene['chr'].iloc[0]),
-            ast.literal_eval(str_fdr_gene['pos'].iloc[0]),
-        ):
-            chr_num = estr[0][3:]
-            pos = estr[1]
-            end = str(int(pos) + 1)
-            str_locus = f'{chr_num}:{pos}-{end}'
-            write_path = output_path(
-                f'gwas_ld/{phenotype}/{celltype}/{gene}_chr{chr_num}_{pos}_gwas_ld_results.csv',
-                'analysis',
-            )
-
-            if to_path(write_path).exists():
-                print(f'GWAS LD for {gene} and {str_locus} already exists. Skipping...')
-                continue
-
-            print(f'Running LD for {gene} and {str_locus}')
-
-            # create empty DF to store the relevant GTs (SNPs)
-            df = pd.DataFrame(columns=['individual'])
-
-            # cyVCF2 reads the SNP VCF
-            vcf = VCF(snp_vcf_path['vcf'])
-            df['individual'] = vcf.samples
-            print('Reading SNP VCF with VCF()')
 
-            print(f'Starting to subset VCF for the lead SNP {lead_snp_locus}')
-            snp_in_vcf_flag = 0
-            for variant in vcf(lead_snp_locus):
-                geno = variant.gt_types  # extracts GTs as a numpy array
-                locus = variant.CHROM + ':' + str(variant.POS)
-                df_to_append = pd.DataFrame(geno, columns=[locus])  # creates a temp df to store the GTs for one locus
-                snp_in_vcf_flag = 1
-                break  # take the first SNP locus
-
-            if snp_in_vcf_flag == 0:
-                print(f'No GTs for SNP {lead_snp_locus} in the VCF, skipping...')
-                continue
-
-            # concatenate results to the main df
-            df = pd.concat([df, df_to_append], axis=1)
-            print("Finished subsetting VCF for lead SNP")
-
-            # extract GTs for the one STR
-            str_vcf = VCF(str_vcf_path['vcf'])
-            for variant in str_vcf(str_locus):
-                print(f'Captured STR with POS:{variant.POS}')
-                ds = variant.format('DS')
-                ds_list = []
-                for i in range(len(ds)):
-                    ds_list.append(ds[i][0])
-                target_data = {'individual': str_vcf.samples, str_locus: ds_list}
-                target_df = pd.DataFrame(target_data)
-                break  # take the first STR locus
-
-            # merge the two dataframes
-            merged_df = df.merge(target_df, on='individual')
-
-            # calculate pairwise correlation of every SNP locus with target STR locus
-            correlation_series = merged_df.drop(columns='individual').corrwith(merged_df[str_locus])
-
-            correlation_df = pd.DataFrame(correlation_series, columns=['correlation'])
-            correlation_df['locus'] = correlation_df.index
-
-            # drop the STR locus from the list of SNPs (it will automatically have a correlation of 1)
-            correlation_df = correlation_df[correlation_df['locus'] != str_locus]
-
-            # add some attributes
-            correlation_df['gene'] = gene
-            correlation_df['str_locus'] = str_locus
-            correlation_df['celltype'] = celltype
+    # eSTRs (if multiple are tied - one row each) of the eGenes of each cell type
+    estrs = []
+    for celltype in celltypes:
+        # load in the str fdr file
+        str_fdr_file = f'{str_fdr_dir}/{celltype}_qval.tsv'
+        str_fdr = pd.read_csv(str_fdr_file, sep='\t')
+        str_fdr = str_fdr[str_fdr['qval'] < 0.05]  # subset to eGenes passing FDR 5% threshold
+
+        # Apply the function to the 'chr' column and create a new 'chrom' column
+        str_fdr['chrom_num'] = str_fdr['chr'].apply(process_chr_element)
+        str_fdr = str_fdr[str_fdr['chrom_num'].isin(chromosomes)]  # subset to the chromosomes
+        for gene, chr_list, pos_list in zip(str_fdr['gene_name'], str_fdr['chr'], str_fdr['pos']):
+            for estr_chr, pos in zip(ast.literal_eval(chr_list), ast.literal_eval(pos_list)):
+                estrs.append((celltype, gene, estr_chr[3:], int(pos)))
+    estrs_df = pd.DataFrame(estrs, columns=['celltype', 'gene', 'chromosome', 'str_pos'])
+
+    # obtain snp cis-window coordinates for every gene
+    windows = cis_windows(gene_annotation_table, estrs_df['gene'].unique())
+    windows['chromosome'] = windows['chrom'].str[3:]
+
+    pairs = []
+    for phenotype, gwas_file in gwas_files.items():
+        # read in gwas catalog file
+        gwas_catalog = pd.read_csv(gwas_file)
+        for chrom, chrom_windows in windows.groupby('chromosome', sort=False):
+            gwas_chrom = gwas_catalog[gwas_catalog['CHR'] == int(chrom)].sort_values('BP', kind='stable')
+            # obtain lead SNP (lowest p-value) in the snp_window of the GWAS
+            lo, hi = window_bounds(gwas_chrom['BP'].to_numpy(), chrom_windows['start'], chrom_windows['end'])
+            p_values = gwas_chrom['P'].to_numpy()
+            for gene, start, end in zip(chrom_windows['gene'], lo, hi):
+                if start == end or np.isnan(p_values[start:end]).all():
+                    print(f'No SNP GWAS data for {gene} in the cis-window ({phenotype}): skipping....')
+                    continue
+                pairs.append((phenotype, gene, gwas_chrom['BP'].iloc[start + np.nanargmin(p_values[start:end])]))
+    lead_snps = pd.DataFrame(pairs, columns=['phenotype', 'gene', 'snp_pos'])
+    return lead_snps.merge(estrs_df, on='gene')[['phenotype', 'celltype', 'gene', 'chromosome', 'snp_pos', 'str_pos']]
+
+
+def ld_parser(snp_vcf_path, str_vcf_path, pairs: pd.DataFrame, chromosome: str, *, localise_modules) -> str:
+    """
+    Correlation of every (lead SNP, eSTR) pair of a chromosome, returned as CSV
+    """
+    import numpy as np
+    from cyvcf2 import VCF
 
-            # write to output_path
-            correlation_df.to_csv(write_path, index=False)
+    # ld_utils.py, shipped with the job
+    localise_modules()
+    from ld_utils import correlate_rows, read_variants_at, shared_samples
+
+    # cyVCF2 reads both VCFs once, in position order
+    snp_vcf = VCF(snp_vcf_path['vcf'])
+    str_vcf = VCF(str_vcf_path['vcf'])
+    snp_positions = np.unique(pairs['snp_pos'].to_numpy())
+    str_positions = np.unique(pairs['str_pos'].to_numpy())
+    snp_genotypes, snp_found = read_variants_at(snp_vcf, chromosome, snp_positions, lambda variant: variant.gt_types)
+    str_dosages, str_found = read_variants_at(
+        str_vcf,
+        chromosome,
+        str_positions,
+        lambda variant: variant.format('DS')[:, 0],
+    )
+    print(f'Captured {snp_found.sum()}/{len(snp_positions)} SNPs and {str_found.sum()}/{len(str_positions)} STRs')
+
+    snp_rows = np.searchsorted(snp_positions, pairs['snp_pos'].to_numpy())
+    str_rows = np.searchsorted(str_positions, pairs['str_pos'].to_numpy())
+    found = snp_found[snp_rows] & str_found[str_rows]
+    if not found.all():
+        print(f'No GTs for {(~found).sum()} (lead SNP, eSTR) pairs in the VCFs, skipping...')
+    pairs = pairs[found].copy()
+
+    # calculate pairwise correlation of every lead SNP with its eSTR (samples in both VCFs)
+    snp_cols, str_cols = shared_samples(snp_vcf.samples, str_vcf.samples)
+    pairs['correlation'] = correlate_rows(
+        snp_genotypes[snp_rows[found]][:, snp_cols],
+        str_dosages[str_rows[found]][:, str_cols],
+    )
+    pairs['r2'] = pairs['correlation'] ** 2
+    pairs['locus'] = chromosome + ':' + pairs['snp_pos'].astype(str)
+    pairs['str_locus'] = chromosome + ':' + pairs['str_pos'].astype(str) + '-' + (pairs['str_pos'] + 1).astype(str)
+    return pairs[['phenotype', 'celltype', 'gene', 'locus', 'str_locus', 'correlation', 'r2']].to_csv(index=False)
+
+
+def combine_ld_results(*results: str) -> str:
+    """
+    Concatenate the per-chromosome results (CSV) into one table
+    """
+    import io
+
+    import pandas as pd
+
+    return pd.concat([pd.read_csv(io.StringIO(result)) for result in results], ignore_index=True).to_csv(index=False)
 
 
 @click.option(
@@ -191,7 +181,7 @@ def ld_parser(
     help='GCS file dir to STR VCF files.',
     type=str,
 )
-@click.option('--phenotype', help='Phenotype to use for coloc', type=str)
+@click.option('--phenotype', help='Phenotypes comma separated (in the order of --gwas-file)', type=str)
 @click.option('--celltypes', help='Cell types to use for coloc', type=str)
 @click.option(
     '--gene-annotation-file',
@@ -205,8 +195,9 @@ def ld_parser(
 )
 @click.option(
     '--gwas-file',
-    help='Path to GWAS catalog (ensure only three columns CHR, BP, and P)',
+    help='Paths to GWAS catalogs comma separated (ensure only three columns CHR, BP, and P)',
 )
+@click.option('--output-name', help='Output name of the combined table (default: the phenotypes)', default=None)
 @click.option(
     '--chromosomes',
     default='1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22',
@@ -227,6 +218,7 @@ def main(
     gwas_file: str,
     chromosomes: str,
     max_parallel_jobs: int,
+    output_name: str | None,
 ):
     # Setup MAX concurrency by genes
     _dependent_jobs: list[hb.batch.job.Job] = []
@@ -239,35 +231,57 @@ def main(
             job.depends_on(_dependent_jobs[-max_parallel_jobs])
         _dependent_jobs.append(job)
 
-    b = get_batch(name='GWAS LD runner')
+    phenotypes, gwas_file_paths = phenotype.split(','), gwas_file.split(',')
+    if len(phenotypes) != len(gwas_file_paths):
+        raise ValueError('--phenotype and --gwas-file must list the same number of phenotypes')
+    if len(set(phenotypes)) != len(phenotypes):
+        raise ValueError('--phenotype lists a phenotype more than once')
+    gwas_files = dict(zip(phenotypes, gwas_file_paths))
+    pairs = collect_ld_pairs(
+        gwas_files,
+        celltypes.split(','),
+        gene_annotation_file,
+        str_fdr_dir,
+        chromosomes.split(','),
+    )
 
-    for celltype in celltypes.split(','):
-        for chr_string in chromosomes.split(','):
-            chromosome = int(chr_string)
-            ld_job = b.new_python_job(
-                f'LD calc for chr{chromosome}; {celltype}',
-            )
-            ld_job.cpu(job_cpu)
-            ld_job.storage(job_storage)
+    b = get_batch(name='GWAS LD runner')
+    results = []
+    for chromosome, chrom_pairs in pairs.groupby('chromosome', sort=False):
+        ld_job = b.new_python_job(
+            f'LD calc for chr{chromosome}: {len(chrom_pairs)} pairs',
+        )
+        ld_job.cpu(job_cpu)
+        ld_job.storage(job_storage)
 
-            snp_vcf_path = f'{snp_vcf_dir}/chr{chromosome}_common_variants.vcf.bgz'
-            str_vcf_path = f'{str_vcf_dir}/hail_filtered_chr{chromosome}.vcf.bgz'
+        snp_vcf_path = f'{snp_vcf_dir}/chr{chromosome}_common_variants.vcf.bgz'
+        str_vcf_path = f'{str_vcf_dir}/hail_filtered_chr{chromosome}.vcf.bgz'
 
-            snp_input = get_batch().read_input_group(**{'vcf': snp_vcf_path, 'csi': snp_vcf_path + '.csi'})
-            str_input = get_batch().read_input_group(**{'vcf': str_vcf_path, 'csi': str_vcf_path + '.csi'})
+        snp_input = get_batch().read_input_group(**{'vcf': snp_vcf_path, 'csi': snp_vcf_path + '.csi'})
+        str_input = get_batch().read_input_group(**{'vcf': str_vcf_path, 'csi': str_vcf_path + '.csi'})
 
+        results.append(
             ld_job.call(
                 ld_parser,
                 snp_input,
                 str_input,
-                phenotype,
-                celltype,
-                gene_annotation_file,
-                str_fdr_dir,
-                gwas_file,
+                chrom_pairs,
                 chromosome,
-            )
-            manage_concurrency_for_job(ld_job)
+                localise_modules=ship_modules(__file__, 'ld_utils.py'),
+            ),
+        )
+        manage_concurrency_for_job(ld_job)
+
+    if results:
+        combine_job = b.new_python_job('Combine LD results')
+        combined = combine_job.call(combine_ld_results, *results)
+        b.write_output(
+            combined.as_str(),
+            output_path(
+                f'gwas_ld/{output_name or phenotype.replace(",", "_")}/all_gwas_ld_results.csv',
+                'analysis',
+            ),
+        )
 
     b.run(wait=False)
 
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+GWAS summary-statistics store: a one-time ingest that normalises a parsed GWAS file into position-sorted,
+bgzipped and tabix-indexed files per chromosome, so that coloc/LD jobs only fetch their own cis-window by region query.
+
+Store layout (`--store-dir`): `{chromosome}.tsv.bgz` (+ `.tbi`), with columns 'chromosome', 'position' (hg38 bp),
+'snp', 'beta', 'varbeta', 'p_value' (the header line starts with '#').
+
+Ingest:
+
+analysis-runner --dataset "bioheart" \
+    --description "Ingest GWAS summary statistics into a tabix-indexed store" \
+    --access-level "test" \
+    --image "australia-southeast1-docker.pkg.dev/analysis-runner/images/driver:d4922e3062565ff160ac2ed62dcdf2fba576b75a-hail-8f6797b033d2e102575c40166cf0c977e91f834e" \
+    --output-dir "str/associatr" \
+    gwas_store.py \
+    --snp-gwas-file=gs://cpg-bioheart-test/str/gwas_catalog/gcst/gcst-gwas-catalogs/GCST011071_parsed.tsv \
+    --store-dir=gs://cpg-bioheart-test/str/gwas_catalog/gcst/gwas-store/GCST011071
+
+Querying (eg in a job, after localising a chromosome with `read_input_group(**gwas_store_inputs(store_dir, chrom))`,
+or with `localise_gwas_store` outside of a job):
+
+    gwas = query_gwas(gwas_input['bgz'], chrom, start, end)
+"""
+
+import click
+import pandas as pd
+
+from cpg_utils import to_path
+from cpg_utils.hail_batch import get_batch
+
+GWAS_COLUMNS = ['chromosome', 'position', 'snp', 'beta', 'varbeta', 'p_value']
+
+
+def gwas_store_path(store_dir: str, chrom: str) -> str:
+    """
+    Path to the bgzipped file of a chromosome in the store
+    """
+    return f'{store_dir}/{chrom}.tsv.bgz'
+
+
+def gwas_store_inputs(store_dir: str, chrom: str) -> dict[str, str]:
+    """
+    Files of a chromosome in the store, as keyword arguments for `read_input_group`
+    """
+    return {'bgz': gwas_store_path(store_dir, chrom), 'tbi': gwas_store_path(store_dir, chrom) + '.tbi'}
+
+
+def localise_gwas_store(store_dir: str, chrom: str, local_dir: str) -> str | None:
+    """
+    Copy the files of a chromosome in the store to `local_dir` (for querying outside of a job),
+    returning the local bgzipped file (None if the store has no variants on that chromosome)
+    """
+    import shutil
+
+    local_path = None
+    for key, path in gwas_store_inputs(store_dir, chrom).items():
+        if not to_path(path).exists():
+            return None
+        local_file = f'{local_dir}/{path.split("/")[-1]}'
+        with to_path(path).open('rb') as src, open(local_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        if key == 'bgz':
+            local_path = local_file
+    return local_path
+
+
+def write_store_chromosome(gwas_chrom: pd.DataFrame, chrom: str, store_dir: str, local_dir: str):
+    """
+    Write the variants of one chromosome (with GWAS_COLUMNS) to the store: position-sorted, bgzipped and tabix-indexed
+    """
+    import os
+    import shutil
+
+    import pysam
+
+    local_path = f'{local_dir}/{chrom}.tsv'
+    gwas_chrom = gwas_chrom.sort_values('position', kind='stable')
+    with open(local_path, 'w') as f:
+        f.write('#' + '\t'.join(GWAS_COLUMNS) + '\n')
+        gwas_chrom[GWAS_COLUMNS].to_csv(f, sep='\t', index=False, header=False)
+    # bgzip and index (removes the uncompressed file)
+    pysam.tabix_index(local_path, seq_col=0, start_col=1, end_col=1, meta_char='#', force=True)
+    for suffix in ['', '.tbi']:
+        with open(f'{local_path}.gz{suffix}', 'rb') as src, to_path(
+            gwas_store_path(store_dir, chrom) + suffix,
+        ).open('wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(f'{local_path}.gz{suffix}')
+
+
+def ingest_gwas(gwas_file: str, store_dir: str, chunksize: int = 1_000_000):
+    """
+    Normalise a GWAS file into the store: one position-sorted, bgzipped and tabix-indexed file per chromosome
+    """
+    import tempfile
+
+    import pandas as pd
+
+    chunks = pd.read_csv(to_path(gwas_file), sep='\t', usecols=GWAS_COLUMNS, chunksize=chunksize)
+    gwas = pd.concat(chunks, ignore_index=True)[GWAS_COLUMNS]
+    gwas['chromosome'] = gwas['chromosome'].astype(str)
+    gwas = gwas.dropna(subset=['position'])
+    gwas['position'] = gwas['position'].astype(int)
+
+    local_dir = tempfile.mkdtemp()
+    for chrom, gwas_chrom in gwas.groupby('chromosome', sort=False):
+        write_store_chromosome(gwas_chrom, chrom, store_dir, local_dir)
+        print(f'Ingested {len(gwas_chrom)} variants for {chrom}')
+
+
+def query_gwas(bgz_path: str, chrom: str, start: float, end: float) -> pd.DataFrame:
+    """
+    Variants of a (local) store file in the region [start, end] of a chromosome
+    """
+    import pandas as pd
+    import pysam
+
+    with pysam.TabixFile(bgz_path) as tabix:
+        if chrom not in tabix.contigs:
+            rows = []
+        else:
+            rows = [line.split('\t') for line in tabix.fetch(chrom, max(int(start) - 1, 0), int(end))]
+    gwas = pd.DataFrame(rows, columns=GWAS_COLUMNS)
+    gwas['position'] = gwas['position'].astype(int)
+    for column in ['beta', 'varbeta', 'p_value']:
+        gwas[column] = pd.to_numeric(gwas[column], errors='coerce')
+    return gwas
+
+
+def read_gwas_chromosome(bgz_path: str, columns: list[str] | None = None) -> pd.DataFrame:
+    """
+    All variants of a (local) store file, sorted by position (eg for scanning every cis-window of a chromosome at once)
+    """
+    import pandas as pd
+
+    gwas = pd.read_csv(
+        bgz_path,
+        sep='\t',
+        compression='gzip',
+        skiprows=1,
+        names=GWAS_COLUMNS,
+        usecols=columns or GWAS_COLUMNS,
+    )
+    for column in {'beta', 'varbeta', 'p_value'} & set(gwas.columns):
+        gwas[column] = pd.to_numeric(gwas[column], errors='coerce')
+    return gwas
+
+
+@click.option('--snp-gwas-file', help='Path to the (parsed) SNP GWAS file', required=True)
+@click.option('--store-dir', help='Output directory of the GWAS store', required=True)
+@click.option('--job-memory', help='Memory of the ingest job', default='highmem')
+@click.option('--job-storage', help='Storage of the ingest job', default='20G')
+@click.command()
+def main(snp_gwas_file, store_dir, job_memory, job_storage):
+    b = get_batch(name='Ingest GWAS summary statistics')
+    ingest_job = b.new_python_job(f'Ingest {snp_gwas_file}')
+    ingest_job.memory(job_memory)
+    ingest_job.storage(job_storage)
+    ingest_job.call(ingest_gwas, snp_gwas_file, store_dir)
+    b.run(wait=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Cis-window engine for GWAS summary statistics: the cis-window (gene +/- 100kB) of each gene from the gene annotation
+table in one vectorised lookup, and the bounds, variant counts and minimum p-values of all windows of a chromosome
+from its position-sorted GWAS variants, by binary search and segmented reductions (one pass over the variants).
+
+    windows = cis_windows(var_table, genes)
+    lo, hi = window_bounds(positions, windows['start'], windows['end'])
+    n_variants, min_p = window_stats(p_values, lo, hi)
+"""
+
+import numpy as np
+import pandas as pd
+
+CIS_WINDOW = 100000
+
+
+def cis_windows(var_table: pd.DataFrame, genes, window: int = CIS_WINDOW) -> pd.DataFrame:
+    """
+    Chromosome, start and end of the cis-window of each gene (in the order of `genes`), from the gene annotation table;
+    genes missing from the table are dropped
+    """
+    windows = (
+        var_table.drop_duplicates('gene_ids')
+        .set_index('gene_ids')
+        .reindex(pd.Index(genes, name='gene'))[['chr', 'start', 'end']]
+        .rename(columns={'chr': 'chrom'})
+    )
+    missing = windows['chrom'].isna()
+    if missing.any():
+        print(f'No gene annotation for {", ".join(windows.index[missing])}: skipping....')
+    windows = windows[~missing].reset_index()
+    windows['start'] = windows['start'].astype(float) - window
+    windows['end'] = windows['end'].astype(float) + window
+    return windows
+
+
+def window_bounds(positions: np.ndarray, starts, ends) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Row bounds [lo, hi) of the variants of each window [start, end] (inclusive, as a region query),
+    in position-sorted variants
+    """
+    lo = np.searchsorted(positions, np.asarray(starts, dtype=float).astype(int), side='left')
+    hi = np.searchsorted(positions, np.asarray(ends, dtype=float).astype(int), side='right')
+    return lo, hi
+
+
+def window_stats(p_values: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Number of variants and minimum p-value (NaN if no variant has one) of each window [lo, hi)
+    """
+    n_variants = hi - lo
+    # reduceat over the interleaved bounds: the even slots reduce p_values[lo:hi] (windows may overlap or be empty,
+    # with a trailing NaN so that hi can be the number of variants)
+    p_values = np.append(np.asarray(p_values, dtype=float), np.nan)
+    min_p = np.full(len(lo), np.nan)
+    if len(lo):
+        bounds = np.column_stack([lo, hi]).ravel()
+        min_p = np.fmin.reduceat(p_values, bounds)[::2]
+        min_p[n_variants == 0] = np.nan
+    return n_variants, min_p
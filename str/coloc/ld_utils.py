@@ -0,0 +1,114 @@
+"""
+Genotype readers and STR-vs-SNP correlation for the coloc LD scripts (`coloc_ld_runner.py`, `gwas_ld_runner.py`).
+
+SNP genotypes are kept in cyVCF2's `gt_types` coding, and STRs as their dosage (first value of FORMAT/DS),
+so that correlations are those of pandas' `corrwith` on the same values.
+"""
+
+import numpy as np
+
+
+def read_snp_window(vcf, region: str, block_size: int = 1024) -> tuple[list[str], np.ndarray]:
+    """
+    Genotypes of all SNPs of a region, in one preallocated variants x samples array (grown by doubling)
+
+    Args:
+        vcf: cyVCF2 VCF (with an index)
+        region: 'chrom:start-end'
+    Returns:
+        loci ('CHROM:POS') and genotypes (`gt_types`) of the SNPs
+    """
+    loci = []
+    genotypes = np.empty((block_size, len(vcf.samples)), dtype=np.int8)
+    for variant in vcf(region):
+        if len(loci) == len(genotypes):
+            genotypes = np.concatenate([genotypes, np.empty_like(genotypes)])
+        genotypes[len(loci)] = variant.gt_types
+        loci.append(variant.CHROM + ':' + str(variant.POS))
+    return loci, genotypes[: len(loci)]
+
+
+def read_variants_at(vcf, chrom: str, positions: np.ndarray, values, max_gap: int = 10_000) -> tuple:
+    """
+    Values of the first variant at each of a set of positions of a chromosome, in one forward sweep of the VCF
+    (positions closer than `max_gap` are read by one region query). A variant matches a position only if its POS is
+    that position: records merely overlapping it (eg a longer STR starting before it) are not matched.
+
+    Args:
+        vcf: cyVCF2 VCF (with an index)
+        positions: sorted, unique positions
+        values: function of a cyVCF2 variant, returning a value per sample
+    Returns:
+        positions x samples float array (NaN for positions without a variant), and a mask of the positions found
+    """
+    genotypes = np.full((len(positions), len(vcf.samples)), np.nan)
+    found = np.zeros(len(positions), dtype=bool)
+    if not len(positions):
+        return genotypes, found
+    rows = {position: i for i, position in enumerate(positions.tolist())}
+    breaks = np.nonzero(np.diff(positions) > max_gap)[0]
+    starts = positions[np.concatenate([[0], breaks + 1])]
+    ends = positions[np.concatenate([breaks, [len(positions) - 1]])]
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        for variant in vcf(f'{chrom}:{start}-{end}'):
+            row = rows.get(variant.POS)
+            if row is None or found[row]:
+                continue
+            genotypes[row] = values(variant)
+            found[row] = True
+    return genotypes, found
+
+
+def read_str_dosage(vcf, str_locus: str) -> np.ndarray | None:
+    """
+    Dosage of the first STR at the start of a locus ('chrom:start-end'), or None if the VCF has no STR there
+
+    As in `read_variants_at`, only a variant whose POS is the start matches (not any record overlapping the locus).
+    """
+    start = int(str_locus.split(':')[1].split('-')[0])
+    for variant in vcf(str_locus):
+        if variant.POS != start:
+            continue
+        print(f'Captured STR with POS:{variant.POS}')
+        return np.asarray(variant.format('DS')[:, 0], dtype=float)
+    return None
+
+
+def shared_samples(snp_samples: list[str], str_samples: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Columns of the samples present in both VCFs (in SNP VCF order, as an inner merge on individual)
+    """
+    str_index = {sample: i for i, sample in enumerate(str_samples)}
+    snp_cols = np.array([i for i, sample in enumerate(snp_samples) if sample in str_index], dtype=int)
+    str_cols = np.array([str_index[snp_samples[i]] for i in snp_cols], dtype=int)
+    return snp_cols, str_cols
+
+
+def correlate_with(genotypes: np.ndarray, target: np.ndarray) -> np.ndarray:
+    """
+    Pearson correlation of every row of a variants x samples matrix with a target (samples), as one standardised
+    matrix-vector product. Samples missing in the target are dropped; constant rows get NaN.
+    """
+    keep = ~np.isnan(target)
+    x = genotypes[:, keep].astype(float)
+    y = target[keep] - target[keep].mean()
+    x -= x.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = (x @ y) / np.sqrt((x**2).sum(axis=1) * (y**2).sum())
+    corr[~np.isfinite(corr)] = np.nan
+    return corr
+
+
+def correlate_rows(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Pearson correlation of each row of `x` with the same row of `y` (pairs x samples), over the samples present in
+    both rows; constant rows get NaN
+    """
+    mask = ~(np.isnan(x) | np.isnan(y))
+    n = mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xc = np.where(mask, x - (np.where(mask, x, 0).sum(axis=1) / n)[:, None], 0)
+        yc = np.where(mask, y - (np.where(mask, y, 0).sum(axis=1) / n)[:, None], 0)
+        corr = (xc * yc).sum(axis=1) / np.sqrt((xc**2).sum(axis=1) * (yc**2).sum(axis=1))
+    corr[~np.isfinite(corr)] = np.nan
+    return corr
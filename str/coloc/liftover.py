@@ -7,6 +7,12 @@ The liftover is obtained from the Broad Institute liftover API.
 It uses BCFTools liftover internally to get the liftover variant id.
 New as of 2024 with support for multi-allelic variants.
 
+The liftover BED (rsID -> hg38 position) is converted once into a memory-mapped rsID index (`--index-dir`):
+- `rsid.npy`: key of each rsID (uint64, sorted, see `rsid_keys`)
+- `chromosome.npy`: chromosome of each rsID (int16 code into `chromosomes.txt`)
+- `position.npy`: hg38 position of each rsID (int64)
+Phenotype files are then streamed in chunks through vectorised lookups (binary search on the sorted rsIDs).
+
 analysis-runner --dataset "bioheart" --description "Liftover variants from hg19 to hg38" --access-level "test" \
     --output-dir "str/associatr/liftover" \
     --memory "4G" \
@@ -14,40 +20,142 @@ analysis-runner --dataset "bioheart" --description "Liftover variants from hg19
     liftover.py
 """
 
-import pandas as pd
+import click
 
 from cpg_utils import to_path
 from cpg_utils.hail_batch import get_batch
 
+INDEX_FILES = ['rsid.npy', 'chromosome.npy', 'position.npy', 'chromosomes.txt']
 
-def liftover(phenotype):
-    file_path = to_path(
-        f'gs://cpg-bioheart-test-upload/str/ukbb-snp-catalogs/white_british_{phenotype}_snp_gwas_results.tab.gz',
-    )
 
-    df = pd.read_csv(file_path, sep='\t', compression='gzip', usecols=['ID', 'REF', 'ALT', 'BETA', 'SE', 'P'])
-    liftover_df = pd.read_csv(
-        'gs://cpg-bioheart-test/str/gymrek-ukbb-snp-gwas-catalogs/ukbb_snp_chr_pos_hg38_liftover.bed',
+def rsid_keys(ids):
+    """
+    Integer keys of variant IDs: the number of rsIDs ('rs123' -> 123), and a 64-bit hash (with the top bit set, so
+    that it cannot equal an rsID key) of any other ID
+    """
+    import numpy as np
+    import pandas as pd
+
+    ids = pd.Series(ids, dtype=str)
+    numbers = pd.to_numeric(ids.str.removeprefix('rs').where(ids.str.fullmatch(r'rs\d+')), errors='coerce')
+    hashes = pd.util.hash_array(ids.to_numpy(dtype=object), categorize=False) | np.uint64(1 << 63)
+    return np.where(numbers.notna(), numbers.fillna(0).to_numpy(dtype=np.uint64), hashes)
+
+
+def build_liftover_index(liftover_bed: str, index_dir: str, chunksize: int = 5_000_000):
+    """
+    Convert the liftover BED (chromosome, position, end, rsID) into the sorted rsID index
+    """
+    import numpy as np
+    import pandas as pd
+
+    keys, chroms, positions = [], [], []
+    chromosomes: dict[str, int] = {}
+    for chunk in pd.read_csv(
+        to_path(liftover_bed),
         sep='\t',
         header=None,
         names=['chromosome', 'position', 'end38', 'rsid'],
-    )
+        usecols=['chromosome', 'position', 'rsid'],
+        chunksize=chunksize,
+    ):
+        for chrom in chunk['chromosome'].unique():
+            chromosomes.setdefault(chrom, len(chromosomes))
+        keys.append(rsid_keys(chunk['rsid']))
+        # int16: hg38 BEDs with alt/random/unplaced contigs have more contigs than int8 codes
+        chroms.append(chunk['chromosome'].map(chromosomes).to_numpy(dtype=np.int16))
+        positions.append(chunk['position'].to_numpy(dtype=np.int64))
+
+    # stable sort keeps the BED order of rsIDs lifted over to several positions
+    order = np.argsort(np.concatenate(keys), kind='stable')
+    arrays = {
+        'rsid.npy': np.concatenate(keys)[order],
+        'chromosome.npy': np.concatenate(chroms)[order],
+        'position.npy': np.concatenate(positions)[order],
+    }
+    for name, array in arrays.items():
+        with to_path(f'{index_dir}/{name}').open('wb') as f:
+            np.save(f, array)
+    with to_path(f'{index_dir}/chromosomes.txt').open('w') as f:
+        f.write('\n'.join(chromosomes) + '\n')
+    print(f'Indexed {len(order)} rsIDs')
+
+
+def lookup_rsids(index: dict, ids) -> tuple:
+    """
+    Matches of rsIDs in the index, as the (row of `ids`, index row) of each match
 
-    df = pd.merge(df, liftover_df, left_on='ID', right_on='rsid')  # noqa: PD015
-    df['varbeta'] = df['SE'] ** 2
-    df['beta'] = df['BETA']
-    df['snp'] = df['chromosome'] + '_' + df['position'].astype(str) + '_' + df['REF'] + '_' + df['ALT']
-    df['p_value'] = df['P']
+    As an inner join on rsID: unmatched IDs are dropped, and IDs with several hg38 positions give one match each.
+    """
+    import numpy as np
 
-    # Write out the results
-    df[['chromosome', 'position', 'varbeta', 'beta', 'snp', 'p_value']].to_csv(
+    keys = rsid_keys(ids)
+    left = np.searchsorted(index['rsid'], keys, side='left')
+    counts = np.searchsorted(index['rsid'], keys, side='right') - left
+    rows = np.repeat(np.arange(len(keys)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, np.repeat(left, counts) + offsets
+
+
+def liftover(phenotype, index_files, chunksize=1_000_000):
+    import gzip
+
+    import numpy as np
+    import pandas as pd
+
+    index = {
+        'rsid': np.load(index_files['rsid'], mmap_mode='r'),
+        'chromosome': np.load(index_files['chromosome'], mmap_mode='r'),
+        'position': np.load(index_files['position'], mmap_mode='r'),
+    }
+    with open(index_files['chromosomes']) as f:
+        chromosomes = np.array(f.read().split(), dtype=object)
+
+    file_path = to_path(
+        f'gs://cpg-bioheart-test-upload/str/ukbb-snp-catalogs/white_british_{phenotype}_snp_gwas_results.tab.gz',
+    )
+    out_path = to_path(
         f'gs://cpg-bioheart-test/str/gymrek-ukbb-snp-gwas-catalogs/white_british_{phenotype}_snp_gwas_results_hg38.tab.gz',
-        sep='\t',
-        index=False,
     )
+    with out_path.open('wb') as out_file, gzip.GzipFile(fileobj=out_file, mode='wb') as out:
+        for i, df in enumerate(
+            pd.read_csv(
+                file_path,
+                sep='\t',
+                compression='gzip',
+                usecols=['ID', 'REF', 'ALT', 'BETA', 'SE', 'P'],
+                chunksize=chunksize,
+            ),
+        ):
+            rows, hits = lookup_rsids(index, df['ID'])
+            df = df.iloc[rows].reset_index(drop=True)
+            df['chromosome'] = chromosomes[index['chromosome'][hits]]
+            df['position'] = index['position'][hits]
+            df['varbeta'] = df['SE'] ** 2
+            df['beta'] = df['BETA']
+            df['snp'] = df['chromosome'] + '_' + df['position'].astype(str) + '_' + df['REF'] + '_' + df['ALT']
+            df['p_value'] = df['P']
 
+            # Write out the results
+            out.write(
+                df[['chromosome', 'position', 'varbeta', 'beta', 'snp', 'p_value']]
+                .to_csv(sep='\t', index=False, header=i == 0)
+                .encode(),
+            )
 
-def main():
+
+@click.option(
+    '--liftover-bed',
+    help='BED of the hg38 position of each rsID',
+    default='gs://cpg-bioheart-test/str/gymrek-ukbb-snp-gwas-catalogs/ukbb_snp_chr_pos_hg38_liftover.bed',
+)
+@click.option(
+    '--index-dir',
+    help='Directory of the rsID index (built from --liftover-bed if it does not exist)',
+    default='gs://cpg-bioheart-test/str/gymrek-ukbb-snp-gwas-catalogs/ukbb_snp_chr_pos_hg38_liftover_index',
+)
+@click.command()
+def main(liftover_bed, index_dir):
     b = get_batch(name='liftover')
     phenotypes = [
         "alanine_aminotransferase",
@@ -95,11 +203,22 @@ def main():
         "vitamin_d",
         "white_blood_cell_count",
     ]
+    # build the rsID index once, for all phenotypes
+    index_job = None
+    if not all(to_path(f'{index_dir}/{name}').exists() for name in INDEX_FILES):
+        index_job = b.new_python_job('Build rsID liftover index')
+        index_job.memory('highmem')
+        index_job.call(build_liftover_index, liftover_bed, index_dir)
+    index_files = b.read_input_group(
+        **{name.split('.')[0]: f'{index_dir}/{name}' for name in INDEX_FILES},
+    )
+
     for pheno in phenotypes:
         liftover_job = b.new_python_job('Liftover variants from hg19 to hg38: ' + pheno)
-        liftover_job.memory('64G')
         liftover_job.storage('10G')
-        liftover_job.call(liftover, pheno)
+        if index_job:
+            liftover_job.depends_on(index_job)
+        liftover_job.call(liftover, pheno, index_files)
     b.run(wait=False)
 
 
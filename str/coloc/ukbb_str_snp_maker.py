@@ -4,6 +4,13 @@
 This script combines the STR an SNP Gymrek UKBB catalogs.
 STR UKBB catalogs are parsed with a harmonised mapping file to ensure its definition matches the eQTL callset.
 
+All phenotypes are harmonised in one job, in a pool of `--job-cpu` processes: the mapping file is loaded once, and
+inherited by the (forked) workers. SNP rows are streamed in chunks, both to the combined catalog and to
+per-chromosome spill files, which are then sorted (with the STR rows of the chromosome) one chromosome at a time into
+a GWAS store per phenotype (`{--store-dir}/{phenotype}`, see gwas_store.py), queried by region by coloc_runner.py.
+Each chromosome is sorted in memory, so a worker holds at most the rows of the largest chromosome (about a tenth of a
+catalog for chr1), plus the mapping file and the STR rows of its phenotype.
+
 analysis-runner --dataset "bioheart" --description "Liftover variants from hg19 to hg38" --access-level "test" \
     --output-dir "str/associatr/liftover" \
     --memory "4G" \
@@ -11,14 +18,41 @@ analysis-runner --dataset "bioheart" --description "Liftover variants from hg19
     ukbb_str_snp_maker.py
 """
 
+import sys
+from pathlib import Path
+
+import click
 import pandas as pd
 
 from cpg_utils import to_path
 from cpg_utils.hail_batch import get_batch
 
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
+
+MAPPING_FILE = 'gs://cpg-bioheart-test/str/gymrek-ukbb-str-gwas-catalogs/ukbb_str_harmonised_mapping.csv'
+OUTPUT_COLUMNS = ['chromosome', 'position', 'varbeta', 'beta', 'snp', 'p_value']
+
+# harmonised STR mapping, loaded once per job (by `load_mapping`) and shared with forked workers
+_mapping: pd.DataFrame | None = None
+
+
+def load_mapping():
+    global _mapping  # noqa: PLW0603
+    _mapping = pd.read_csv(to_path(MAPPING_FILE))
+
 
-def liftover(phenotype):
+def liftover(phenotype, store_root, chunksize=1_000_000):
+    """
+    Combine the harmonised STR and the SNP catalogs of a phenotype, and write them to its GWAS store.
+    SNP rows are streamed, but each chromosome is read back whole to be sorted (memory bounded by the largest chromosome).
+    """
     import gzip
+    import shutil
+    import tempfile
+
+    from gwas_store import write_store_chromosome
 
     str_gwas_file = f'gs://cpg-bioheart-test/str/gymrek-ukbb-str-gwas-catalogs/gymrek-ukbb-str-gwas-catalogs/white_british_{phenotype}_str_gwas_results.tab.gz'
     with gzip.open(to_path(str_gwas_file), 'rb') as f:
@@ -37,11 +71,9 @@ def liftover(phenotype):
         )
     str_gwas['chromosome'] = 'chr' + str_gwas['chromosome'].astype(str)
 
-    mapping_df = pd.read_csv('gs://cpg-bioheart-test/str/gymrek-ukbb-str-gwas-catalogs/ukbb_str_harmonised_mapping.csv')
-
     df = pd.merge(  # noqa: PD015
         str_gwas,
-        mapping_df,
+        _mapping,
         left_on=['chromosome', 'start_pos (hg38)', 'repeat_unit'],
         right_on=['chrom', 'gwas_pos', 'gwas_motif'],
     )
@@ -49,22 +81,68 @@ def liftover(phenotype):
     df['varbeta'] = df['standard_error'] ** 2
     df['position'] = df['catalog_pos']
 
-    # Write out the results
-    df = df[['chromosome', 'position', 'varbeta', 'beta', 'snp', 'p_value']]
+    # harmonised STR rows, written ahead of the SNP rows
+    df = df[OUTPUT_COLUMNS]
 
+    local_dir = tempfile.mkdtemp()
+    spill_files = {}  # SNP rows of each chromosome, before sorting
     snp_gwas_parsed_file = f'gs://cpg-bioheart-test/str/gymrek-ukbb-snp-gwas-catalogs/white_british_{phenotype}_snp_gwas_results_hg38.tab.gz'
-    with gzip.open(to_path(snp_gwas_parsed_file), 'rb') as f_snp:
-        snp_gwas = pd.read_csv(f_snp, sep='\t')
-
-    df_combined = pd.concat([df, snp_gwas])
-    df_combined.to_csv(
+    with gzip.open(to_path(snp_gwas_parsed_file), 'rb') as f_snp, to_path(
         f'gs://cpg-bioheart-test/str/gymrek-ukbb-snp-str-gwas-catalogs/white_british_{phenotype}_snp_str_gwas_results_hg38.tab.gz',
-        sep='\t',
-        index=False,
-    )
-
-
-def main():
+    ).open('wb') as out_file, gzip.GzipFile(fileobj=out_file, mode='wb') as out:
+        out.write(df.to_csv(sep='\t', index=False).encode())
+        for snp_gwas in pd.read_csv(f_snp, sep='\t', chunksize=chunksize):
+            snp_gwas = snp_gwas[OUTPUT_COLUMNS]
+            out.write(snp_gwas.to_csv(sep='\t', index=False, header=False).encode())
+            for chrom, snp_gwas_chrom in snp_gwas.groupby('chromosome', sort=False):
+                if chrom not in spill_files:
+                    spill_files[chrom] = open(f'{local_dir}/{chrom}_snps.tsv', 'w')  # noqa: SIM115
+                snp_gwas_chrom.to_csv(spill_files[chrom], sep='\t', index=False, header=False)
+    for spill_file in spill_files.values():
+        spill_file.close()
+
+    # sort the STR and SNP rows of each chromosome into the GWAS store
+    for chrom in list(dict.fromkeys([*df['chromosome'], *spill_files])):
+        gwas_chrom = df[df['chromosome'] == chrom]
+        if chrom in spill_files:
+            gwas_chrom = pd.concat(
+                [gwas_chrom, pd.read_csv(f'{local_dir}/{chrom}_snps.tsv', sep='\t', names=OUTPUT_COLUMNS)],
+            )
+        gwas_chrom = gwas_chrom.dropna(subset=['position'])
+        gwas_chrom['position'] = gwas_chrom['position'].astype(int)
+        write_store_chromosome(gwas_chrom, chrom, f'{store_root}/{phenotype}', local_dir)
+    shutil.rmtree(local_dir)
+    print(f'Harmonised {phenotype}')
+
+
+def harmonise_catalogs(phenotypes, store_root, max_workers, *, localise_modules):
+    """
+    Harmonise the catalogs of all phenotypes, one phenotype per (forked) process
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import repeat
+
+    # workers look the functions up by module (this function is sent to the job by value, as part of __main__), so
+    # this script is shipped with the job, with gwas_store.py and the job_modules.py it imports
+    localise_modules()
+    from ukbb_str_snp_maker import liftover, load_mapping
+
+    load_mapping()
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        # list() re-raises any failure of a worker
+        list(executor.map(liftover, phenotypes, repeat(store_root)))
+
+
+@click.option(
+    '--store-dir',
+    help='Directory of the GWAS stores (one per phenotype)',
+    default='gs://cpg-bioheart-test/str/gymrek-ukbb-snp-str-gwas-catalogs/gwas-store',
+)
+@click.option('--job-cpu', help='CPU of the harmonisation job (one phenotype is harmonised per CPU)', default=8)
+@click.option('--job-storage', help='Storage of the harmonisation job', default='50G')
+@click.command()
+def main(store_dir, job_cpu, job_storage):
     b = get_batch(name='liftover')
     phenotypes = [
         "alanine_aminotransferase",
@@ -112,11 +190,17 @@ def main():
         "vitamin_d",
         "white_blood_cell_count",
     ]
-    for pheno in phenotypes:
-        liftover_job = b.new_python_job('Parse STR UKBB and combine with SNP ' + pheno)
-        liftover_job.memory('32G')
-        liftover_job.storage('10G')
-        liftover_job.call(liftover, pheno)
+    harmonise_job = b.new_python_job('Parse STR UKBB and combine with SNP')
+    harmonise_job.cpu(job_cpu)
+    harmonise_job.memory('highmem')
+    harmonise_job.storage(job_storage)
+    harmonise_job.call(
+        harmonise_catalogs,
+        phenotypes,
+        store_dir,
+        max(1, int(job_cpu)),
+        localise_modules=ship_modules(__file__, 'ukbb_str_snp_maker.py', 'gwas_store.py', '../helper/job_modules.py'),
+    )
     b.run(wait=False)
 
 
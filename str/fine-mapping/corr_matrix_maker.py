@@ -3,14 +3,14 @@
 """
 This script is used to create a correlation matrix between STR and SNP genotypes, which is required by fine-mapping methods.
 
-Output: Correlation matrix, and list of variants (as appears in the matrix)
+Output: Correlation matrix (binary .npy, see ld_store.py), and list of variants (as appears in the matrix)
 
-Workflow (for each cell type):
-1) Extract genes where the eSTR is significant (default = FDR<0.05).
-For each gene,
-2) Extract the STR and SNP coordinates where the association signal is p < 5e-4, to reduce computational burden of fine-mapper.
-3) Obtain the genotypes for each extracted STR and SNP in 2)
-4) Calculate the correlation matrix between STR and SNP genotypes.
+Workflow (for each chromosome):
+1) Extract genes where the eSTR is significant (default = FDR<0.05), for each cell type.
+2) For each cell type and gene, extract the STR and SNP coordinates where the association signal is p < 5e-4, to reduce computational burden of fine-mapper.
+3) Obtain the genotypes for all STRs and SNPs extracted in 2), sorted by position and read in one sweep of each VCF.
+4) For each gene, calculate one correlation matrix between the STR and SNP genotypes of all cell types' loci
+(`correlation_matrix/all_celltypes`). Each cell type gets the list of its own loci, used to subset that matrix.
 
 analysis-runner --dataset "bioheart" \
     --description "Calculate LD between STR and SNPs" \
@@ -30,6 +30,9 @@ analysis-runner --dataset "bioheart" \
 """
 
 import ast
+import sys
+import warnings
+from pathlib import Path
 
 import click
 import numpy as np
@@ -41,23 +44,28 @@ from hailtop.batch import ResourceGroup
 from cpg_utils.config import output_path
 from cpg_utils.hail_batch import get_batch
 
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
 
-def ld_parser(
-    snp_vcf_path: ResourceGroup,
-    str_vcf_path: ResourceGroup,
+
+def collect_ld_targets(
     str_fdr: pd.DataFrame,
     celltype: str,
     pval_cutoff: float,
     associatr_dir: str,
-) -> str:
+) -> pd.DataFrame:
+    """
+    Collect the STR and SNP loci passing `pval_cutoff` for every eGene of a cell type and chromosome.
+
+    Returns:
+        df with one row per (gene, variant): gene, chrom, pos, motif, end (STRs only), is_str and varid
+        ('{chrom}:{pos}_{motif}', as used for the LD matrix rows/columns). Within a gene, STRs come first.
+    """
     import pandas as pd
-    from cyvcf2 import VCF
-
-    if str_fdr.empty:
-        print(f'No eSTRs for {celltype}')
-        return  # type: ignore
 
-    for index, row in str_fdr.iterrows():  # iterate over each gene
+    targets = []
+    for _, row in str_fdr.iterrows():  # iterate over each gene
         gene = row['gene_name']
         chrom = ast.literal_eval(row['chr'])[0]
         # obtain raw associaTR results for this gene
@@ -72,74 +80,222 @@ def ld_parser(
         if associatr.empty:
             print(f'No associatr results for this gene: {gene}')
             continue
+        gene_targets = pd.DataFrame(
+            {
+                'gene': gene,
+                'chrom': chrom,
+                'pos': associatr['pos'].astype(int),
+                'motif': associatr['motif'],
+                'is_str': ~associatr['motif'].str.contains('-'),
+            },
+        )
+        gene_targets['end'] = (associatr['pos'] + associatr['ref_len'] * associatr['period']).round()
+        gene_targets.loc[~gene_targets['is_str'], 'end'] = np.nan
+        gene_targets['varid'] = (
+            gene_targets['chrom'] + ':' + gene_targets['pos'].astype(str) + '_' + gene_targets['motif']
+        )
+        # STR columns precede SNP columns in the LD matrix
+        targets.append(gene_targets.sort_values('is_str', ascending=False, kind='stable').drop_duplicates('varid'))
+
+    if not targets:
+        return pd.DataFrame(columns=['gene', 'chrom', 'pos', 'motif', 'is_str', 'end', 'varid'])
+    return pd.concat(targets, ignore_index=True)
+
+
+def decode_repcn(genotypes: np.ndarray) -> np.ndarray:
+    """
+    Decode REPCN genotypes ('12/13', or '.' if missing) into the sum of both allele lengths (NaN if missing)
+    """
+    # one join/split over the whole record, rather than a split per sample
+    alleles = '/'.join(genotypes).replace('.', 'nan/nan').split('/')
+    return np.asarray(alleles, dtype=np.float32).reshape(-1, 2).sum(axis=1)
+
+
+def genotype_regions(positions: np.ndarray, max_gap: int = 100_000) -> list[tuple[int, int]]:
+    """
+    Merge sorted target positions into disjoint regions, so that a VCF can be read in one forward sweep
+    """
+    breaks = np.nonzero(np.diff(positions) > max_gap)[0]
+    starts = positions[np.concatenate([[0], breaks + 1])]
+    ends = positions[np.concatenate([breaks, [len(positions) - 1]])]
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def read_genotype_matrix(
+    snp_vcf_path: str,
+    str_vcf_path: str,
+    targets: pd.DataFrame,
+) -> tuple[np.ndarray, dict[str, int]]:
+    """
+    Read the genotypes of all target loci of a chromosome into one preallocated float32 matrix
+    (samples x variants), sweeping each VCF once in position order.
+    SNPs are coded as alternate allele counts, STRs as the sum of both allele lengths; missing values are NaN.
+
+    Returns:
+        genotype matrix (rows: samples present in both VCFs, in STR VCF order), and a mapping of varid to column
+    """
+    from cyvcf2 import VCF
+
+    variants = targets.drop_duplicates('varid').sort_values('pos').reset_index(drop=True)
+    columns = {varid: i for i, varid in enumerate(variants['varid'])}
+    found = np.zeros(len(variants), dtype=bool)
+
+    snp_vcf = VCF(snp_vcf_path)
+    str_vcf = VCF(str_vcf_path)
+    # samples present in both VCFs (as in an inner merge on individual, keeping the STR VCF order)
+    snp_sample_index = {sample: i for i, sample in enumerate(snp_vcf.samples)}
+    str_rows = np.array([i for i, sample in enumerate(str_vcf.samples) if sample in snp_sample_index], dtype=int)
+    snp_rows = np.array([snp_sample_index[str_vcf.samples[i]] for i in str_rows], dtype=int)
+    genotypes = np.full((len(str_rows), len(variants)), np.nan, dtype=np.float32)
+
+    for is_str, vcf in [(False, snp_vcf), (True, str_vcf)]:
+        vcf_variants = variants[variants['is_str'] == is_str]
+        if vcf_variants.empty:
+            continue
+        chrom = vcf_variants['chrom'].iloc[0]
+        if is_str:
+            keys = dict(
+                zip(
+                    zip(vcf_variants['pos'], vcf_variants['motif'], vcf_variants['end'].astype(int)),
+                    vcf_variants.index,
+                ),
+            )
+        else:
+            keys = dict(zip(zip(vcf_variants['pos'], vcf_variants['motif']), vcf_variants.index))
+        for start, end in genotype_regions(vcf_variants['pos'].to_numpy()):
+            for variant in vcf(f'{chrom}:{start}-{end}'):
+                if is_str:
+                    key = (variant.POS, str(variant.INFO.get('RU')), int(variant.INFO.get('END')))
+                else:
+                    key = (variant.POS, str(variant.INFO.get('RU')))
+                col = keys.get(key)
+                if col is None or found[col]:
+                    continue
+                if is_str:
+                    genotypes[:, col] = decode_repcn(variant.format('REPCN'))[str_rows]
+                else:
+                    gt = variant.gt_types
+                    gt[gt == 3] = 2  # convert HOM ALT 3 encoding into a 2
+                    genotypes[:, col] = gt[snp_rows]
+                found[col] = True
+
+    # keep only the loci found in the VCFs
+    columns = {varid: col for varid, col in columns.items() if found[col]}
+    return genotypes, columns
+
+
+def ld_matrix(genotypes: np.ndarray, shrinkage: float = 0.0, block_size: int = 0) -> np.ndarray:
+    """
+    Pearson correlation (LD) matrix of a samples x variants genotype matrix, computed in float32.
+    Missing genotypes are mean-imputed, the matrix is standardised once and R = Z^T Z / (n - 1) is computed via BLAS,
+    optionally in blocks of `block_size` variants to bound peak memory for very wide windows.
+    Monomorphic (or entirely missing) variants get NaN rows/columns, as with pandas' DataFrame.corr().
+
+    Args:
+        genotypes (np.ndarray): samples x variants
+        shrinkage (float): weight of the identity matrix in (1 - shrinkage) * R + shrinkage * I
+        block_size (int): number of variants per block (0 computes R in one product)
+    """
+    z = np.array(genotypes, dtype=np.float32)
+    n_samples, n_variants = z.shape
+    # fill missing values with mean of the column (variant) to avoid NAs
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        means = np.nanmean(z, axis=0)
+    missing = np.isnan(z)
+    z[missing] = np.take(means, np.nonzero(missing)[1])
+    z -= means
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z /= np.sqrt((z**2).sum(axis=0) / (n_samples - 1))
+    z[:, ~np.isfinite(z).all(axis=0)] = np.nan
+
+    block_size = block_size or n_variants
+    corr = np.empty((n_variants, n_variants), dtype=np.float32)
+    for start in range(0, n_variants, block_size):
+        corr[start : start + block_size] = z[:, start : start + block_size].T @ z
+    corr /= n_samples - 1
+    # remove floating point drift, so that R is exactly symmetric with a unit diagonal
+    corr = (corr + corr.T) / 2
+    np.clip(corr, -1, 1, out=corr)
+    valid = np.flatnonzero(~np.isnan(np.diagonal(corr)))
+    corr[valid, valid] = 1
+
+    if shrinkage:
+        corr *= 1 - shrinkage
+        corr[valid, valid] += shrinkage
+    return corr
+
+
+def ld_parser(
+    snp_vcf_path: ResourceGroup,
+    str_vcf_path: ResourceGroup,
+    str_fdrs: dict[str, pd.DataFrame],
+    chrom: str,
+    pval_cutoff: float,
+    associatr_dir: str,
+    ld_shrinkage: float = 0.0,
+    ld_block_size: int = 0,
+    ld_dtype: str = 'float32',
+    *,
+    localise_modules,
+) -> str:
+    from concurrent.futures import ThreadPoolExecutor
+
+    import pandas as pd
+
+    # ld_store.py, shipped with the job
+    localise_modules()
+    from ld_store import SHARED_LD_DIR, write_ld_matrix, write_ld_variants
 
-        # create empty DF to store the relevant GTs (SNPs, STRs)
-        snp_df = pd.DataFrame(columns=['individual'])
-        str_df = pd.DataFrame(columns=['individual'])
+    str_fdrs = {celltype: str_fdr for celltype, str_fdr in str_fdrs.items() if not str_fdr.empty}
+    if not str_fdrs:
+        print(f'No eSTRs for {chrom}')
+        return  # type: ignore
 
-        # cyVCF2 reads the SNP,STR VCF
-        snp_vcf = VCF(snp_vcf_path['vcf'])
-        snp_df['individual'] = snp_vcf.samples
-        str_vcf = VCF(str_vcf_path['vcf'])
-        snp_df['individual'] = snp_df['individual'].apply(
-            lambda x: f"CPG{x}",
+    # collect each cell type's loci (reading the associaTR files of cell types in parallel)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        celltype_targets = dict(
+            zip(
+                str_fdrs,
+                executor.map(
+                    lambda celltype: collect_ld_targets(str_fdrs[celltype], celltype, pval_cutoff, associatr_dir),
+                    str_fdrs,
+                ),
+            ),
         )
-        str_df['individual'] = str_vcf.samples
-        str_df['individual'] = str_df['individual'].apply(
-            lambda x: f"CPG{x}",
-        )  # add CPG prefix to match SNP individual names
-
-        for index, row in associatr.iterrows():  # obtain GTs for each STR/SNP listed in the raw associatr file
-            pos = row['pos']
-            motif = row['motif']
-            if '-' in row['motif']:  # SNP
-                for variant in snp_vcf(f'{chrom}:{pos}-{pos}'):
-                    if str(variant.INFO.get('RU')) == motif:
-                        gt = variant.gt_types
-                        gt[gt == 3] = 2  # convert HOM ALT 3 encoding into a 2
-
-                        snp_df[f'{chrom}:{pos}_{motif}'] = gt
-                        break
-            else:  # STR
-                chrom = row['chr']
-                end = round(pos + row['ref_len'] * row['period'])
-                for variant in str_vcf(f'{chrom}:{pos}-{pos}'):
-                    if (str(variant.INFO.get('RU')) == motif) and (
-                        int(variant.INFO.get('END')) == end
-                    ):  # check if the motif and end coordinate matches
-                        genotypes = variant.format('REPCN')
-                        # Replace '.' with '-99/-99' to handle missing values
-                        genotypes = np.where(genotypes == '.', '-99/-99', genotypes)
-
-                        # Split each element by '/'
-                        split_genotypes = [genotype.split('/') for genotype in genotypes]
-
-                        # Convert split_genotypes into a numpy array for easier manipulation
-                        split_genotypes_array = np.array(split_genotypes)
-
-                        # Convert the strings to integers and sum them row-wise
-                        sums = np.sum(split_genotypes_array.astype(int), axis=1)
-                        # set dummy -198 value to np.nan
-                        sums = np.where(sums == -198, np.nan, sums)
-
-                        str_df[f'{chrom}:{pos}_{motif}'] = sums
-                        break
-        # merge the two dataframes
-        merged_df = str_df.merge(snp_df, on='individual')
+    celltype_targets = {celltype: targets for celltype, targets in celltype_targets.items() if not targets.empty}
+    if not celltype_targets:
+        return  # type: ignore
+    # LD is the same for every cell type: compute it once per gene, over the union of all cell types' loci
+    targets = pd.concat(celltype_targets.values(), ignore_index=True)
+    targets = targets.sort_values(['gene', 'is_str'], ascending=[True, False], kind='stable').drop_duplicates(
+        ['gene', 'varid'],
+    )
+    # read the genotypes of all genes' loci in one sweep of each VCF
+    genotypes, columns = read_genotype_matrix(snp_vcf_path['vcf'], str_vcf_path['vcf'], targets)
+
+    for gene, gene_targets in targets.groupby('gene', sort=False):
+        varids = [varid for varid in gene_targets['varid'] if varid in columns]
 
         # calculate pairwise correlation of every variant
-        merged_df = merged_df.drop(columns='individual')
-        merged_df = merged_df.fillna(
-            merged_df.mean(),
-        )  # fill missing values with mean of the column (variant) to avoid NAs
-        corr_matrix = merged_df.corr()
+        corr = ld_matrix(genotypes[:, [columns[varid] for varid in varids]], ld_shrinkage, ld_block_size)
 
         # write to bucket
-        corr_matrix.to_csv(
-            output_path(f'correlation_matrix/{celltype}/{chrom}/{gene}_correlation_matrix.tsv', 'analysis'),
-            sep='\t',
+        write_ld_matrix(
+            output_path(f'correlation_matrix/{SHARED_LD_DIR}/{chrom}/{gene}_correlation_matrix', 'analysis'),
+            corr,
+            varids,
+            ld_dtype,
         )
         print(f"Wrote correlation matrix for {gene}")
+
+    # each cell type's matrix is the subset of the shared matrix to its own loci
+    for celltype, targets in celltype_targets.items():
+        for gene, gene_targets in targets.groupby('gene', sort=False):
+            write_ld_variants(
+                output_path(f'correlation_matrix/{celltype}/{chrom}/{gene}_correlation_matrix', 'analysis'),
+                [varid for varid in gene_targets['varid'] if varid in columns],
+            )
     return  # type: ignore
 
 
@@ -180,6 +336,22 @@ def ld_parser(
     help='Chromosomes to use',
     default='chr1,chr2,chr3,chr4,chr5,chr6,chr7,chr8,chr9,chr10,chr11,chr12,chr13,chr14,chr15,chr16,chr17,chr18,chr19,chr20,chr21,chr22',
 )
+@click.option(
+    '--ld-shrinkage',
+    help='Shrink the LD matrix towards the identity: (1 - s) * R + s * I (improves SuSiE-RSS stability)',
+    default=0.0,
+)
+@click.option(
+    '--ld-block-size',
+    help='Compute the LD matrix in blocks of this many variants (0 = no blocking)',
+    default=0,
+)
+@click.option(
+    '--ld-dtype',
+    help='Precision of the stored LD matrix (float16 halves the storage)',
+    type=click.Choice(['float32', 'float16']),
+    default='float32',
+)
 @click.option('--job-cpu', default=1)
 @click.option('--job-storage', default='20G')
 @click.option('--max-parallel-jobs', default=22)
@@ -196,6 +368,9 @@ def main(
     pval_cutoff: float,
     chromosomes: str,
     max_parallel_jobs: int,
+    ld_shrinkage: float,
+    ld_block_size: int,
+    ld_dtype: str,
 ):
     # Setup MAX concurrency by genes
     _dependent_jobs: list[hb.batch.job.Job] = []
@@ -209,36 +384,45 @@ def main(
         _dependent_jobs.append(job)
 
     b = get_batch(name='Correlation matrix runner')
+    # read in eSTR files
+    str_fdrs = {}
     for celltype in celltypes.split(','):
-        # read in eSTR file
         str_fdr_file = f'{str_fdr_dir}/{celltype}_qval.tsv'
         str_fdr = pd.read_csv(str_fdr_file, sep='\t')
-        str_fdr = str_fdr[str_fdr['qval'] < fdr_cutoff]  # subset to eSTRs passing FDR 5% threshold by default
-        for chrom in chromosomes.split(','):
-            # filter eSTRs by chromosome
-            str_fdr_chrom = str_fdr[str_fdr['chr'].str.contains("'" + chrom + "'")]
-            # read in STR and SNP VCFs for this chromosome
-            snp_vcf_path = f'{snp_vcf_dir}/hail_filtered_{chrom}.vcf.bgz'
-            str_vcf_path = f'{str_vcf_dir}/hail_filtered_{chrom}.vcf.bgz'
-            # run LD calculation for each chrom-celltype combination
-            ld_job = b.new_python_job(
-                f'LD calc for {celltype}:{chrom}',
-            )
-            ld_job.cpu(job_cpu)
-            ld_job.storage(job_storage)
-            snp_input = get_batch().read_input_group(**{'vcf': snp_vcf_path, 'tbi': snp_vcf_path + '.tbi'})
-            str_input = get_batch().read_input_group(**{'vcf': str_vcf_path, 'tbi': str_vcf_path + '.tbi'})
-
-            ld_job.call(
-                ld_parser,
-                snp_input,
-                str_input,
-                str_fdr_chrom,
-                celltype,
-                pval_cutoff,
-                associatr_dir,
-            )
-            manage_concurrency_for_job(ld_job)
+        str_fdrs[celltype] = str_fdr[
+            str_fdr['qval'] < fdr_cutoff
+        ]  # subset to eSTRs passing FDR 5% threshold by default
+    for chrom in chromosomes.split(','):
+        # filter eSTRs by chromosome
+        str_fdrs_chrom = {
+            celltype: str_fdr[str_fdr['chr'].str.contains("'" + chrom + "'")] for celltype, str_fdr in str_fdrs.items()
+        }
+        # read in STR and SNP VCFs for this chromosome
+        snp_vcf_path = f'{snp_vcf_dir}/hail_filtered_{chrom}.vcf.bgz'
+        str_vcf_path = f'{str_vcf_dir}/hail_filtered_{chrom}.vcf.bgz'
+        # run LD calculation for all cell types of this chromosome at once
+        ld_job = b.new_python_job(
+            f'LD calc for {chrom}',
+        )
+        ld_job.cpu(job_cpu)
+        ld_job.storage(job_storage)
+        snp_input = get_batch().read_input_group(**{'vcf': snp_vcf_path, 'tbi': snp_vcf_path + '.tbi'})
+        str_input = get_batch().read_input_group(**{'vcf': str_vcf_path, 'tbi': str_vcf_path + '.tbi'})
+
+        ld_job.call(
+            ld_parser,
+            snp_input,
+            str_input,
+            str_fdrs_chrom,
+            chrom,
+            pval_cutoff,
+            associatr_dir,
+            ld_shrinkage,
+            ld_block_size,
+            ld_dtype,
+            localise_modules=ship_modules(__file__, 'ld_store.py'),
+        )
+        manage_concurrency_for_job(ld_job)
 
     b.run(wait=False)
 
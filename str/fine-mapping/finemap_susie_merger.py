@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 """
-This script merges the output of FINEMAP and SUSIE into a single file per gene-celltype combination.
+This script merges the output of FINEMAP and SUSIE on the exact variant ID, into a single table per cell type
+(`susie_finemap/{celltype}_all_genes.tsv`, with the variants found by only one method in `{celltype}_unmatched.tsv`),
+and a table of all cell types (`susie_finemap/all_cell_types_all_genes.tsv`, unfiltered: the coloc scripts read the
+significant-only `all_cell_types_all_genes_sig_only.tsv` by default, which is not written here).
+
+With `--susie-finemap-dir`, the per-gene tables of `susie_finemap_runner.py` (SuSiE and FINEMAP run on the same inputs,
+and already merged) are concatenated into the same tables instead (without `{celltype}_unmatched.tsv`).
 
 analysis-runner --dataset "bioheart" --access-level 'test' --description "Merge FINEMAP and SUSIE results" \
 --image "australia-southeast1-docker.pkg.dev/analysis-runner/images/driver:d4922e3062565ff160ac2ed62dcdf2fba576b75a-hail-8f6797b033d2e102575c40166cf0c977e91f834e" \
@@ -23,40 +29,128 @@ from cpg_utils import to_path
 from cpg_utils.hail_batch import get_batch, output_path
 
 
-def run_concatenator(finemap_dir: str, susie_dir: str, celltype: str, chromosome: str, gene: str) -> None:
+def merge_gene(finemap_dir: str, susie_dir: str, celltype: str, chromosome: str, gene: str) -> tuple:
     """
-    Concatenate two dataframes together.
+    Merge the FINEMAP and SUSIE results of a gene on the exact variant ID (FINEMAP's rsid is SUSIE's varid).
+
+    Returns:
+        merged df, and df of the variants found by only one of the methods
     """
     import pandas as pd
 
-    from cpg_utils.hail_batch import output_path
-
     # read input files
     finemap_df = pd.read_csv(f'{finemap_dir}/{celltype}/{chromosome}/{gene}.snp', sep=' ')
     finemap_df = finemap_df[['rsid', 'beta', 'se', 'prob', 'log10bf']]
     finemap_df = finemap_df.rename(columns={'prob': 'finemap_prob', 'log10bf': 'finemap_log10bf'})
     susie_df = pd.read_csv(f'{susie_dir}/{celltype}/{chromosome}/{gene}_100kb.tsv', sep='\t')
 
-    # Create new columns with rounded values
-    susie_df['beta_rounded'] = susie_df['coeff_meta'].round(3)
-    susie_df['se_rounded'] = susie_df['se_meta'].round(3)
+    merged_df = susie_df.merge(finemap_df, left_on='varid', right_on='rsid', how='outer', indicator=True)
+    unmatched = merged_df.loc[merged_df['_merge'] != 'both', ['varid', 'rsid', '_merge']]
+    unmatched = pd.DataFrame(
+        {
+            'gene': gene,
+            'chr': chromosome,
+            'varid': unmatched['varid'].fillna(unmatched['rsid']),
+            'found_in': unmatched['_merge'].map({'left_only': 'susie', 'right_only': 'finemap'}),
+        },
+    )
+    merged_df = merged_df[merged_df['_merge'] == 'both'].drop(columns='_merge')
+    merged_df['gene'] = gene
+    merged_df['celltype'] = celltype
+    return merged_df, unmatched
 
-    finemap_df['beta_rounded'] = finemap_df['beta'].round(3)
-    finemap_df['se_rounded'] = finemap_df['se'].round(3)
 
-    # Merge on the new columns
-    merged_df = susie_df.merge(
-        finemap_df,
-        left_on=['varid', 'beta_rounded', 'se_rounded'],
-        right_on=['rsid', 'beta_rounded', 'se_rounded'],
-    )
+def run_concatenator(finemap_dir: str, susie_dir: str, celltype: str, chromosomes: list[str], max_workers: int = 16):
+    """
+    Merge the FINEMAP and SUSIE results of all genes of a cell type into one table, reading the gene files concurrently.
+    Variants found by only one of the methods are reported in a separate table.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    import pandas as pd
 
-    # drop the new columns as they are no longer needed
-    merged_df = merged_df.drop(columns=['beta_rounded', 'se_rounded'])
+    from cpg_utils import to_path
+    from cpg_utils.hail_batch import output_path
+
+    gene_keys = []
+    for chromosome in chromosomes:
+        # genes with both SUSIE and FINEMAP results
+        susie_genes = {
+            str(gene_file).split('/')[-1].split('_')[0]
+            for gene_file in to_path(f'{susie_dir}/{celltype}/{chromosome}').glob('*_100kb.tsv')
+        }
+        finemap_genes = {
+            str(gene_file).split('/')[-1].removesuffix('.snp')
+            for gene_file in to_path(f'{finemap_dir}/{celltype}/{chromosome}').glob('*.snp')
+        }
+        gene_keys.extend((chromosome, gene) for gene in sorted(susie_genes & finemap_genes))
+    if not gene_keys:
+        print(f'No genes with both SUSIE and FINEMAP results for {celltype}')
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(
+            executor.map(
+                lambda gene_key: merge_gene(finemap_dir, susie_dir, celltype, *gene_key),
+                gene_keys,
+            ),
+        )
+    merged_df = pd.concat([merged for merged, _ in results], ignore_index=True)
+    unmatched = pd.concat([unmatched for _, unmatched in results], ignore_index=True)
+    if not unmatched.empty:
+        print(f'{len(unmatched)} variants of {celltype} are only in one of SUSIE and FINEMAP results')
+
+    # write results as tsv files to gcp
+    merged_df.to_csv(output_path(f'susie_finemap/{celltype}_all_genes.tsv', 'analysis'), sep='\t', index=False)
+    unmatched.to_csv(output_path(f'susie_finemap/{celltype}_unmatched.tsv', 'analysis'), sep='\t', index=False)
+
+
+def concatenate_merged(susie_finemap_dir: str, celltype: str, chromosomes: list[str], max_workers: int = 16):
+    """
+    Concatenate the per-gene merged SUSIE and FINEMAP results of susie_finemap_runner.py of all genes of a cell type
+    into one table, reading the gene files concurrently
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    import pandas as pd
+
+    from cpg_utils import to_path
+    from cpg_utils.hail_batch import output_path
+
+    gene_files = [
+        str(gene_file)
+        for chromosome in chromosomes
+        for gene_file in sorted(to_path(f'{susie_finemap_dir}/{celltype}/{chromosome}').glob('*.tsv'))
+    ]
+    if not gene_files:
+        print(f'No merged SUSIE and FINEMAP results for {celltype}')
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        merged_df = pd.concat(
+            executor.map(lambda gene_file: pd.read_csv(gene_file, sep='\t'), gene_files),
+            ignore_index=True,
+        )
+    merged_df.to_csv(output_path(f'susie_finemap/{celltype}_all_genes.tsv', 'analysis'), sep='\t', index=False)
+
+
+def combine_celltypes(celltypes: list[str]):
+    """
+    Concatenate the merged tables of all cell types (all fine-mapped genes, without any significance filter)
+    """
+    import pandas as pd
+
+    from cpg_utils import to_path
+    from cpg_utils.hail_batch import output_path
 
-    # write results as a tsv file to gcp
-    merged_df.to_csv(
-        output_path(f'susie_finemap/{celltype}/{chromosome}/{gene}.tsv', 'analysis'),
+    celltype_files = [output_path(f'susie_finemap/{celltype}_all_genes.tsv', 'analysis') for celltype in celltypes]
+    celltype_files = [celltype_file for celltype_file in celltype_files if to_path(celltype_file).exists()]
+    if not celltype_files:
+        print('No merged SUSIE and FINEMAP results')
+        return
+    combined = pd.concat([pd.read_csv(celltype_file, sep='\t') for celltype_file in celltype_files], ignore_index=True)
+    combined.to_csv(
+        output_path('susie_finemap/all_cell_types_all_genes.tsv', 'analysis'),
         sep='\t',
         index=False,
     )
@@ -64,15 +158,20 @@ def run_concatenator(finemap_dir: str, susie_dir: str, celltype: str, chromosome
 
 @click.option('--finemap-dir', help='Input directory for the FINEMAP .snp files')
 @click.option('--susie-dir', help='Input directory for the susie output .tsv files')
+@click.option(
+    '--susie-finemap-dir',
+    help='Input directory for the merged susie_finemap_runner.py .tsv files (instead of --finemap-dir/--susie-dir)',
+)
 @click.option('--celltypes', help='comma-separated list of cell types')
 @click.option('--chromosomes', help='comma-separated list of chromosomes')
-@click.option('--max-parallel-jobs', help='Maximum number of jobs to run in parallel', default=500)
-@click.option('--job-cpu', help='Number of CPUs to use for each job', default=0.25)
+@click.option('--max-parallel-jobs', help='Maximum number of jobs to run in parallel', default=50)
+@click.option('--job-cpu', help='Number of CPUs to use for each job', default=1)
 @click.option('--always-run', help='Job set to always run', is_flag=True)
 @click.command()
 def main(
     finemap_dir: str,
     susie_dir: str,
+    susie_finemap_dir: str,
     celltypes: str,
     chromosomes: str,
     max_parallel_jobs: int,
@@ -94,24 +193,26 @@ def main(
         _dependent_jobs.append(job)
 
     b = get_batch(name='Merge FINEMAP and SUSIE results')
+    merge_jobs = []
     for celltype in celltypes.split(','):
-        for chromosome in chromosomes.split(','):
-            # gets the list of available gene files in input dir 1
-            gene_files = list(map(str, to_path(f'{susie_dir}/{celltype}/{chromosome}').glob('*.tsv')))
-            for gene_file in gene_files:
-                # see if the gene file exists in input dir 2. If it does, concatenate the two files together.
-                gene = gene_file.split('/')[-1].split('_')[0]
-                finemap_file_name = gene + '.snp'
-                if to_path(f'{finemap_dir}/{celltype}/{chromosome}/{finemap_file_name}').exists():
-                    # see if output file exists. If it does, skip this job
-                    if to_path(output_path(f'susie_finemap/{celltype}/{chromosome}/{gene}.tsv', 'analysis')).exists():
-                        continue
-                    j = b.new_python_job(name=f'Merge SUSIE and FINEMAP results for {celltype}_{chromosome}_{gene}')
-                    j.cpu(job_cpu)
-                    if always_run:
-                        j.always_run()
-                    j.call(run_concatenator, finemap_dir, susie_dir, celltype, chromosome, gene)
-                    manage_concurrency_for_job(j)
+        # see if output file exists. If it does, skip this cell type
+        if to_path(output_path(f'susie_finemap/{celltype}_all_genes.tsv', 'analysis')).exists():
+            continue
+        j = b.new_python_job(name=f'Merge SUSIE and FINEMAP results for {celltype}')
+        j.cpu(job_cpu)
+        if always_run:
+            j.always_run()
+        if susie_finemap_dir:
+            j.call(concatenate_merged, susie_finemap_dir, celltype, chromosomes.split(','))
+        else:
+            j.call(run_concatenator, finemap_dir, susie_dir, celltype, chromosomes.split(','))
+        manage_concurrency_for_job(j)
+        merge_jobs.append(j)
+
+    # one table of all cell types
+    combine_job = b.new_python_job(name='Combine SUSIE and FINEMAP results of all cell types')
+    combine_job.depends_on(*merge_jobs)
+    combine_job.call(combine_celltypes, celltypes.split(','))
     b.run(wait=False)
 
 
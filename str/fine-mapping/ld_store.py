@@ -0,0 +1,107 @@
+"""
+Binary LD matrix store shared by the fine-mapping scripts.
+
+Each LD matrix is stored as a full square matrix in `{prefix}.npy` (float32, or float16 to halve the size),
+with the variant IDs of its rows/columns in `{prefix}_variants.tsv` (one `varid` column, in matrix order).
+Matrices are read back memory-mapped (or, in a bucket, row by row from the stream), so that only the entries that are
+used are read.
+
+LD does not depend on the cell type, so one matrix is stored per gene (under `SHARED_LD_DIR`) over the union of the
+variants of all cell types. Each cell type only stores a variant index (`{prefix}_variants.tsv`, without a matrix),
+which is used to subset the shared matrix.
+"""
+
+import numpy as np
+import pandas as pd
+
+from cpg_utils import to_path
+
+SHARED_LD_DIR = 'all_celltypes'
+
+
+def write_ld_matrix(prefix: str, corr: np.ndarray, variant_ids: list[str], dtype: str = 'float32'):
+    """
+    Write an LD matrix and its variant index to `{prefix}.npy` and `{prefix}_variants.tsv`
+    """
+    if corr.shape != (len(variant_ids), len(variant_ids)):
+        raise ValueError(f'LD matrix of shape {corr.shape} does not match {len(variant_ids)} variant IDs')
+    with to_path(f'{prefix}.npy').open('wb') as f:
+        np.save(f, np.asarray(corr, dtype=dtype))
+    write_ld_variants(prefix, variant_ids)
+
+
+def read_ld_variants(prefix: str) -> list[str]:
+    """
+    Read the variant IDs (in matrix order) of a stored LD matrix
+    """
+    return pd.read_csv(to_path(f'{prefix}_variants.tsv'), sep='\t')['varid'].tolist()
+
+
+def write_ld_variants(prefix: str, variant_ids: list[str]):
+    """
+    Write a variant index on its own (ie a cell type's subset of a shared LD matrix) to `{prefix}_variants.tsv`
+    """
+    pd.DataFrame({'varid': variant_ids}).to_csv(to_path(f'{prefix}_variants.tsv'), sep='\t', index=False)
+
+
+def read_npy_rows(f, rows: np.ndarray) -> np.ndarray:
+    """
+    Read the given rows of a 2D .npy matrix from a seekable file object, one contiguous read per row
+    (LD matrices are symmetric, so rows are read as stored whatever the memory order)
+    """
+    major, _ = np.lib.format.read_magic(f)
+    read_header = np.lib.format.read_array_header_1_0 if major == 1 else np.lib.format.read_array_header_2_0
+    shape, _, dtype = read_header(f)
+    offset = f.tell()
+    row_bytes = shape[1] * dtype.itemsize
+    matrix = np.empty((len(rows), shape[1]), dtype=dtype)
+    for i, row in enumerate(rows):
+        f.seek(offset + int(row) * row_bytes)
+        matrix[i] = np.frombuffer(f.read(row_bytes), dtype=dtype)
+    return matrix
+
+
+def read_ld_matrix(prefix: str, variant_ids: list[str] | None = None) -> tuple[np.ndarray, list[str]]:
+    """
+    Read a stored LD matrix, returning it with its variant IDs.
+    Local matrices are memory-mapped; matrices in a bucket are read from the stream (nothing is copied to local disk).
+    If `variant_ids` is given, only the rows/columns of those variants (in that order) are read.
+    """
+    path = f'{prefix}.npy'
+    matrix_ids = read_ld_variants(prefix)
+    index = None
+    if variant_ids is not None:
+        index = pd.Index(matrix_ids).get_indexer(variant_ids)
+        if (index < 0).any():
+            raise ValueError(f'{(index < 0).sum()} variants are not in the LD matrix {prefix}')
+    if path.startswith('gs://'):
+        with to_path(path).open('rb') as f:
+            if index is None:
+                return np.load(f), matrix_ids
+            return read_npy_rows(f, index)[:, index], list(variant_ids)
+    matrix = np.load(path, mmap_mode='r')
+    if index is None:
+        return matrix, matrix_ids
+    return matrix[np.ix_(index, index)], list(variant_ids)
+
+
+def load_gene_inputs(ld_dir: str, associatr_dir: str, celltype: str, chrom: str, gene: str) -> tuple:
+    """
+    Load a gene's LD matrix (subset to the cell type's variants) and its associaTR results, in LD matrix order
+
+    Returns:
+        associaTR results (with varid), LD matrix, and sample size
+    """
+    ld_ids = read_ld_variants(f'{ld_dir}/{celltype}/{chrom}/{gene}_correlation_matrix')
+    ld_matrix, _ = read_ld_matrix(f'{ld_dir}/{SHARED_LD_DIR}/{chrom}/{gene}_correlation_matrix', ld_ids)
+
+    associatr = pd.read_csv(f'{associatr_dir}/{celltype}/{chrom}/{gene}_100000bp_meta_results.tsv', sep='\t')
+    associatr['varid'] = associatr['chr'] + ':' + associatr['pos'].astype(str) + '_' + associatr['motif']
+    # order the associaTR results as the LD matrix (first match of each variant)
+    associatr = associatr.drop_duplicates('varid').set_index('varid', drop=False).reindex(ld_ids).reset_index(drop=True)
+    # sample size: loci missing from the results (or from a cohort) are NaN, so take the largest total over loci
+    n_samples = associatr.filter(like='n_samples_tested_').sum(axis=1, min_count=1)
+    if n_samples.isna().all():
+        raise ValueError(f'No sample sizes in the associaTR results of {gene} ({celltype}, {chrom})')
+    n = int(n_samples.max())
+    return associatr, np.asarray(ld_matrix, dtype=np.float64), n
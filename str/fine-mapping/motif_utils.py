@@ -0,0 +1,56 @@
+"""
+Shared STR motif helpers, so that every STR-aware comparison uses the same definition of motif identity.
+
+- `reverse_complement`: complement via `str.translate` (non-ACGT characters are kept as they are)
+- `canonical_motif`: minimal rotation over the motif and its reverse complement (eg 'TA', 'AT' -> 'AT'; 'CAG', 'CTG' -> 'AGC')
+- `is_whole_copy`: whether a sequence is a whole number of copies of a cyclical representation of a motif,
+  on either strand (eg 'TAT' for 'ATT', but not 'GC' for 'CAG')
+
+Results are memoised, as the same few motifs are compared many times.
+"""
+
+from functools import lru_cache
+
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def reverse_complement(sequence: str) -> str:
+    """
+    Return the reverse complement of a DNA sequence.
+    """
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def cyclical_shifts(s: str) -> list[str]:
+    """
+    Generate all cyclical shifts of a string.
+    """
+    return [s[i:] + s[:i] for i in range(len(s))]
+
+
+@lru_cache(maxsize=None)
+def canonical_motif(motif: str) -> str:
+    """
+    Canonical form of a motif: the lexicographically smallest rotation of the motif or its reverse complement
+    """
+    return min(cyclical_shifts(motif) + cyclical_shifts(reverse_complement(motif)), default=motif)
+
+
+@lru_cache(maxsize=None)
+def whole_copy_rotations(motif: str, n_copies: int) -> frozenset[str]:
+    """
+    All cyclical representations of `n_copies` copies of a motif, on either strand
+    """
+    return frozenset(cyclical_shifts(motif * n_copies)) | frozenset(
+        cyclical_shifts(reverse_complement(motif) * n_copies),
+    )
+
+
+def is_whole_copy(sequence: str, motif: str) -> bool:
+    """
+    Checks if a sequence is a whole copy (or a whole number of copies) of a cyclical representation of a motif,
+    on either strand
+    """
+    if not motif or len(sequence) % len(motif) != 0:
+        return False
+    return sequence in whole_copy_rotations(motif, len(sequence) // len(motif))
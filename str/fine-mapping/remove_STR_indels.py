@@ -15,7 +15,7 @@ e.g. a 'TAT' insertion overlapping with a 'ATT' STR would be considered an STR a
 
 Note that impure indels are conservatively not considered STRs. For example, a 'GCCGCA' insertion overlapping a 'GCC' STR would not be considered an STR.
 
-This script additionally removes duplicate eSTRs (defined by sharing the same coordinates and motif), retaining only one eSTR per duplicate set (chosen based on having the lowest p-value).
+This script additionally removes duplicate eSTRs (defined by sharing the same coordinates and motif, compared by canonical motif (`motif_utils.py`) so that rotations and the reverse strand match), retaining only one eSTR per duplicate set (chosen based on having the lowest p-value).
 
 Usage:
 
@@ -32,6 +32,8 @@ remove_STR_indels.py \
 
 """
 import ast
+import sys
+from pathlib import Path
 
 import click
 import numpy as np
@@ -42,104 +44,107 @@ from hailtop.batch import ResourceGroup
 from cpg_utils.config import output_path
 from cpg_utils.hail_batch import get_batch
 
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
 
-def check_str(motif):
-    """
-    Checks if a row in a df represents an STR (i.e. the motif does not contain a '-')
-    """
-    return '-' not in motif
 
-
-def reverse_complement(sequence):
+def str_indel_rows(result_df):
     """
-    Return the reverse complement of a DNA sequence.
+    Find the rows of indels representing STRs.
+    Each indel is compared to the first STR (in row order) whose interval [pos, end] contains the indel position.
 
+    Returns:
+        index labels of the indels to drop
     """
-    complement_dict = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-    reverse_sequence = sequence[::-1]
-    reverse_complement_sequence = ''.join(complement_dict.get(base, base) for base in reverse_sequence)
-    return reverse_complement_sequence
-
-
-def cyclical_shifts(s):
+    from motif_utils import is_whole_copy
+
+    motifs = result_df['motif'].to_numpy(dtype=str)
+    positions = result_df['pos'].to_numpy()
+    is_str = np.array(['-' not in motif for motif in motifs], dtype=bool)
+    # indels: non-STRs that are not single base changes
+    is_indel = np.array(
+        [
+            not str_row and any(len(part) != 1 for part in motif.split('-')[:2])
+            for motif, str_row in zip(motifs, is_str)
+        ],
+        dtype=bool,
+    )
+    str_rows = np.flatnonzero(is_str)
+    indel_rows = np.flatnonzero(is_indel)
+    if len(str_rows) == 0 or len(indel_rows) == 0:
+        return []
+
+    # sort the STR intervals once by start
+    str_starts = positions[str_rows]
+    str_ends = str_starts + (result_df['ref_len'].to_numpy() * result_df['period'].to_numpy())[str_rows]
+    order = np.argsort(str_starts, kind='stable')
+    str_rows, str_starts, str_ends = str_rows[order], str_starts[order], str_ends[order]
+
+    # candidate STRs of an indel start within the longest STR interval before it
+    indel_pos = positions[indel_rows]
+    max_len = np.nanmax(str_ends - str_starts)
+    lo = np.searchsorted(str_starts, indel_pos - max_len, side='left')
+    hi = np.searchsorted(str_starts, indel_pos, side='right')
+    counts = hi - lo
+    pair_indel = np.repeat(np.arange(len(indel_rows)), counts)
+    pair_str = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    # keep overlapping candidates, then the first STR in row order for each indel
+    overlapping = str_ends[pair_str] >= indel_pos[pair_indel]
+    pair_indel, pair_str = pair_indel[overlapping], pair_str[overlapping]
+    first_str = np.full(len(indel_rows), np.iinfo(np.int64).max)
+    np.minimum.at(first_str, pair_indel, str_rows[pair_str])
+    matched = np.flatnonzero(first_str != np.iinfo(np.int64).max)
+
+    to_delete = []
+    for indel_i in matched:
+        row = indel_rows[indel_i]
+        # Split the motif to find the indel
+        indel = next(part for part in motifs[row].split('-') if len(part) != 1)[1:]
+        if is_whole_copy(indel, motifs[first_str[indel_i]]):
+            to_delete.append(result_df.index[row])
+    return to_delete
+
+
+def filter_gene_file(gene_file, celltype, chrom):
     """
-    Generate all cyclical shifts of a string.
+    Remove duplicate eSTRs and indels representing STRs from one gene's associaTR output
     """
-    return [s[i:] + s[:i] for i in range(len(s))]
+    import pandas as pd
+    from motif_utils import canonical_motif
 
+    data = pd.read_csv(str(gene_file), sep='\t')
+    gene_file_name = str(gene_file).split('/')[-1]
+    print(f'Processing {gene_file_name}...')
 
-def filter_str_indels_and_duplicates(associatr_dir, celltype, chrom):
-    import pandas as pd
+    # STR motifs are compared by their canonical form (SNP/indel 'REF-ALT' motifs as they are)
+    data['motif_key'] = [motif if '-' in motif else canonical_motif(motif) for motif in data['motif'].astype(str)]
+    # Find duplicate eSTRs and remove all but the one with the lowest p-value
+    duplicates = data[data.duplicated(subset=['chr', 'pos', 'motif_key'], keep=False)]
+    # Group by 'chr', 'pos', motif and keep the one with the lowest 'p-val'
+    lowest_pval_duplicates = duplicates.loc[duplicates.groupby(['chr', 'pos', 'motif_key'])['pval_meta'].idxmin()]
+    # Find non-duplicate rows
+    non_duplicates = data.drop(duplicates.index)
+    # Concatenate the non-duplicates with the lowest p-value duplicates
+    result_df = pd.concat([non_duplicates, lowest_pval_duplicates]).sort_index().drop(columns='motif_key')
+
+    # Drop the rows where indels are representing STRs
+    result_df = result_df.drop(str_indel_rows(result_df))
+    result_df.to_csv(output_path(f'{celltype}/{chrom}/{gene_file_name}', 'analysis'), sep='\t', index=False)
+
+
+def filter_str_indels_and_duplicates(associatr_dir, celltype, chrom, max_workers=8, *, localise_modules):
+    from concurrent.futures import ThreadPoolExecutor
 
     from cpg_utils import to_path
 
-    # Load associaTR output
+    # motif_utils.py, shipped with the job
+    localise_modules()
+
+    # Load associaTR output, processing gene files in parallel
     gene_files = list(to_path(f'{associatr_dir}/{celltype}/{chrom}').glob('*.tsv'))
-    for gene_file in gene_files:
-        data = pd.read_csv(str(gene_file), sep='\t')
-        gene_file_name = str(gene_file).split('/')[-1]
-        print(f'Processing {gene_file_name}...')
-
-        # Find duplicate eSTRs and remove all but the one with the lowest p-value
-        duplicates = data[data.duplicated(subset=['chr', 'pos', 'motif'], keep=False)]
-        # Group by 'chr', 'pos', 'motif' and keep the one with the lowest 'p-val'
-        lowest_pval_duplicates = duplicates.loc[duplicates.groupby(['chr', 'pos', 'motif'])['pval_meta'].idxmin()]
-        # Find non-duplicate rows
-        non_duplicates = data.drop(duplicates.index)
-        # Concatenate the non-duplicates with the lowest p-value duplicates
-        result_df = pd.concat([non_duplicates, lowest_pval_duplicates]).sort_index()
-
-        # get df containing only STRs
-        result_df_str = result_df[result_df['motif'].apply(check_str)]
-        result_df_str.loc[:, 'end'] = (
-            result_df_str.loc[:, 'pos'] + result_df_str.loc[:, 'ref_len'] * result_df_str.loc[:, 'period']
-        )
-
-        indices_to_delete = []  # store indices of indels representing STRs (to drop later)
-        for i, row1 in result_df.iterrows():  # iterate through every variant record in df
-            if '-' not in row1['motif']:  # skip if STR
-                continue
-            parts = row1['motif'].split('-')
-            if len(parts[0]) == 1 and len(parts[1]) == 1:  # skip if SNP (single base change)
-                continue
-
-            pos_indel = row1['pos']
-            # Split the motif to find the indel
-            motif_parts = row1['motif'].split('-')
-
-            indel = next((part for part in motif_parts if len(part) != 1), None)[1:]
-
-            found = False
-            for j, row2 in result_df_str.iterrows():
-                if (
-                    row2['pos'] <= pos_indel <= row2['end']
-                ):  # Check if pos_indel is between 'pos' and 'end' of any row in STR dataframe
-                    str_motif = row2['motif']
-
-                    if (indel == str_motif) or (
-                        reverse_complement(indel) == str_motif
-                    ):  # straightforward case where (reverse complement of) indel matches STR motif exactly
-                        # print(f"Indel: {row1['motif']} {indel} matches motif {str_motif}")
-                        indices_to_delete.append(i)
-                        found = True
-                        break
-
-                    if len(indel) % len(str_motif) == 0:  # check if len(indel) is a multiple of len(str_motif)
-                        elongated_motif = str_motif * (len(indel) // len(str_motif))
-                        if (indel in cyclical_shifts(elongated_motif)) or (
-                            reverse_complement(indel) in cyclical_shifts(elongated_motif)
-                        ):
-                            indices_to_delete.append(i)
-                            found = True
-                            break
-
-                    found = True
-                    break
-            # if not found:
-            # print("Indel not in STR interval")
-        # Drop the rows where indels are representing STRs
-        result_df = result_df.drop(indices_to_delete)
-        result_df.to_csv(output_path(f'{celltype}/{chrom}/{gene_file_name}', 'analysis'), sep='\t', index=False)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda gene_file: filter_gene_file(gene_file, celltype, chrom), gene_files))
 
 
 @click.option('--associatr-dir', required=True, type=str, help='Directory containing associaTR outputs.')
@@ -154,6 +159,13 @@ def filter_str_indels_and_duplicates(associatr_dir, celltype, chrom):
 )
 @click.option('--job-cpu', required=False, type=float, help='Number of CPUs to use per job.', default=0.25)
 @click.option('--job-storage', required=False, type=str, help='Storage to use per job.', default='0G')
+@click.option(
+    '--max-workers',
+    required=False,
+    type=int,
+    help='Number of gene files processed in parallel per job.',
+    default=8,
+)
 @click.command()
 def main(
     associatr_dir: str,
@@ -162,6 +174,7 @@ def main(
     max_parallel_jobs: int,
     job_cpu: int,
     job_storage: str,
+    max_workers: int,
 ):
     # Setup MAX concurrency by genes
     _dependent_jobs: list[hb.batch.job.Job] = []
@@ -183,7 +196,14 @@ def main(
             filter_job.cpu(job_cpu)
             filter_job.storage(job_storage)
 
-            filter_job.call(filter_str_indels_and_duplicates, associatr_dir, celltype, chrom)
+            filter_job.call(
+                filter_str_indels_and_duplicates,
+                associatr_dir,
+                celltype,
+                chrom,
+                max_workers,
+                localise_modules=ship_modules(__file__, 'motif_utils.py'),
+            )
             manage_concurrency_for_job(filter_job)
 
     b.run(wait=False)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+"""
+This script runs SuSiE-RSS (`susie_rss.py`) and FINEMAP on the same load of each gene's LD matrix and summary statistics,
+and merges their results by variant ID into a single file per gene-celltype combination
+(as `finemap_susie_merger.py`, without the separately produced FINEMAP inputs and outputs).
+
+Required inputs:
+- output from`corr_matrix_maker.py` (ie LD matrix shared by all cell types, stored as binary .npy, see ld_store.py)
+- associaTR raw outputs (eSNPs and eSTRs combined), preferably also run with `remove_STR_indels.py`.
+- FINEMAP (v1.4) executable, either on the image or localised from `--finemap-binary`.
+
+FINEMAP inputs (.z, text .ld and master files; see `run_finemap` for why not .bcor) are written from memory to the job's
+local disk, with each variant's MAF pooled from the associaTR allele frequencies. A gene for which FINEMAP fails is
+logged and skipped (and rerun by the next run). The per-gene tables (`susie_finemap/{celltype}/{chrom}/{gene}.tsv`) are concatenated per cell type by
+`finemap_susie_merger.py --susie-finemap-dir`.
+
+analysis-runner --dataset "bioheart" \
+    --description "Run SuSiE and FINEMAP for eGenes identified by STR analysis" \
+    --access-level "test" \
+    --image "australia-southeast1-docker.pkg.dev/analysis-runner/images/driver:d4922e3062565ff160ac2ed62dcdf2fba576b75a-hail-8f6797b033d2e102575c40166cf0c977e91f834e" \
+    --output-dir "str/associatr/fine_mapping/v2" \
+    susie_finemap_runner.py \
+    --celltypes "CD4_TCM" \
+    --chromosomes "chr22" \
+    --ld-dir "gs://cpg-bioheart-test-analysis/str/associatr/fine_mapping/prep_files/v2/correlation_matrix" \
+    --associatr-dir "gs://cpg-bioheart-test/str/associatr/snps_and_strs/rm_str_indels_dup_strs/tob_n1055_and_bioheart_n990/meta_results" \
+    --finemap-binary "gs://cpg-bioheart-test/str/finemap/finemap_v1.4.2_x86_64"
+"""
+
+import sys
+from pathlib import Path
+
+import click
+
+import hailtop.batch as hb
+
+from cpg_utils import to_path
+from cpg_utils.hail_batch import get_batch, output_path
+
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
+
+
+def minor_allele_frequency(associatr):
+    """
+    Minor allele frequency of each variant (1 - the frequency of its most common allele, so that multi-allelic STRs are
+    covered), from the associaTR allele frequencies ('{allele: frequency}') of each cohort, weighted by sample size.
+    FINEMAP needs a MAF in (0, 0.5] for every variant: values are clipped to it, and variants without frequencies get 0.5.
+    """
+    import ast
+
+    import numpy as np
+
+    def parse_maf(frequencies):
+        try:
+            return 1 - max(ast.literal_eval(frequencies).values())
+        except (ValueError, SyntaxError, TypeError, AttributeError):
+            return np.nan
+
+    weighted_maf = np.zeros(len(associatr))
+    total_weight = np.zeros(len(associatr))
+    for column in associatr.filter(like='allele_frequency').columns:
+        maf = associatr[column].map(parse_maf).to_numpy(dtype=float)
+        n_column = column.replace('allele_frequency', 'n_samples_tested')
+        weight = associatr[n_column].to_numpy(dtype=float) if n_column in associatr else np.ones(len(associatr))
+        weight = np.where(np.isnan(maf) | np.isnan(weight), 0, weight)
+        weighted_maf += weight * np.nan_to_num(maf)
+        total_weight += weight
+    with np.errstate(divide='ignore', invalid='ignore'):
+        maf = weighted_maf / total_weight
+    return np.clip(np.nan_to_num(maf, nan=0.5), 1e-6, 0.5)
+
+
+def run_finemap(
+    finemap_binary: str,
+    work_dir: str,
+    gene: str,
+    associatr,
+    ld_matrix,
+    n: int,
+    num_causal_variants: int,
+):
+    """
+    Write the FINEMAP inputs of a gene from memory, run FINEMAP (shotgun stochastic search) and read its .snp output
+    (None if FINEMAP fails for this gene, so that the other genes of the job are still fine-mapped)
+    """
+    import os
+    import subprocess
+
+    import numpy as np
+    import pandas as pd
+
+    prefix = f'{work_dir}/{gene}'
+    # SNPs carry their alleles in the variant ID ('REF-ALT' motif); STRs are multi-allelic, so they are labelled by
+    # their motif (FINEMAP only reports the allele labels)
+    alleles = associatr['motif'].str.partition('-')
+    is_snp = alleles[1] == '-'
+    z_df = pd.DataFrame(
+        {
+            'rsid': associatr['varid'],
+            'chromosome': associatr['chr'].str.removeprefix('chr'),
+            'position': associatr['pos'],
+            'allele1': np.where(is_snp, alleles[0], associatr['motif']),
+            'allele2': np.where(is_snp, alleles[2], 'N'),
+            'maf': minor_allele_frequency(associatr),
+            'beta': associatr['coeff_meta'],
+            'se': associatr['se_meta'],
+        },
+    )
+    z_df.to_csv(f'{prefix}.z', sep=' ', index=False)
+    ld = np.nan_to_num(ld_matrix)
+    np.fill_diagonal(ld, 1)
+    # FINEMAP reads LD either as this text matrix or as LDstore's .bcor, whose layout is only written by LDstore
+    # (a hand-written .bcor that FINEMAP misreads would silently fine-map with the wrong LD); the text file is local
+    # and removed after the run, and '%.9g' writes the stored (float32) correlations without loss
+    np.savetxt(f'{prefix}.ld', ld, fmt='%.9g', delimiter=' ')
+    with open(f'{prefix}.master', 'w') as f:
+        f.write('z;ld;snp;config;cred;log;n_samples\n')
+        f.write(f'{prefix}.z;{prefix}.ld;{prefix}.snp;{prefix}.config;{prefix}.cred;{prefix}.log;{n}\n')
+
+    try:
+        subprocess.run(
+            [
+                finemap_binary,
+                '--sss',
+                '--in-files',
+                f'{prefix}.master',
+                '--n-causal-snps',
+                str(num_causal_variants),
+                '--n-threads',
+                '1',
+                '--log',
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+    except subprocess.CalledProcessError as error:
+        print(f'FINEMAP failed for {gene} (exit code {error.returncode}): {error.stderr.strip()[-1000:]}')
+        return None
+    finally:
+        for suffix in ['z', 'ld', 'master']:
+            os.remove(f'{prefix}.{suffix}')
+    return pd.read_csv(f'{prefix}.snp', sep=' ')
+
+
+def susie_finemap_runner(
+    ld_dir,
+    associatr_dir,
+    celltype,
+    chrom,
+    genes,
+    finemap_binary,
+    num_iterations,
+    num_causal_variants,
+    max_workers,
+    *,
+    localise_modules,
+):
+    import os
+    import stat
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from functools import partial
+
+    # ld_store.py and susie_rss.py, shipped with the job
+    localise_modules()
+    from ld_store import load_gene_inputs
+    from susie_rss import summary_vars, susie_get_pip, susie_rss
+
+    from cpg_utils.hail_batch import output_path
+
+    if os.path.exists(finemap_binary):
+        os.chmod(finemap_binary, os.stat(finemap_binary).st_mode | stat.S_IXUSR)
+    work_dir = tempfile.mkdtemp()
+    fit_gene = partial(susie_rss, var_y=1, L=num_causal_variants, max_iter=num_iterations)
+    # SuSiE fits and FINEMAP runs (one single-threaded process each) run side by side, so they share the job's CPUs
+    susie_workers = max(1, max_workers // 2)
+    finemap_workers = max(1, max_workers - susie_workers)
+    with ProcessPoolExecutor(max_workers=susie_workers) as susie_executor, ThreadPoolExecutor(
+        max_workers=finemap_workers,
+    ) as finemap_executor:
+        # load genes in batches, to bound the number of LD matrices held in memory at once
+        for start in range(0, len(genes), 4 * max_workers):
+            batch_genes = genes[start : start + 4 * max_workers]
+            # each gene's LD matrix and summary statistics are loaded once, and used by both methods
+            inputs = [load_gene_inputs(ld_dir, associatr_dir, celltype, chrom, gene) for gene in batch_genes]
+            susie_fits = susie_executor.map(
+                fit_gene,
+                [associatr['coeff_meta'].to_numpy() for associatr, _, _ in inputs],
+                [associatr['se_meta'].to_numpy() for associatr, _, _ in inputs],
+                [n for _, _, n in inputs],
+                [ld_matrix for _, ld_matrix, _ in inputs],
+            )
+            finemap_dfs = finemap_executor.map(
+                lambda gene_inputs: run_finemap(finemap_binary, work_dir, *gene_inputs, num_causal_variants),
+                [(gene, associatr, ld_matrix, n) for gene, (associatr, ld_matrix, n) in zip(batch_genes, inputs)],
+            )
+            for gene, (associatr, _, _), fit, finemap_df in zip(batch_genes, inputs, susie_fits, finemap_dfs):
+                if finemap_df is None:
+                    print(f'No FINEMAP results for {gene}: skipping....')
+                    continue
+                associatr['susie_pip'] = susie_get_pip(fit, prune_by_cs=True)
+                associatr['variable_prob'], associatr['cs'] = summary_vars(fit)
+
+                # merge on the exact variant ID (FINEMAP's rsid)
+                finemap_df = finemap_df[['rsid', 'beta', 'se', 'prob', 'log10bf']]
+                finemap_df = finemap_df.rename(columns={'prob': 'finemap_prob', 'log10bf': 'finemap_log10bf'})
+                merged_df = associatr.merge(finemap_df, left_on='varid', right_on='rsid')
+                # as finemap_susie_merger.py's per-gene tables, which it concatenates per cell type
+                merged_df['gene'] = gene
+                merged_df['celltype'] = celltype
+
+                # write results as a tsv file to gcp
+                merged_df.to_csv(
+                    output_path(f'susie_finemap/{celltype}/{chrom}/{gene}.tsv', 'analysis'),
+                    sep='\t',
+                    index=False,
+                )
+                print(f'Fine-mapped {gene}')
+
+
+@click.option('--celltypes', help='Cell types comma separated')
+@click.option('--chromosomes', help='Chromosomes comma separated')
+@click.option('--ld-dir', help='Directory to LD correlation matrices')
+@click.option('--associatr-dir', help='Directory to associatr outputs')
+@click.option(
+    '--finemap-binary',
+    help='GCS path to the FINEMAP executable (default: FINEMAP on the image PATH)',
+    default=None,
+)
+@click.option('--max-parallel-jobs', help='Maximum number of parallel jobs', default=500)
+@click.option('--num_iterations', help='Number of iterations for SuSiE', default=100)
+@click.option('--job-cpu', help='CPU for each job (genes are fitted in one process per CPU)', default=4)
+@click.option('--num-causal-variants', help='Number of causal variants to estimate', default=10)
+@click.option('--always-run', help='Job set to always run', is_flag=True)
+@click.command()
+def main(
+    celltypes,
+    chromosomes,
+    ld_dir,
+    associatr_dir,
+    finemap_binary,
+    max_parallel_jobs,
+    num_iterations,
+    job_cpu,
+    num_causal_variants,
+    always_run,
+):
+    # Setup MAX concurrency by genes
+    _dependent_jobs: list[hb.batch.job.Job] = []
+
+    def manage_concurrency_for_job(job: hb.batch.job.Job):
+        """
+        To avoid having too many jobs running at once, we have to limit concurrency.
+        """
+        if len(_dependent_jobs) >= max_parallel_jobs:
+            job.depends_on(_dependent_jobs[-max_parallel_jobs])
+        _dependent_jobs.append(job)
+
+    b = get_batch(name='Run SuSiE and FINEMAP')
+
+    for celltype in celltypes.split(','):
+        for chrom in chromosomes.split(','):
+            ld_files = list(to_path(f'{ld_dir}/{celltype}/{chrom}').glob('*_variants.tsv'))
+            genes = []
+            for ld_file in ld_files:
+                gene = str(ld_file).split('/')[-1].split('_')[0]
+                # see if output file exists. If it does, skip this gene
+                if to_path(output_path(f'susie_finemap/{celltype}/{chrom}/{gene}.tsv', 'analysis')).exists():
+                    continue
+                genes.append(gene)
+            if not genes:
+                continue
+
+            j = b.new_python_job(name=f'SuSiE and FINEMAP for {chrom}: {celltype}')
+            j.cpu(job_cpu)
+            if always_run:
+                j.always_run()
+            j.call(
+                susie_finemap_runner,
+                ld_dir,
+                associatr_dir,
+                celltype,
+                chrom,
+                genes,
+                b.read_input(finemap_binary) if finemap_binary else 'finemap',
+                num_iterations,
+                num_causal_variants,
+                max(1, int(job_cpu)),
+                localise_modules=ship_modules(__file__, 'ld_store.py', 'susie_rss.py'),
+            )
+            manage_concurrency_for_job(j)
+    b.run(wait=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+"""
+NumPy implementation of SuSiE-RSS (the IBSS algorithm on summary statistics), following susieR's
+`susie_rss(bhat, shat, n, R, var_y)` with its default settings: residual variance fixed at var_y,
+prior variances estimated per effect (optimised on the log scale, with a null check),
+credible sets at 95% coverage with a minimum absolute correlation (purity) of 0.5.
+
+Fits can be persisted (`write_fit`) and used to warm-start a later fit of the same gene (`read_fit`), for example
+in a related cell type or with a different number of effects L. Persisted fits also keep the effects with a credible
+set (`cs_index`), so that their log Bayes factors (`lbf_variable`) can be used for colocalisation (coloc's bf_bf).
+"""
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+from scipy.stats import norm
+
+from cpg_utils import to_path
+
+# fit entries persisted by `write_fit`, enough to warm-start a later fit
+FIT_ARRAYS = ['alpha', 'mu', 'mu2', 'lbf_variable', 'V', 'elbo']
+
+
+def single_effect_loglik(V: float, betahat: np.ndarray, shat2: np.ndarray, prior_weights: np.ndarray) -> float:
+    """
+    Log Bayes factor of a single-effect model with prior variance V (against no effect)
+    """
+    lbf = norm.logpdf(betahat, 0, np.sqrt(V + shat2)) - norm.logpdf(betahat, 0, np.sqrt(shat2))
+    lbf[np.isinf(shat2)] = 0
+    maxlbf = lbf.max()
+    return np.log(np.sum(np.exp(lbf - maxlbf) * prior_weights)) + maxlbf
+
+
+def optimize_prior_variance(
+    betahat: np.ndarray,
+    shat2: np.ndarray,
+    prior_weights: np.ndarray,
+    V_init: float,
+    check_null_threshold: float = 0.0,
+) -> float:
+    """
+    Maximise the single-effect likelihood over log(V) in [-30, 15], keeping V_init if it is better,
+    and setting V to 0 if no effect is at least as likely
+    """
+
+    def neg_loglik_logscale(log_V):
+        return -single_effect_loglik(np.exp(log_V), betahat, shat2, prior_weights)
+
+    log_V = minimize_scalar(neg_loglik_logscale, bounds=(-30, 15), method='bounded').x
+    if V_init > 0 and neg_loglik_logscale(log_V) > neg_loglik_logscale(np.log(V_init)):
+        log_V = np.log(V_init)
+    V = np.exp(log_V)
+    if single_effect_loglik(0, betahat, shat2, prior_weights) + check_null_threshold >= single_effect_loglik(
+        V,
+        betahat,
+        shat2,
+        prior_weights,
+    ):
+        V = 0.0
+    return V
+
+
+def single_effect_regression(
+    XtR: np.ndarray,
+    dXtX: np.ndarray,
+    V: float,
+    sigma2: float,
+    prior_weights: np.ndarray,
+) -> dict:
+    """
+    Bayesian single-effect regression on sufficient statistics, estimating the prior variance V
+    """
+    shat2 = sigma2 / dXtX
+    betahat = XtR / dXtX
+    V = optimize_prior_variance(betahat, shat2, prior_weights, V)
+
+    if V > 0:
+        lbf = norm.logpdf(betahat, 0, np.sqrt(V + shat2)) - norm.logpdf(betahat, 0, np.sqrt(shat2))
+    else:
+        lbf = np.zeros_like(betahat)
+    lbf[np.isinf(shat2)] = 0
+    maxlbf = lbf.max()
+    w_weighted = np.exp(lbf - maxlbf) * prior_weights
+    alpha = w_weighted / w_weighted.sum()
+    post_var = 1 / (1 / V + dXtX / sigma2) if V > 0 else np.zeros_like(dXtX)
+    post_mean = post_var * XtR / sigma2
+    return {
+        'alpha': alpha,
+        'mu': post_mean,
+        'mu2': post_var + post_mean**2,
+        'lbf': lbf,
+        'lbf_model': maxlbf + np.log(w_weighted.sum()),
+        'V': V,
+    }
+
+
+def expected_loglik(XtX: np.ndarray, Xty: np.ndarray, fit: dict, yty: float, n: int) -> float:
+    """
+    Expected log-likelihood of the full model under the variational posterior
+    """
+    B = fit['alpha'] * fit['mu']
+    betabar = B.sum(axis=0)
+    XB2 = np.sum((B @ XtX) * B)
+    postb2 = fit['alpha'] * fit['mu2']
+    er2 = yty - 2 * betabar @ Xty + betabar @ XtX @ betabar - XB2 + np.sum(np.diag(XtX) * postb2)
+    return -n / 2 * np.log(2 * np.pi * fit['sigma2']) - er2 / (2 * fit['sigma2'])
+
+
+def credible_sets(
+    alpha: np.ndarray,
+    V: np.ndarray,
+    R: np.ndarray,
+    coverage: float = 0.95,
+    min_abs_corr: float = 0.5,
+) -> dict:
+    """
+    Credible sets of each effect: the fewest variables whose alpha sums to `coverage`.
+    Sets of effects with no prior variance, duplicated sets and sets with purity (minimum absolute
+    correlation between their variables) below `min_abs_corr` are dropped; the rest are ordered by purity.
+
+    Returns:
+        dict with cs (list of variable indices), cs_index (effect of each set), purity (min, mean and median
+        absolute correlation) and coverage (claimed coverage of each set); all empty if there is no set
+    """
+    sets, seen = [], set()
+    for l in np.flatnonzero(V > 1e-9):
+        order = np.argsort(-alpha[l], kind='stable')
+        n_in_set = np.sum(np.cumsum(alpha[l][order]) < coverage) + 1
+        cs = np.sort(order[:n_in_set])
+        if tuple(cs) in seen:
+            continue
+        seen.add(tuple(cs))
+        if len(cs) == 1:
+            purity = (1.0, 1.0, 1.0)
+        else:
+            abs_corr = np.abs(R[np.ix_(cs, cs)][np.triu_indices(len(cs), k=1)])
+            purity = (abs_corr.min(), abs_corr.mean(), np.median(abs_corr))
+        if purity[0] >= min_abs_corr:
+            sets.append((cs, int(l), purity, alpha[l][cs].sum()))
+    sets.sort(key=lambda cs_set: -cs_set[2][0])
+    return {
+        'cs': [cs for cs, _, _, _ in sets],
+        'cs_index': [l for _, l, _, _ in sets],
+        'purity': [purity for _, _, purity, _ in sets],
+        'coverage': [claimed for _, _, _, claimed in sets],
+    }
+
+
+def susie_get_pip(fit: dict, prune_by_cs: bool = False, prior_tol: float = 1e-9) -> np.ndarray:
+    """
+    Posterior inclusion probabilities, from effects with a non-zero prior variance
+    (and, if `prune_by_cs`, only from effects with a credible set)
+    """
+    include = np.flatnonzero(fit['V'] > prior_tol)
+    if prune_by_cs:
+        include = np.intersect1d(include, fit['sets']['cs_index'])
+    if len(include) == 0:
+        return np.zeros(fit['alpha'].shape[1])
+    return 1 - np.prod(1 - fit['alpha'][include], axis=0)
+
+
+def summary_vars(fit: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Per-variable summary, as in susieR's summary(fit)$vars (in variable order):
+    variable_prob (PIP) and cs (effect of the credible set the variable is in, -1 if none)
+    """
+    cs_of_variable = np.full(fit['alpha'].shape[1], -1)
+    for cs, l in zip(fit['sets']['cs'], fit['sets']['cs_index']):
+        cs_of_variable[cs] = l + 1  # effects are numbered from 1, as in susieR
+    return fit['pip'], cs_of_variable
+
+
+def write_fit(path: str, fit: dict, variant_ids: list[str]):
+    """
+    Persist the posterior of a fit (with the variant IDs of its columns, and the effects with a credible set)
+    as a compressed .npz
+    """
+    with to_path(path).open('wb') as f:
+        np.savez_compressed(
+            f,
+            varid=np.asarray(variant_ids, dtype=str),
+            niter=fit['niter'],
+            converged=fit['converged'],
+            cs_index=np.asarray(fit['sets']['cs_index'], dtype=int),
+            **{key: fit[key] for key in FIT_ARRAYS},
+        )
+
+
+def read_fit(path: str, variant_ids: list[str]) -> dict | None:
+    """
+    Read a persisted fit, aligned to `variant_ids` (None if there is no fit at `path`).
+    Variants missing from the persisted fit start with no weight.
+    """
+    if not to_path(path).exists():
+        return None
+    with to_path(path).open('rb') as f, np.load(f) as npz:
+        stored = {key: npz[key] for key in [*FIT_ARRAYS, 'varid']}
+    index = {varid: i for i, varid in enumerate(stored['varid'])}
+    columns = np.array([index.get(varid, -1) for varid in variant_ids])
+    found = columns >= 0
+    init = {'V': stored['V']}
+    for key in ['alpha', 'mu', 'mu2', 'lbf_variable']:
+        init[key] = np.zeros((len(stored['V']), len(variant_ids)))
+        init[key][:, found] = stored[key][:, columns[found]]
+    return init
+
+
+def init_effects(init: dict | None, L: int, p: int, V: float) -> dict:
+    """
+    Initial posterior of L effects over p variables: from `init` (a previous fit, aligned to the same variables)
+    if given, keeping its L effects with the largest prior variances and adding null effects if it has fewer,
+    otherwise the null start (uniform alpha, zero mu) with prior variance V
+    """
+    fit = {
+        'alpha': np.full((L, p), 1 / p),
+        'mu': np.zeros((L, p)),
+        'mu2': np.zeros((L, p)),
+        'lbf_variable': np.zeros((L, p)),
+        'V': np.full(L, V),
+    }
+    if init is not None:
+        keep = np.argsort(-init['V'], kind='stable')[:L]
+        for key in fit:
+            fit[key][: len(keep)] = init[key][keep]
+        # renormalise alpha (variants can be missing from the previous fit)
+        alpha = fit['alpha'][: len(keep)]
+        totals = alpha.sum(axis=1, keepdims=True)
+        fit['alpha'][: len(keep)] = np.where(totals > 0, alpha / np.where(totals > 0, totals, 1), 1 / p)
+    return fit
+
+
+def susie_rss(
+    bhat: np.ndarray,
+    shat: np.ndarray,
+    n: int,
+    R: np.ndarray,
+    var_y: float = 1.0,
+    L: int = 10,
+    scaled_prior_variance: float = 0.2,
+    max_iter: int = 100,
+    tol: float = 1e-3,
+    coverage: float = 0.95,
+    min_abs_corr: float = 0.5,
+    init: dict | None = None,
+) -> dict:
+    """
+    Fit SuSiE to summary statistics (effect sizes, their standard errors and the LD matrix).
+
+    Args:
+        bhat, shat (np.ndarray): effect sizes and standard errors of each variable
+        n (int): sample size
+        R (np.ndarray): LD (correlation) matrix of the variables; NaN entries (monomorphic variants) are taken as 0
+        var_y (float): variance of the phenotype
+        L (int): maximum number of causal variables
+        init (dict): previous fit (see `read_fit`) to warm-start from, instead of the null start
+
+    Returns:
+        dict with alpha, mu, mu2 and lbf_variable (L x variables), V, lbf and KL (per effect), elbo,
+        niter, converged, sigma2, sets (see `credible_sets`) and pip
+    """
+    bhat = np.asarray(bhat, dtype=np.float64)
+    shat = np.asarray(shat, dtype=np.float64)
+    R = np.nan_to_num(np.asarray(R, dtype=np.float64))
+    np.fill_diagonal(R, 1)
+    p = len(bhat)
+    L = min(L, p)
+
+    # sufficient statistics, with z-scores adjusted for the sample size (as in susie_rss)
+    z = bhat / shat
+    adj = (n - 1) / (z**2 + n - 2)
+    XtXdiag = var_y * adj / shat**2
+    XtX = R * np.sqrt(XtXdiag)[:, None] * np.sqrt(XtXdiag)[None, :]
+    XtX = (XtX + XtX.T) / 2
+    Xty = z * adj * var_y / shat
+    yty = (n - 1) * var_y
+    # standardise
+    csd = np.sqrt(np.diag(XtX) / (n - 1))
+    csd[csd == 0] = 1
+    XtX = XtX / csd[:, None] / csd[None, :]
+    Xty = Xty / csd
+    dXtX = np.diag(XtX)
+
+    prior_weights = np.full(p, 1 / p)
+    fit = init_effects(init, L, p, scaled_prior_variance * var_y)
+    fit.update({'lbf': np.full(L, np.nan), 'KL': np.full(L, np.nan), 'sigma2': var_y})
+    XtXr = XtX @ (fit['alpha'] * fit['mu']).sum(axis=0)
+    elbo = [-np.inf]
+    converged = False
+    for _ in range(max_iter):
+        for l in range(L):
+            # residualise on all other effects
+            XtXr -= XtX @ (fit['alpha'][l] * fit['mu'][l])
+            XtR = Xty - XtXr
+            ser = single_effect_regression(XtR, dXtX, fit['V'][l], fit['sigma2'], prior_weights)
+            fit['alpha'][l], fit['mu'][l], fit['mu2'][l] = ser['alpha'], ser['mu'], ser['mu2']
+            fit['lbf_variable'][l], fit['lbf'][l], fit['V'][l] = ser['lbf'], ser['lbf_model'], ser['V']
+            eb, eb2 = ser['alpha'] * ser['mu'], ser['alpha'] * ser['mu2']
+            fit['KL'][l] = -ser['lbf_model'] - 0.5 / fit['sigma2'] * (-2 * eb @ XtR + dXtX @ eb2)
+            XtXr += XtX @ eb
+        elbo.append(expected_loglik(XtX, Xty, fit, yty, n) - fit['KL'].sum())
+        if elbo[-1] - elbo[-2] < tol:
+            converged = True
+            break
+
+    fit['elbo'] = np.array(elbo[1:])
+    fit['niter'] = len(elbo) - 1
+    fit['converged'] = converged
+    fit['sets'] = credible_sets(fit['alpha'], fit['V'], R, coverage, min_abs_corr)
+    fit['pip'] = susie_get_pip(fit)
+    return fit
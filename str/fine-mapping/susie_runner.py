@@ -2,15 +2,25 @@
 
 """
 
-This script will run SusieR, fine-mapping tool.
+This script will run SuSiE-RSS, fine-mapping tool (NumPy implementation in `susie_rss.py`, following susieR's defaults).
 
 Required inputs:
-- output from`corr_matrix_maker.py` (ie LD matrix)
+- output from`corr_matrix_maker.py` (ie LD matrix shared by all cell types, stored as binary .npy, see ld_store.py)
 - associaTR raw outputs (eSNPs and eSTRs combined), preferably also run with `remove_STR_indels.py`.
+
+Genes of a cell type and chromosome are fitted in one job, in a pool of `--susie-cpu` processes.
+Each fit is persisted (`{gene}_fit.npz`), and can warm-start a later run (`--warm-start-dir`), for example
+for a related cell type (`--warm-start-celltype`) or a different `--num-causal-variants`.
+
+GWAS mode (`--gwas-store-dir`): SuSiE is instead fitted to the GWAS summary statistics of each gene's region, over the
+variants of its shared LD matrix (ie with the cached LD, one job per chromosome for all cell types), and persisted as
+`susie_gwas/{pheno-output-name}/{chrom}/{gene}_fit.npz` for SuSiE-coloc (`str/coloc/coloc_susie_runner.py`).
+The GWAS store is as written by `str/coloc/gwas_store.py`, and `--gwas-n` is the GWAS sample size.
+
 analysis-runner --dataset "bioheart" \
-    --description "Run susieR for eGenes identified by STR analysis" \
+    --description "Run SuSiE for eGenes identified by STR analysis" \
     --access-level "test" \
-    --image "australia-southeast1-docker.pkg.dev/cpg-common/images/r-meta:susie" \
+    --image "australia-southeast1-docker.pkg.dev/analysis-runner/images/driver:d4922e3062565ff160ac2ed62dcdf2fba576b75a-hail-8f6797b033d2e102575c40166cf0c977e91f834e" \
     --output-dir "str/associatr/fine_mapping/v2" \
     susie_runner.py \
     --celltypes "gdT,B_intermediate,ILC,Plasmablast,dnT,ASDC,cDC1,pDC,NK_CD56bright,MAIT,B_memory,CD4_CTL,CD4_Proliferating,CD8_Proliferating,HSPC,NK_Proliferating,cDC2,CD16_Mono,Treg,CD14_Mono,CD8_TCM,CD4_TEM,CD8_Naive,CD4_TCM,NK,CD8_TEM,CD4_Naive,B_naive" \
@@ -20,104 +30,197 @@ analysis-runner --dataset "bioheart" \
     --max-parallel-jobs 100
 """
 
+import sys
+from pathlib import Path
+
 import click
+import pandas as pd
+from ld_store import SHARED_LD_DIR
 
 import hailtop.batch as hb
 
 from cpg_utils import to_path
 from cpg_utils.hail_batch import get_batch, output_path
 
-
-def susie_runner(ld_path, associatr_path, celltype, chrom, num_iterations, num_causal_variants):
+# shared job helpers (str/helper/job_modules.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'helper'))
+from job_modules import ship_modules
+
+
+def fit_summary(fit: dict, varids: list[str]) -> str:
+    """
+    Plain-text summary of a SuSiE fit (convergence, prior variances and credible sets)
+    """
+    lines = [
+        f"niter: {fit['niter']}",
+        f"converged: {fit['converged']}",
+        f"elbo: {' '.join(f'{elbo:.6g}' for elbo in fit['elbo'])}",
+        f"V: {' '.join(f'{V:.6g}' for V in fit['V'])}",
+    ]
+    sets = fit['sets']
+    for cs, l, purity, coverage in zip(sets['cs'], sets['cs_index'], sets['purity'], sets['coverage']):
+        lines.append(
+            f'L{l + 1}: coverage={coverage:.4f} min_abs_corr={purity[0]:.4f} mean_abs_corr={purity[1]:.4f} '
+            f'median_abs_corr={purity[2]:.4f} variants={",".join(varids[i] for i in cs)}',
+        )
+    return '\n'.join(lines) + '\n'
+
+
+def read_gwas_region(bgz_path: str, chrom: str, start: int, end: int) -> pd.DataFrame:
+    """
+    SNP GWAS variants of a region of a (local) GWAS store file (see str/coloc/gwas_store.py), with their LD variant ID
+    (the store's 'chr1_123_A_G' as 'chr1:123_A-G')
+    """
     import pandas as pd
-    import rpy2.robjects as ro
-    from rpy2.robjects import pandas2ri
-
-    from cpg_utils.hail_batch import output_path
-
-    ro.r('library(susieR)')
-    ro.r('library(tidyverse)')
-
-    # load in LD matrix and associatr file into R environment
-    ld_matrix = pd.read_csv(ld_path, sep='\t')
-    ld_matrix = ld_matrix.rename(columns={'Unnamed: 0': 'X'})
-
-    gene = ld_path.split('/')[-1].split('_')[0]
-    with (ro.default_converter + pandas2ri.converter).context():
-        ld_r = ro.conversion.get_conversion().py2rpy(ld_matrix)
-    print('loaded in ld_r')
-    associatr_sum_stats = pd.read_csv(associatr_path, sep='\t')
-    with (ro.default_converter + pandas2ri.converter).context():
-        associatr_r = ro.conversion.get_conversion().py2rpy(associatr_sum_stats)
-    print('loaded in associatr_r')
-    ro.globalenv['associatr_r'] = associatr_r
-    ro.globalenv['ld_r'] = ld_r
-    ro.globalenv['gene'] = gene
-    ro.globalenv['num_iterations'] = num_iterations
-    ro.globalenv['num_causal_variants'] = num_causal_variants
-
-    ro.r(
-        '''
-    df_subset <- subset(ld_r, select = -X)
-    corr_x = as.matrix(df_subset)
-    rownames(corr_x) <- NULL
-    colnames(corr_x) <- NULL
-
-    # Create a new variable directly with the desired format
-    associatr_r$varid <- paste(associatr_r$chr, associatr_r$pos, sep = ":")
-    associatr_r$varid <- paste(associatr_r$varid, associatr_r$motif, sep = "_")
-
-    # Create an index based on the order vector
-    index <- match(ld_r$X, associatr_r$varid)
-
-    # Reorder the associatr data frame using the index
-    df_ordered <- associatr_r[index, ]
-
-    # Run SusieR
-    fitted_rss1 <- susie_rss(bhat = df_ordered$coeff_meta, shat = df_ordered$se_meta, n = df_ordered$n_samples_tested_1[1]+df_ordered$n_samples_tested_2[1], R = corr_x, var_y = 1, L = num_causal_variants,
-    max_iter =num_iterations)
-
-   # Append SusieR results to dataframe
-    df_ordered$susie_pip = susie_get_pip(fitted_rss1, prune_by_cs = TRUE)
-
-    # Capture the raw outputs
-    raw_output = capture.output(fitted_rss1)
-
-    # Capture the summary outputs (try catch, in case it is empty)
-    p4 <- tryCatch({
+    import pysam
+
+    with pysam.TabixFile(bgz_path) as tabix:
+        rows = [] if chrom not in tabix.contigs else [line.split('\t') for line in tabix.fetch(chrom, start - 1, end)]
+    gwas = pd.DataFrame(rows, columns=['chromosome', 'position', 'snp', 'beta', 'varbeta', 'p_value'])
+    for column in ['beta', 'varbeta']:
+        gwas[column] = pd.to_numeric(gwas[column], errors='coerce')
+    snp = gwas['snp'].str.split('_', expand=True)
+    if snp.shape[1] != 4:
+        gwas['varid'] = pd.Series(dtype=str)
+        return gwas
+    gwas['varid'] = snp[0] + ':' + snp[1] + '_' + snp[2] + '-' + snp[3]
+    return gwas
+
+
+def susie_gwas_runner(
+    ld_dir,
+    gwas_input,
+    chrom,
+    genes,
+    gwas_n,
+    pheno_output_name,
+    num_iterations,
+    num_causal_variants,
+    max_workers,
+    *,
+    localise_modules,
+):
+    """
+    Fit SuSiE to the GWAS summary statistics of each gene's region, over the variants of its shared LD matrix
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
 
-    summary_df <- as.data.frame(as.matrix(summary(fitted_rss1)))
-    summary_df <- summary_df[order(summary_df$variable), ]
-    summary_df <- summary_df[, -1]
-    df_ordered <- cbind(df_ordered, summary_df)
-    }, error = function(e) {
+    import numpy as np
 
-    print(paste("An error occurred:", e))
-    0
-    })
+    from cpg_utils import to_path
+    from cpg_utils.hail_batch import output_path
 
+    # ld_store.py and susie_rss.py, shipped with the job
+    localise_modules()
+    from ld_store import SHARED_LD_DIR, read_ld_matrix, read_ld_variants
+    from susie_rss import susie_rss, write_fit
+
+    fit_gene = partial(susie_rss, var_y=1, L=num_causal_variants, max_iter=num_iterations)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # load genes in batches, to bound the number of LD matrices held in memory at once
+        for start in range(0, len(genes), 4 * max_workers):
+            inputs = []
+            for gene in genes[start : start + 4 * max_workers]:
+                prefix = f'{ld_dir}/{SHARED_LD_DIR}/{chrom}/{gene}_correlation_matrix'
+                ld_ids = read_ld_variants(prefix)
+                positions = [int(varid.split(':')[1].split('_')[0]) for varid in ld_ids]
+                gwas = read_gwas_region(gwas_input['bgz'], chrom, min(positions), max(positions))
+                gwas = gwas[gwas['varid'].isin(ld_ids) & (gwas['varbeta'] > 0) & gwas['beta'].notna()]
+                gwas = gwas.drop_duplicates('varid')
+                if gwas.empty:
+                    print(f'No SNP GWAS data for {gene} in the LD variants: skipping....')
+                    continue
+                ld_matrix, _ = read_ld_matrix(prefix, gwas['varid'].tolist())
+                inputs.append((gene, gwas, np.asarray(ld_matrix, dtype=np.float64)))
+            futures = [
+                executor.submit(fit_gene, gwas['beta'].to_numpy(), np.sqrt(gwas['varbeta'].to_numpy()), gwas_n, ld)
+                for _, gwas, ld in inputs
+            ]
+            for (gene, gwas, _), future in zip(inputs, futures):
+                fit = future.result()
+                write_fit(
+                    output_path(f"susie_gwas/{pheno_output_name}/{chrom}/{gene}_fit.npz", 'analysis'),
+                    fit,
+                    gwas['varid'].tolist(),
+                )
+                with to_path(
+                    output_path(f"susie_gwas/{pheno_output_name}/{chrom}/{gene}_100kb_output.txt", 'analysis'),
+                ).open('w') as file:
+                    file.write(fit_summary(fit, gwas['varid'].tolist()))
+                print(f'Fitted SuSiE to the GWAS for {gene}')
 
-    ''',
-    )
 
-    # convert to pandas df
-    with (ro.default_converter + pandas2ri.converter).context():
-        susie_associatr_df = ro.conversion.get_conversion().rpy2py(ro.r('df_ordered'))
-    print('converted back to pandas df')
+def susie_runner(
+    ld_dir,
+    associatr_dir,
+    celltype,
+    chrom,
+    genes,
+    num_iterations,
+    num_causal_variants,
+    max_workers,
+    warm_start_dir=None,
+    *,
+    localise_modules,
+):
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
 
-    # convert raw output to python
-    raw_output_python = ro.r('raw_output')
+    # ld_store.py and susie_rss.py, shipped with the job
+    localise_modules()
+    from ld_store import load_gene_inputs
+    from susie_rss import read_fit, summary_vars, susie_get_pip, susie_rss, write_fit
 
-    # write raw output to GCS
-    with to_path(output_path(f"susie/{celltype}/{chrom}/{gene}_100kb_output.txt", 'analysis')).open('w') as file:
-        file.write(str(raw_output_python))
+    from cpg_utils import to_path
+    from cpg_utils.hail_batch import output_path
 
-    # write dataframe to GCS
-    susie_associatr_df.to_csv(
-        output_path(f"susie/{celltype}/{chrom}/{gene}_100kb.tsv", 'analysis'),
-        sep='\t',
-        index=False,
-    )
+    fit_gene = partial(susie_rss, var_y=1, L=num_causal_variants, max_iter=num_iterations)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # load genes in batches, to bound the number of LD matrices held in memory at once
+        for start in range(0, len(genes), 4 * max_workers):
+            batch_genes = genes[start : start + 4 * max_workers]
+            inputs = [load_gene_inputs(ld_dir, associatr_dir, celltype, chrom, gene) for gene in batch_genes]
+            futures = [
+                executor.submit(
+                    fit_gene,
+                    associatr['coeff_meta'].to_numpy(),
+                    associatr['se_meta'].to_numpy(),
+                    n,
+                    ld_matrix,
+                    # warm-start from a persisted fit of the same gene (None: null start)
+                    init=(
+                        read_fit(f'{warm_start_dir}/{chrom}/{gene}_fit.npz', associatr['varid'].tolist())
+                        if warm_start_dir
+                        else None
+                    ),
+                )
+                for gene, (associatr, ld_matrix, n) in zip(batch_genes, inputs)
+            ]
+            for gene, (associatr, _, _), future in zip(batch_genes, inputs, futures):
+                fit = future.result()
+                write_fit(
+                    output_path(f"susie/{celltype}/{chrom}/{gene}_fit.npz", 'analysis'),
+                    fit,
+                    associatr['varid'].tolist(),
+                )
+                # append SuSiE results to dataframe (as susie_get_pip(prune_by_cs = TRUE) and summary(fit)$vars)
+                associatr['susie_pip'] = susie_get_pip(fit, prune_by_cs=True)
+                associatr['variable_prob'], associatr['cs'] = summary_vars(fit)
+
+                # write fit summary to GCS
+                with to_path(output_path(f"susie/{celltype}/{chrom}/{gene}_100kb_output.txt", 'analysis')).open(
+                    'w',
+                ) as file:
+                    file.write(fit_summary(fit, associatr['varid'].tolist()))
+
+                # write dataframe to GCS
+                associatr.to_csv(
+                    output_path(f"susie/{celltype}/{chrom}/{gene}_100kb.tsv", 'analysis'),
+                    sep='\t',
+                    index=False,
+                )
+                print(f'Fitted SuSiE for {gene}')
 
 
 @click.option('--celltypes', help='Cell types comma separated')
@@ -125,9 +228,26 @@ def susie_runner(ld_path, associatr_path, celltype, chrom, num_iterations, num_c
 @click.option('--ld-dir', help='Directory to LD correlation matrices')
 @click.option('--associatr-dir', help='Directory to associatr outputs')
 @click.option('--max-parallel-jobs', help='Maximum number of parallel jobs', default=500)
-@click.option('--num_iterations', help='Number of iterations for SusieR', default=100)
-@click.option('--susie-cpu', help='CPU for SusieR job', default=0.25)
+@click.option('--num_iterations', help='Number of iterations for SuSiE', default=100)
+@click.option('--susie-cpu', help='CPU for SuSiE job (genes are fitted in one process per CPU)', default=4)
 @click.option('--num-causal-variants', help='Number of causal variants to estimate', default=10)
+@click.option(
+    '--warm-start-dir',
+    help='Directory of persisted fits (as written by this script, eg {output}/susie) to warm-start from',
+    default=None,
+)
+@click.option(
+    '--warm-start-celltype',
+    help='Cell type of the fits to warm-start from (default: the same cell type, eg for an L-sweep)',
+    default=None,
+)
+@click.option(
+    '--gwas-store-dir',
+    help='GWAS store (see str/coloc/gwas_store.py) to fit instead of the eQTLs (GWAS mode)',
+    default=None,
+)
+@click.option('--pheno-output-name', help='Phenotype output name (GWAS mode)', default=None)
+@click.option('--gwas-n', help='GWAS sample size (GWAS mode)', type=int, default=None)
 @click.option('--always-run', help='Job set to always run', is_flag=True)
 @click.command()
 def main(
@@ -139,6 +259,11 @@ def main(
     num_iterations,
     susie_cpu,
     num_causal_variants,
+    warm_start_dir,
+    warm_start_celltype,
+    gwas_store_dir,
+    pheno_output_name,
+    gwas_n,
     always_run,
 ):
     # Setup MAX concurrency by genes
@@ -152,37 +277,89 @@ def main(
             job.depends_on(_dependent_jobs[-max_parallel_jobs])
         _dependent_jobs.append(job)
 
-    b = get_batch(name='Run susieR')
+    if gwas_store_dir:
+        if not (pheno_output_name and gwas_n):
+            raise ValueError('GWAS mode needs --pheno-output-name and --gwas-n')
+        b = get_batch(name=f'Run SuSiE: {pheno_output_name}')
+        for chrom in chromosomes.split(','):
+            gwas_files = {'bgz': f'{gwas_store_dir}/{chrom}.tsv.bgz', 'tbi': f'{gwas_store_dir}/{chrom}.tsv.bgz.tbi'}
+            # the store has no file for chromosomes without GWAS variants
+            if not all(to_path(path).exists() for path in gwas_files.values()):
+                print(f'No GWAS store file for {chrom} ({pheno_output_name}): skipping....')
+                continue
+            # the GWAS is fitted over the variants of the LD matrix shared by all cell types
+            ld_files = list(to_path(f'{ld_dir}/{SHARED_LD_DIR}/{chrom}').glob('*_variants.tsv'))
+            genes = []
+            for ld_file in ld_files:
+                gene = str(ld_file).split('/')[-1].split('_')[0]
+                if to_path(
+                    output_path(f"susie_gwas/{pheno_output_name}/{chrom}/{gene}_fit.npz", 'analysis'),
+                ).exists():
+                    continue
+                genes.append(gene)
+            if not genes:
+                continue
+            print(f'Processing {len(genes)} genes for {pheno_output_name}:{chrom}...')
+
+            susie_job = b.new_python_job(f'SuSiE for {chrom}: {pheno_output_name}')
+            susie_job.cpu(susie_cpu)
+            if always_run:
+                susie_job.always_run()
+            susie_job.call(
+                susie_gwas_runner,
+                ld_dir,
+                b.read_input_group(**gwas_files),
+                chrom,
+                genes,
+                gwas_n,
+                pheno_output_name,
+                num_iterations,
+                num_causal_variants,
+                max(1, int(susie_cpu)),
+                localise_modules=ship_modules(__file__, 'ld_store.py', 'susie_rss.py'),
+            )
+            manage_concurrency_for_job(susie_job)
+        b.run(wait=False)
+        return
+
+    b = get_batch(name='Run SuSiE')
 
     for celltype in celltypes.split(','):
         for chrom in chromosomes.split(','):
-            ld_files = list(to_path(f'{ld_dir}/{celltype}/{chrom}').glob('*.tsv'))
-            for ld_file in ld_files:  # for each gene (each has its own LD file)
-                ld_file = str(ld_file)
-                gene = ld_file.split('/')[-1].split('_')[0]
-                print(f'Processing {gene}...')
+            # each gene has its own LD file (shared by all cell types), subset to the variants listed for this cell type
+            ld_files = list(to_path(f'{ld_dir}/{celltype}/{chrom}').glob('*_variants.tsv'))
+            genes = []
+            for ld_file in ld_files:
+                gene = str(ld_file).split('/')[-1].split('_')[0]
                 if to_path(
                     output_path(f"susie/{celltype}/{chrom}/{gene}_100kb.tsv", 'analysis'),
                 ).exists():
                     continue
-                associatr_path = f'{associatr_dir}/{celltype}/{chrom}/{gene}_100000bp_meta_results.tsv'
-
-                susie_job = b.new_python_job(
-                    f'SusieR for {chrom}:{gene}: {celltype}',
-                )
-                susie_job.cpu(susie_cpu)
-                if always_run:
-                    susie_job.always_run()
-                susie_job.call(
-                    susie_runner,
-                    ld_file,
-                    associatr_path,
-                    celltype,
-                    chrom,
-                    num_iterations,
-                    num_causal_variants,
-                )
-                manage_concurrency_for_job(susie_job)
+                genes.append(gene)
+            if not genes:
+                continue
+            print(f'Processing {len(genes)} genes for {celltype}:{chrom}...')
+
+            susie_job = b.new_python_job(
+                f'SuSiE for {chrom}: {celltype}',
+            )
+            susie_job.cpu(susie_cpu)
+            if always_run:
+                susie_job.always_run()
+            susie_job.call(
+                susie_runner,
+                ld_dir,
+                associatr_dir,
+                celltype,
+                chrom,
+                genes,
+                num_iterations,
+                num_causal_variants,
+                max(1, int(susie_cpu)),
+                f'{warm_start_dir}/{warm_start_celltype or celltype}' if warm_start_dir else None,
+                localise_modules=ship_modules(__file__, 'ld_store.py', 'susie_rss.py'),
+            )
+            manage_concurrency_for_job(susie_job)
     b.run(wait=False)
 
 
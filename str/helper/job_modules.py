@@ -0,0 +1,47 @@
+"""
+Shipping repo modules with Hail Batch Python jobs.
+
+The worker image does not contain this repo, and dill pickles the functions of importable modules by reference, so a
+job importing a repo module (eg `ld_store.py`) fails on the worker with ModuleNotFoundError. `ship_modules` reads the
+modules on the driver and returns `localise_modules`, which is pickled by value (with the module sources) as a job
+argument, and makes them importable in the job:
+
+    # driver (scripts import this module from str/helper, see eg str/fine-mapping/susie_runner.py)
+    job.call(fit_genes, ..., localise_modules=ship_modules(__file__, 'ld_store.py', 'susie_rss.py'))
+
+    # job
+    def fit_genes(..., *, localise_modules):
+        localise_modules()
+        from ld_store import read_ld_matrix
+
+Process pools of the job inherit the import path, so their workers can import the shipped modules too.
+"""
+
+from pathlib import Path
+
+
+def ship_modules(script: str, *paths: str):
+    """
+    Repo modules a job imports, as a function to call in the job to make them importable there
+
+    Args:
+        script: path of the calling script (`__file__`)
+        paths: modules to ship, relative to the directory of `script`
+    """
+    sources = {Path(path).stem: (Path(script).parent / path).read_text() for path in paths}
+
+    # nested, so that dill pickles it by value (with `sources`) rather than as a reference to this module
+    def localise_modules():
+        """
+        Write the shipped modules to a local directory on the import path of the job
+        """
+        import sys
+        import tempfile
+
+        module_dir = tempfile.mkdtemp()
+        for name, source in sources.items():
+            with open(f'{module_dir}/{name}.py', 'w') as f:
+                f.write(source)
+        sys.path.insert(0, module_dir)
+
+    return localise_modules